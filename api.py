@@ -0,0 +1,221 @@
+'''
+HTTP API for the chatbot, alongside the Streamlit UI
+
+use command:
+
+uvicorn api:app --host 0.0.0.0 --port 8000
+
+Projects are the directories under `dbs/`, as in the Streamlit app. Retrievers, OpenAI clients and the answer
+cache are shared by all requests in the process. Set GPRMAX_CHATBOT_PRELOAD to a comma separated list of
+projects to load them at startup; /ready reports ready once they are loaded.
+
+endpoints:
+
+POST /query           {"query", "projects", "model"} -> {"answer", "sources"}
+POST /query/stream    same body, streams newline delimited JSON: {"sources"}, then {"token"}s, then {"done", "metrics"}
+POST /prompt          {"query", "projects"} -> {"prompt", "sources"}
+POST /generate_input  {"query"} -> {"file_name", "content"}
+GET  /health          liveness, and the projects currently loaded
+GET  /ready           503 until the preloaded projects are loaded and an OpenAI API key is set
+'''
+
+import asyncio
+import json
+import os
+import threading
+import time
+from contextlib import asynccontextmanager
+from typing import List
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel
+from utils.answer_cache_utils import cached_query_chatbot
+from utils.query_utils import build_prompt, generate_gprmax_input_text, get_prompt, stream_answer, stream_query_chatbot
+from utils.retriever_utils import get_embedding_function, get_llm, get_retriever, project_name, query_projects_chatbot, retrieve_across_projects, retriever_stats
+
+
+DEFAULT_PROJECT = "af6c69d5"
+CHAT_MODELS = ["gpt-4o-mini", "gpt-4o"]
+
+_state = {"ready" : False, "preload_error" : None}
+
+
+class QueryRequest(BaseModel):
+    query: str
+    projects: List[str] = [DEFAULT_PROJECT]
+    model: str = "gpt-4o-mini"
+
+
+class PromptRequest(BaseModel):
+    query: str
+    projects: List[str] = [DEFAULT_PROJECT]
+
+
+class GenerateInputRequest(BaseModel):
+    query: str = "generate input file"
+
+
+def project_db_dir(project):
+    '''
+    `dbs/{project}/db`, or a 404 if there is no such project
+    '''
+    if not project or os.path.basename(project) != project or project.startswith("."):
+        raise HTTPException(status_code=400, detail=f"Invalid project name: {project}")
+
+    db_dir = f"dbs/{project}/db"
+    if not os.path.exists(db_dir):
+        raise HTTPException(status_code=404, detail=f"Database does not exist, or is in the incorrect location: {db_dir}")
+
+    return db_dir
+
+
+def check_request(query, projects, model = None):
+    if not query.strip():
+        raise HTTPException(status_code=400, detail="Please enter a query")
+    if not projects:
+        raise HTTPException(status_code=400, detail="Please select a project")
+    if model is not None and model not in CHAT_MODELS:
+        raise HTTPException(status_code=400, detail=f"Unknown chat model {model}, expected one of {CHAT_MODELS}")
+    if not os.environ.get("OPENAI_API_KEY"):
+        raise HTTPException(status_code=503, detail="No OpenAI API key set")
+
+    return [project_db_dir(project) for project in projects]
+
+
+def preload_projects():
+    projects = [project.strip() for project in os.environ.get("GPRMAX_CHATBOT_PRELOAD", "").split(",") if project.strip()]
+    try:
+        for project in projects:
+            get_retriever(f"dbs/{project}/db", get_embedding_function())
+            print(f"Loaded project {project}")
+        _state["ready"] = True
+    except Exception as e:
+        _state["preload_error"] = f"{type(e).__name__}: {e}"
+        print(f"Failed to preload projects: {_state['preload_error']}")
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # load in the background so /health answers while large projects load
+    threading.Thread(target=preload_projects, daemon=True).start()
+    yield
+
+
+app = FastAPI(title="gprMax chatbot", lifespan=lifespan)
+
+
+def answer_query(request, db_dirs):
+    embedding_function = get_embedding_function()
+    llm = get_llm(request.model)
+
+    # the generated file's content is the answer; nothing is left in the server's working directory
+    if "generate input file" in request.query.lower():
+        _, content = generate_input_file(request.query)
+        return content, []
+
+    if len(db_dirs) == 1:
+        retriever = get_retriever(db_dirs[0], embedding_function)
+        return cached_query_chatbot(request.query, retriever.db, retriever.docstore, llm, db_dirs[0], request.model)
+
+    return query_projects_chatbot(request.query, db_dirs, embedding_function, llm)
+
+
+@app.post("/query")
+async def query(request: QueryRequest):
+    db_dirs = check_request(request.query, request.projects, request.model)
+
+    # OpenAI calls block, so they run in worker threads and requests are served concurrently
+    answer, sources = await asyncio.to_thread(answer_query, request, db_dirs)
+
+    return {"answer" : answer, "sources" : sources}
+
+
+def stream_events(request, db_dirs):
+    '''
+    newline delimited JSON events for /query/stream. Runs in a worker thread (Starlette iterates synchronous
+    generators in its thread pool)
+    '''
+    embedding_function = get_embedding_function()
+    llm = get_llm(request.model)
+    metrics = {}
+    start = time.perf_counter()
+
+    if "generate input file" in request.query.lower():
+        _, content = generate_input_file(request.query)
+        tokens, sources = iter([content]), []
+        metrics["total_time"] = time.perf_counter() - start
+    elif len(db_dirs) == 1:
+        retriever = get_retriever(db_dirs[0], embedding_function)
+        tokens, sources = stream_query_chatbot(request.query, retriever.db, retriever.docstore, llm, metrics=metrics)
+    else:
+        source_docs = retrieve_across_projects(request.query, db_dirs, embedding_function)
+        tokens, sources = stream_answer(request.query, source_docs, llm, metrics=metrics, start=start)
+
+    yield json.dumps({"sources" : sources}) + "\n"
+    for token in tokens:
+        yield json.dumps({"token" : token}) + "\n"
+    yield json.dumps({"done" : True, "metrics" : metrics}) + "\n"
+
+
+@app.post("/query/stream")
+async def query_stream(request: QueryRequest):
+    db_dirs = check_request(request.query, request.projects, request.model)
+
+    return StreamingResponse(stream_events(request, db_dirs), media_type="application/x-ndjson")
+
+
+def build_prompt_text(request, db_dirs):
+    embedding_function = get_embedding_function()
+
+    if len(db_dirs) == 1:
+        retriever = get_retriever(db_dirs[0], embedding_function)
+        return get_prompt(request.query, retriever.db, retriever.docstore)
+
+    source_docs = retrieve_across_projects(request.query, db_dirs, embedding_function)
+    prompt, context_docs, _ = build_prompt(request.query, source_docs)
+    return prompt.text, [doc.metadata['source'] for doc in context_docs]
+
+
+@app.post("/prompt")
+async def prompt(request: PromptRequest):
+    db_dirs = check_request(request.query, request.projects)
+
+    prompt_text, sources = await asyncio.to_thread(build_prompt_text, request, db_dirs)
+
+    return {"prompt" : prompt_text, "sources" : sources}
+
+
+def generate_input_file(query):
+    return generate_gprmax_input_text(query)
+
+
+@app.post("/generate_input")
+async def generate_input(request: GenerateInputRequest):
+    file_path, content = await asyncio.to_thread(generate_input_file, request.query)
+
+    return {"file_name" : os.path.basename(file_path), "content" : content}
+
+
+@app.get("/health")
+async def health():
+    stats = retriever_stats()
+    return {
+        "status" : "ok",
+        "projects" : [project_name(project["db_dir"]) for project in stats["projects"]],
+        "retrievers" : stats,
+    }
+
+
+@app.get("/ready")
+async def ready():
+    body = {
+        "ready" : _state["ready"] and bool(os.environ.get("OPENAI_API_KEY")),
+        "preload_error" : _state["preload_error"],
+        "projects" : [project_name(project["db_dir"]) for project in retriever_stats()["projects"]],
+    }
+    return JSONResponse(body, status_code=200 if body["ready"] else 503)
+
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,257 @@
+'''
+Command line queries against a project in `dbs/`
+
+use command:
+
+python query.py {project_name} query {query}
+python query.py {project_name} prompt {query}
+python query.py {project_name} batch {questions.jsonl|questions.csv} {answers.jsonl} [--model gpt-4o-mini] [--max-workers 8] [--batch-size 32]
+
+batch retrieves context for `--batch-size` questions at a time, answers them `--max-workers` at a time, and
+appends each answer to the output JSONL file as soon as it is ready:
+
+    {"id" : ..., "question" : ..., "answer" : ..., "sources" : [...], "latency" : ...}
+
+Questions are read from a "question" (or "Question" / "query") field of each JSONL line or CSV row, with an
+optional "id" (default: the line number). Questions already answered in the output file are skipped, so an
+interrupted run resumes where it stopped. Questions that still fail after retries are written with an "error"
+field and asked again on the next run.
+'''
+
+import argparse
+import csv
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from utils.answer_cache_utils import answer_cacheable, cached_query_chatbot, get_answer_cache
+from utils.query_utils import answer_from_docs, copy_prompt, generate_gprmax_input_text, get_prompt, print_answer, retrieve_source_docs_batch, save_answer_and_sources
+from utils.ratelimit_utils import TokenBucketLimiter, call_with_backoff, estimate_tokens
+from utils.retriever_utils import get_embedding_function, get_llm, get_retriever
+
+
+QUESTION_FIELDS = ["question", "Question", "query"]
+
+# prompt (context) plus answer tokens of one chatbot call, counted against the tokens per minute budget
+ANSWER_TOKENS_ESTIMATE = 2000
+
+
+def load_questions(path):
+    '''
+    returns a list of (id, question) from a JSONL or CSV file
+    '''
+    if path.lower().endswith(".csv"):
+        with open(path, "r", encoding="utf-8", newline="") as f:
+            rows = list(csv.DictReader(f))
+    else:
+        with open(path, "r", encoding="utf-8") as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+
+    questions = []
+    for i, row in enumerate(rows):
+        question = next((row[field] for field in QUESTION_FIELDS if row.get(field)), None)
+        if question is None:
+            print(f"Skipping row {i}: no question field ({', '.join(QUESTION_FIELDS)})")
+            continue
+        # CSV files give blank id cells as ""; those rows fall back to their row number like rows without an id
+        question_id = row.get("id")
+        if question_id is None or not str(question_id).strip():
+            question_id = i
+        questions.append((str(question_id), question))
+
+    return questions
+
+
+def load_answered(output_path):
+    '''
+    ids of the questions already answered in `output_path`
+    '''
+    answered = set()
+    if not os.path.exists(output_path):
+        return answered
+
+    with open(output_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # the last line may be cut short if the run was killed mid-write
+                continue
+            if "answer" in record:
+                answered.add(record["id"])
+
+    return answered
+
+
+def answer_question_file(db_dir, input_path, output_path, model = "gpt-4o-mini", max_workers = 8,
+                         requests_per_minute = 500, tokens_per_minute = 200000, batch_size = 32):
+    '''
+    answers the questions in `input_path` with the project in `db_dir`, appending results to `output_path`
+
+    questions are embedded and retrieved `batch_size` at a time (one embedding call and one vector search per
+    batch), then answered by `max_workers` LLM calls at a time
+    '''
+    questions = load_questions(input_path)
+    answered = load_answered(output_path)
+    todo = [(question_id, question) for question_id, question in questions if question_id not in answered]
+
+    print(f"{len(questions)} questions, {len(questions) - len(todo)} already answered")
+
+    # the project is loaded once and shared by every worker
+    embedding_function = get_embedding_function()
+    llm = get_llm(model)
+    retriever = get_retriever(db_dir, embedding_function)
+    answer_cache = get_answer_cache()
+
+    limiter = TokenBucketLimiter(requests_per_minute, tokens_per_minute)
+    output_lock = threading.Lock()
+    counts = {"answered" : 0, "failed" : 0}
+
+    def write(record):
+        with output_lock, open(output_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record) + "\n")
+            counts["failed" if "error" in record else "answered"] += 1
+            done = counts["answered"] + counts["failed"]
+            if done % 50 == 0 or done == len(todo):
+                print(f"{done}/{len(todo)} questions ({counts['failed']} failed)")
+
+    def retrieve(batch):
+        '''
+        returns (question_id, question, query_vector, source_docs, cached answer) for each question of `batch`
+        '''
+        batch_questions = [question for _, question in batch]
+        query_vectors = call_with_backoff(embedding_function.embed_documents, batch_questions)
+
+        cached = [answer_cache.lookup(vector, db_dir, model) if answer_cacheable(question) else None for question, vector in zip(batch_questions, query_vectors)]
+        to_retrieve = [i for i, question in enumerate(batch_questions) if cached[i] is None and answer_cacheable(question)]
+
+        source_docs = [None] * len(batch)
+        retrieved = retrieve_source_docs_batch(
+            [batch_questions[i] for i in to_retrieve],
+            retriever.db,
+            retriever.docstore,
+            query_vectors=[query_vectors[i] for i in to_retrieve],
+        )
+        for i, docs in zip(to_retrieve, retrieved):
+            source_docs[i] = docs
+
+        return [(question_id, question, vector, docs, hit) for (question_id, question), vector, docs, hit in zip(batch, query_vectors, source_docs, cached)]
+
+    def answer(question_id, question, query_vector, source_docs, cached, start):
+        record = {"id" : question_id, "question" : question}
+        try:
+            if cached is not None:
+                chatbot_answer, sources = cached
+            else:
+                limiter.acquire_sync(estimate_tokens(question) + ANSWER_TOKENS_ESTIMATE)
+                if source_docs is None:
+                    # input file generation: the file's content is the answer, so workers never share a file
+                    _, chatbot_answer = generate_gprmax_input_text(question)
+                    sources = []
+                else:
+                    chatbot_answer, sources = call_with_backoff(answer_from_docs, question, source_docs, llm)
+                    answer_cache.store(query_vector, question, chatbot_answer, sources, db_dir, model)
+            record.update({"answer" : chatbot_answer, "sources" : sources})
+        except Exception as e:
+            record["error"] = f"{type(e).__name__}: {e}"
+        record["latency"] = time.perf_counter() - start
+
+        write(record)
+
+    def check(done):
+        '''
+        reports the questions whose `answer` raised, e.g. because the output file could not be written
+        '''
+        for future in done:
+            question_id = pending.pop(future)
+            if future.exception() is not None:
+                with output_lock:
+                    counts["failed"] += 1
+                print(f"Question {question_id} failed: {type(future.exception()).__name__}: {future.exception()}")
+
+    # only a few batches of questions are queued at a time, so huge input files do not pile up futures
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # future -> question_id
+        pending = {}
+        for i in range(0, len(todo), batch_size):
+            batch = todo[i:i + batch_size]
+            while len(pending) > max_workers:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                check(done)
+
+            start = time.perf_counter()
+            try:
+                retrieved = retrieve(batch)
+            except Exception as e:
+                for question_id, question in batch:
+                    write({"id" : question_id, "question" : question, "error" : f"{type(e).__name__}: {e}", "latency" : time.perf_counter() - start})
+                continue
+
+            for question_id, question, query_vector, source_docs, cached in retrieved:
+                pending[executor.submit(answer, question_id, question, query_vector, source_docs, cached, start)] = question_id
+        done, _ = wait(pending)
+        check(done)
+
+    print(f"Answered {counts['answered']} questions, {counts['failed']} failed. Results in {output_path}")
+
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query a gprMax chatbot project from the command line")
+    parser.add_argument("project_name", help="project directory under dbs/")
+    parser.add_argument("mode", choices=["query", "prompt", "batch"])
+    parser.add_argument("args", nargs="+", help="the query, or for batch the input and output files")
+    parser.add_argument("--model", default="gpt-4o-mini")
+    parser.add_argument("--max-workers", type=int, default=8, help="questions answered at once in batch mode")
+    parser.add_argument("--batch-size", type=int, default=32, help="questions embedded and retrieved together in batch mode")
+    parser.add_argument("--requests-per-minute", type=int, default=500)
+    parser.add_argument("--tokens-per-minute", type=int, default=200000)
+    args = parser.parse_args()
+
+    root_dir = f"dbs/{args.project_name}"
+    db_dir = f"{root_dir}/db"
+
+    if not os.path.exists(db_dir):
+        print(f"Database does not exist, or is in the incorrect location. Make sure that the database exists and has path `{db_dir}`")
+        sys.exit(1)
+
+    if args.mode == "batch":
+        if len(args.args) != 2:
+            parser.error("batch needs an input file and an output file")
+        answer_question_file(
+            db_dir,
+            args.args[0],
+            args.args[1],
+            model=args.model,
+            max_workers=args.max_workers,
+            requests_per_minute=args.requests_per_minute,
+            tokens_per_minute=args.tokens_per_minute,
+            batch_size=args.batch_size,
+        )
+        return
+
+    query = " ".join(args.args)
+    retriever = get_retriever(db_dir, get_embedding_function())
+
+    if args.mode == "prompt":
+        metrics = {}
+        prompt, sources = get_prompt(query, retriever.db, retriever.docstore, metrics=metrics)
+        print(prompt)
+        print(f"Context: {metrics['context_tokens']} tokens ({metrics['saved_tokens']} saved)")
+        copy_prompt(prompt, sources)
+        return
+
+    answer, sources = cached_query_chatbot(query, retriever.db, retriever.docstore, get_llm(args.model), db_dir, args.model)
+
+    answer_path = f"{root_dir}/answers/{str(uuid.uuid4())}.md"
+    os.makedirs(f"{root_dir}/answers", exist_ok=True)
+    save_answer_and_sources(answer_path, query, answer, sources)
+    print_answer(answer, sources, answer_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+'''
+Semantic cache of chatbot answers
+
+Near-duplicate questions ("how do I install gprMax", "install gprmax on windows") are answered from the cache
+when the cosine similarity between their query embeddings is above a threshold, skipping retrieval and the LLM
+call. Entries are kept per (project, model), expire after `ttl` seconds, are evicted least recently used first,
+and are dropped whenever the project's database changes on disk.
+
+The threshold depends on the embedding model. text-embedding-ada-002 similarities are bunched between ~0.7 and
+1.0, so different questions about the same topic often score above 0.95; the default of 0.98 only matches
+rephrasings. Set GPRMAX_CHATBOT_ANSWER_CACHE_THRESHOLD (or pass `threshold`) when using another model.
+'''
+
+import os
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+from utils.query_utils import query_chatbot
+
+
+DEFAULT_THRESHOLD = float(os.environ.get("GPRMAX_CHATBOT_ANSWER_CACHE_THRESHOLD", 0.98))
+
+
+def db_version(db_dir):
+    '''
+    changes whenever the database in `db_dir` is rebuilt or updated (both rewrite the chunk index and manifest)
+    '''
+    version = []
+    for file_name in ["chunks.idx", "manifest.json"]:
+        try:
+            version.append(os.stat(f"{db_dir}/{file_name}").st_mtime_ns)
+        except FileNotFoundError:
+            version.append(None)
+    return tuple(version)
+
+
+def answer_cacheable(query):
+    '''
+    input file generation writes a new file every time, so its "answer" (a file path) is never cached
+    '''
+    return "generate input file" not in query.lower()
+
+
+class SemanticAnswerCache:
+
+    def __init__(self, threshold = DEFAULT_THRESHOLD, ttl = 24 * 3600, max_entries = 1000):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        # (db_dir, model) -> {"version" : ..., "entries" : OrderedDict, "matrix" : ..., "keys" : ...}
+        self._namespaces = {}
+        self._next_key = 0
+
+    def _namespace(self, db_dir, model):
+        name = (os.path.abspath(db_dir), model)
+        version = db_version(db_dir)
+
+        namespace = self._namespaces.get(name)
+        if namespace is None or namespace["version"] != version:
+            # new project, or its database changed since these answers were cached
+            namespace = {"version" : version, "entries" : OrderedDict(), "matrix" : None, "keys" : []}
+            self._namespaces[name] = namespace
+
+        return namespace
+
+    def _size(self):
+        return sum(len(namespace["entries"]) for namespace in self._namespaces.values())
+
+    def _expire(self, namespace):
+        now = time.time()
+        expired = [key for key, entry in namespace["entries"].items() if now - entry["created"] > self.ttl]
+        for key in expired:
+            del namespace["entries"][key]
+        if expired:
+            namespace["matrix"] = None
+
+    def lookup(self, query_vector, db_dir, model):
+        '''
+        returns (answer, sources) of the most similar cached question above the threshold, or None
+        '''
+        # a copy, so the caller's vector is not normalized in place
+        query_vector = np.array(query_vector, dtype=np.float32)
+        query_vector /= np.linalg.norm(query_vector) or 1.0
+
+        with self._lock:
+            namespace = self._namespace(db_dir, model)
+            self._expire(namespace)
+
+            if namespace["entries"]:
+                if namespace["matrix"] is None:
+                    namespace["keys"] = list(namespace["entries"])
+                    namespace["matrix"] = np.stack([namespace["entries"][key]["vector"] for key in namespace["keys"]])
+
+                similarities = namespace["matrix"] @ query_vector
+                best = int(np.argmax(similarities))
+
+                if similarities[best] >= self.threshold:
+                    key = namespace["keys"][best]
+                    namespace["entries"].move_to_end(key)
+                    entry = namespace["entries"][key]
+                    entry["last_used"] = time.time()
+                    self.hits += 1
+                    return entry["answer"], list(entry["sources"])
+
+            self.misses += 1
+            return None
+
+    def store(self, query_vector, query, answer, sources, db_dir, model):
+        # a copy, so the caller's vector is not normalized in place
+        query_vector = np.array(query_vector, dtype=np.float32)
+        query_vector /= np.linalg.norm(query_vector) or 1.0
+
+        with self._lock:
+            namespace = self._namespace(db_dir, model)
+            namespace["entries"][self._next_key] = {
+                "vector" : query_vector,
+                "query" : query,
+                "answer" : answer,
+                "sources" : list(sources),
+                "created" : time.time(),
+                "last_used" : time.time(),
+            }
+            namespace["matrix"] = None
+            self._next_key += 1
+
+            while self._size() > self.max_entries:
+                self._evict_one()
+
+    def _evict_one(self):
+        # least recently used entry across all namespaces (each namespace keeps its entries in LRU order)
+        oldest = None
+        for namespace in self._namespaces.values():
+            if namespace["entries"]:
+                key, entry = next(iter(namespace["entries"].items()))
+                if oldest is None or entry["last_used"] < oldest[2]:
+                    oldest = (namespace, key, entry["last_used"])
+
+        namespace, key, _ = oldest
+        del namespace["entries"][key]
+        namespace["matrix"] = None
+        self.evictions += 1
+
+    def invalidate(self, db_dir = None):
+        '''
+        drops cached answers for `db_dir` (or every project)
+        '''
+        with self._lock:
+            for name in list(self._namespaces):
+                if db_dir is None or name[0] == os.path.abspath(db_dir):
+                    del self._namespaces[name]
+
+    def stats(self):
+        total = self.hits + self.misses
+        with self._lock:
+            entries = self._size()
+        return {
+            "hits" : self.hits,
+            "misses" : self.misses,
+            "hit_rate" : self.hits / total if total else 0.0,
+            "evictions" : self.evictions,
+            "entries" : entries,
+        }
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_answer_cache():
+    '''
+    returns the process-wide answer cache
+    '''
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = SemanticAnswerCache()
+        return _default_cache
+
+
+def cached_query_chatbot(query, db, docstore, llm, db_dir, model, cache = None):
+    '''
+    `query_chatbot`, answered from the semantic cache when a similar enough question was asked before
+    '''
+    if cache is None:
+        cache = get_answer_cache()
+
+    if not answer_cacheable(query):
+        return query_chatbot(query, db, docstore, llm)
+
+    query_vector = db.embeddings.embed_query(query)
+    cached = cache.lookup(query_vector, db_dir, model)
+    if cached is not None:
+        return cached
+
+    answer, sources = query_chatbot(query, db, docstore, llm)
+    cache.store(query_vector, query, answer, sources, db_dir, model)
+
+    return answer, sources
@@ -0,0 +1,437 @@
+'''
+Retrieval-only benchmark: recall@k, MRR and latency percentiles of `db.similarity_search`
+
+Uses qa pairs labelled with the chunk each question was generated from (see `generate_labelled_qa_pairs`).
+By default the benchmark runs fully offline: the project's summaries are embedded with the deterministic
+`HashingEmbeddings` into a temporary in-memory Chroma collection, so no OpenAI calls are made and results are
+comparable from run to run. Reports are JSON, and `compare_reports` flags regressions against a baseline.
+
+usage:
+
+python -m utils.benchmark_utils generate {db_dir} {qa_path} [--n N]
+python -m utils.benchmark_utils run {db_dir} {qa_path} [--online] [--hybrid] [--two-level] [--rerank] [--index chroma|numpy] [--out report.json] [--baseline old_report.json]
+python -m utils.benchmark_utils index {db_dir} {qa_path} [--online]
+python -m utils.benchmark_utils compression {db_dir} {qa_path} [--online] [--pq-subvectors 64]
+
+`index` runs the same questions against Chroma and the NumPy vector index (see utils/vector_index_utils.py) and
+reports both, with the share of questions whose top k results are identical. `compression` compares the NumPy
+index stored as float32, int8 and pq (with and without full precision rerank): the memory searched per query
+against the recall lost.
+'''
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import uuid
+import numpy as np
+from langchain_chroma import Chroma
+from langchain_core.documents import Document
+from utils.bm25_utils import build_bm25_index, load_bm25_index, reciprocal_rank_fusion
+from utils.chunkstore_utils import ChunkStore
+from utils.embedding_utils import HashingEmbeddings
+from utils.multivector_utils import MultiVectorStore, chunk_level_enabled, open_chunk_db
+from utils.generate_qna_utils import generate_labelled_qa_pairs, load_labelled_qa_pairs, save_labelled_qa_pairs
+from utils.quantization_utils import DEFAULT_PQ_SUBVECTORS
+from utils.rerank_utils import RERANK_CANDIDATES, get_reranker
+from utils.vector_index_utils import NumpyVectorStore, build_vector_store, chroma_vectors, vector_index_fresh
+
+
+DEFAULT_K_VALUES = (1, 4, 10)
+
+
+def build_offline_db(document_data, embedding_function = None, level = "summary"):
+    '''
+    embeds the summaries (or with `level` "chunk", the raw page_content) of `document_data` into a new in-memory
+    Chroma collection, as `create_db` would
+    '''
+    if embedding_function is None:
+        embedding_function = HashingEmbeddings()
+
+    if level == "chunk":
+        texts = [doc['page_content'] for doc in document_data]
+    else:
+        texts = [doc['summary'] or doc['page_content'] for doc in document_data]
+    docs = [Document(page_content = text, metadata = {'doc_id' : doc['doc_id']}) for text, doc in zip(texts, document_data)]
+
+    return Chroma.from_documents(
+        docs,
+        embedding_function,
+        ids=[doc['doc_id'] for doc in document_data],
+        collection_name=f"benchmark-{uuid.uuid4().hex[:8]}"
+    )
+
+
+def latency_percentiles(latencies):
+    latencies = np.asarray(latencies) * 1000
+    return {
+        "mean_ms" : float(latencies.mean()),
+        "p50_ms" : float(np.percentile(latencies, 50)),
+        "p95_ms" : float(np.percentile(latencies, 95)),
+        "p99_ms" : float(np.percentile(latencies, 99)),
+    }
+
+
+def benchmark_retrieval(search, labelled_qa_pairs, k_values = DEFAULT_K_VALUES):
+    '''
+    search: function (query, k) -> list of doc_ids, best first
+    labelled_qa_pairs: qa pairs with the "doc_id" of the chunk they were generated from
+
+    returns a report with recall@k for each k, MRR (within the largest k) and search latency percentiles
+    '''
+    max_k = max(k_values)
+    ranks = []
+    latencies = []
+
+    for qa in labelled_qa_pairs:
+        start = time.perf_counter()
+        doc_ids = search(qa['Question'], max_k)
+        latencies.append(time.perf_counter() - start)
+
+        ranks.append(doc_ids.index(qa['doc_id']) + 1 if qa['doc_id'] in doc_ids else None)
+
+    n = len(ranks)
+    report = {
+        "n" : n,
+        "recall" : {str(k) : sum(r is not None and r <= k for r in ranks) / n for k in k_values},
+        "mrr" : sum(1 / r for r in ranks if r is not None) / n,
+        "latency" : latency_percentiles(latencies),
+    }
+
+    return report
+
+
+def chroma_search(db):
+    def search(query, k):
+        return [doc.metadata['doc_id'] for doc in db.similarity_search(query, k=k)]
+    return search
+
+
+def hybrid_search(db, lexical_index):
+    '''
+    vector search fused with BM25 by reciprocal rank fusion, as `retrieve_source_docs` does
+    '''
+    def search(query, k):
+        vector_ids = [doc.metadata['doc_id'] for doc in db.similarity_search(query, k=k)]
+        lexical_ids = [doc_id for doc_id, _ in lexical_index.search(query, k)]
+        return reciprocal_rank_fusion([vector_ids, lexical_ids])[:k]
+    return search
+
+
+def rerank_search(search, texts):
+    '''
+    re-ranks the RERANK_CANDIDATES best results of `search` with the cross-encoder, as `retrieve_source_docs`
+    does with `rerank`
+
+    texts: {doc_id : page_content}
+    '''
+    reranker = get_reranker()
+
+    def rerank(query, k):
+        candidates = search(query, max(k, RERANK_CANDIDATES))
+        docs = [Document(page_content = texts[doc_id], metadata = {'doc_id' : doc_id}) for doc_id in candidates]
+        return [doc.metadata['doc_id'] for doc in reranker.rerank(query, docs, k)]
+    return rerank
+
+
+def numpy_store(db, db_dir = None):
+    '''
+    the NumPy vector index of `db`: the project's exported one if `db_dir` has an up to date export, otherwise
+    built in memory from the Chroma `db`
+    '''
+    if db_dir is not None and vector_index_fresh(db_dir):
+        return NumpyVectorStore.load(db_dir, db.embeddings)
+
+    doc_ids, vectors, metric = chroma_vectors(db)
+    return NumpyVectorStore(doc_ids, vectors, metric, db.embeddings)
+
+
+def load_benchmark_db(db_dir, online = False, hybrid = False, two_level = False):
+    '''
+    returns (Chroma db, BM25 index or None) to benchmark the project in `db_dir` with. With `two_level` the
+    db is a `MultiVectorStore` of the summary and raw chunk vectors
+    '''
+    if online:
+        from utils.retriever_utils import get_embedding_function
+        db = Chroma(persist_directory=f"{db_dir}/chroma_db", embedding_function=get_embedding_function())
+        lexical_index = load_bm25_index(db_dir, save = False) if hybrid else None
+        if two_level:
+            if not chunk_level_enabled(db_dir):
+                raise ValueError(f"{db_dir} has no chunk level, run `python -m utils.multivector_utils enable {db_dir}`")
+            db = MultiVectorStore([db, open_chunk_db(db_dir, db.embeddings)])
+    else:
+        docstore = ChunkStore(db_dir)
+        document_data = docstore.document_data()
+        docstore.close()
+        db = build_offline_db(document_data)
+        lexical_index = build_bm25_index(document_data) if hybrid else None
+        if two_level:
+            db = MultiVectorStore([db, build_offline_db(document_data, db.embeddings, level = "chunk")])
+
+    return db, lexical_index
+
+
+def run_benchmark(db_dir, qa_path, online = False, hybrid = False, index = "chroma", two_level = False, rerank = False,
+                  k_values = DEFAULT_K_VALUES):
+    '''
+    benchmarks retrieval of the project in `db_dir` on the labelled qa pairs in `qa_path`
+
+    online: search the project's own Chroma store with OpenAI embeddings, instead of the offline stand-in
+    hybrid: fuse the vector results with the project's BM25 index
+    index: "chroma", or "numpy" to search the same vectors with the NumPy vector index
+    two_level: also search the raw chunk vectors and fuse the rankings (see `utils/multivector_utils.py`)
+    rerank: re-rank a wider candidate set with the cross-encoder (see `utils/rerank_utils.py`)
+    '''
+    labelled_qa_pairs = load_labelled_qa_pairs(qa_path)
+
+    db, lexical_index = load_benchmark_db(db_dir, online = online, hybrid = hybrid, two_level = two_level)
+    if index == "numpy":
+        if two_level:
+            db = MultiVectorStore([numpy_store(db.levels[0], db_dir if online else None), numpy_store(db.levels[1])])
+        else:
+            db = numpy_store(db, db_dir if online else None)
+
+    search = hybrid_search(db, lexical_index) if hybrid else chroma_search(db)
+    if rerank:
+        docstore = ChunkStore(db_dir)
+        texts = {doc_id : docstore[doc_id].page_content for doc_id in docstore.keys()}
+        docstore.close()
+
+        search = rerank_search(search, texts)
+        # load the model before the timed questions
+        search(labelled_qa_pairs[0]['Question'], 1)
+
+    report = benchmark_retrieval(search, labelled_qa_pairs, k_values)
+    report["project"] = db_dir
+    report["embeddings"] = "openai" if online else HashingEmbeddings().model
+    report["retrieval"] = "hybrid" if hybrid else "vector"
+    report["index"] = index
+    report["levels"] = ["summary", "chunk"] if two_level else ["summary"]
+    report["rerank"] = rerank
+    report["created"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+
+    return report
+
+
+def compare_indexes(db_dir, qa_path, online = False, k_values = DEFAULT_K_VALUES):
+    '''
+    benchmarks Chroma and the NumPy vector index on the same vectors and questions
+
+    returns {"chroma" : report, "numpy" : report, "agreement" : {k : share of questions with identical top k}}.
+    Online, the reports also have the time to open each index ("open_ms")
+    '''
+    labelled_qa_pairs = load_labelled_qa_pairs(qa_path)
+
+    db, _ = load_benchmark_db(db_dir, online = online)
+    open_times = {}
+    if online:
+        start = time.perf_counter()
+        db = Chroma(persist_directory=f"{db_dir}/chroma_db", embedding_function=db.embeddings)
+        db._collection.count()
+        open_times["chroma"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    store = numpy_store(db, db_dir if online else None)
+    open_times["numpy"] = time.perf_counter() - start
+
+    reports = {}
+    for index, searched_db in [("chroma", db), ("numpy", store)]:
+        # warm up, so the first query does not pay for lazy initialization
+        searched_db.similarity_search(labelled_qa_pairs[0]['Question'], k=1)
+        reports[index] = benchmark_retrieval(chroma_search(searched_db), labelled_qa_pairs, k_values)
+        reports[index]["index"] = index
+        if online:
+            reports[index]["open_ms"] = open_times[index] * 1000
+
+    max_k = max(k_values)
+    chroma_results = [chroma_search(db)(qa['Question'], max_k) for qa in labelled_qa_pairs]
+    numpy_results = [chroma_search(store)(qa['Question'], max_k) for qa in labelled_qa_pairs]
+    agreement = {
+        str(k) : sum(a[:k] == b[:k] for a, b in zip(chroma_results, numpy_results)) / len(labelled_qa_pairs)
+        for k in k_values
+    }
+
+    return {
+        "project" : db_dir,
+        "embeddings" : "openai" if online else HashingEmbeddings().model,
+        "chunks" : len(store),
+        "chroma" : reports["chroma"],
+        "numpy" : reports["numpy"],
+        "agreement" : agreement,
+        "created" : time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def compare_compression(db_dir, qa_path, online = False, k_values = DEFAULT_K_VALUES, pq_subvectors = DEFAULT_PQ_SUBVECTORS):
+    '''
+    benchmarks the NumPy vector index of the project in `db_dir` with each compression, on the same questions
+
+    returns {"project", "chunks", "reports"}, with a report per compression holding the memory searched per
+    query ("memory_bytes"), its ratio to float32 and the recall lost against float32
+    '''
+    labelled_qa_pairs = load_labelled_qa_pairs(qa_path)
+
+    db, _ = load_benchmark_db(db_dir, online = online)
+    doc_ids, vectors, metric = chroma_vectors(db)
+
+    reports = {}
+    for compression, rerank in [("float32", False), ("int8", False), ("int8", True), ("pq", False), ("pq", True)]:
+        store = build_vector_store(doc_ids, vectors, metric, db.embeddings, compression = compression, rerank = rerank, pq_subvectors = pq_subvectors)
+
+        report = benchmark_retrieval(chroma_search(store), labelled_qa_pairs, k_values)
+        report["memory_bytes"] = store.nbytes
+        name = f"{compression}+rerank" if rerank else compression
+        reports[name] = report
+
+    for report in reports.values():
+        report["memory_ratio"] = report["memory_bytes"] / reports["float32"]["memory_bytes"]
+        report["recall_lost"] = {k : reports["float32"]["recall"][k] - recall for k, recall in report["recall"].items()}
+
+    return {
+        "project" : db_dir,
+        "embeddings" : "openai" if online else HashingEmbeddings().model,
+        "chunks" : len(doc_ids),
+        "n" : len(labelled_qa_pairs),
+        "reports" : reports,
+        "created" : time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def print_compression_comparison(comparison):
+    print(f"{comparison['project']} ({comparison['chunks']} chunks, {comparison['n']} questions, {comparison['embeddings']} embeddings)")
+    for name, report in comparison["reports"].items():
+        recall = ", ".join(f"@{k} {value:.3f} (-{report['recall_lost'][k]:.3f})" if report['recall_lost'][k] > 0 else f"@{k} {value:.3f}" for k, value in report["recall"].items())
+        print(f"  {name:<14} {report['memory_bytes'] / 1024:>10.1f}KB ({report['memory_ratio']:.3f}x)  recall {recall}  p50 {report['latency']['p50_ms']:.2f}ms")
+
+
+def compare_reports(baseline, current, tolerance = 0.02, latency_tolerance = 0.25):
+    '''
+    returns a list of human readable regressions of `current` against `baseline`: recall or MRR lower by more
+    than `tolerance`, or p95 latency higher by more than `latency_tolerance` (relative)
+    '''
+    regressions = []
+
+    for k, recall in baseline["recall"].items():
+        if k in current["recall"] and current["recall"][k] < recall - tolerance:
+            regressions.append(f"recall@{k}: {recall:.3f} -> {current['recall'][k]:.3f}")
+
+    if current["mrr"] < baseline["mrr"] - tolerance:
+        regressions.append(f"mrr: {baseline['mrr']:.3f} -> {current['mrr']:.3f}")
+
+    if current["latency"]["p95_ms"] > baseline["latency"]["p95_ms"] * (1 + latency_tolerance):
+        regressions.append(f"p95 latency: {baseline['latency']['p95_ms']:.1f}ms -> {current['latency']['p95_ms']:.1f}ms")
+
+    return regressions
+
+
+def print_report(report):
+    print(f"{report['project']} ({report['n']} questions, {report['embeddings']} embeddings, {report.get('retrieval', 'vector')} retrieval, {report.get('index', 'chroma')} index, {' + '.join(report.get('levels', ['summary']))} vectors{', re-ranked' if report.get('rerank') else ''})")
+    for k, recall in report["recall"].items():
+        print(f"  recall@{k}: {recall:.3f}")
+    print(f"  mrr: {report['mrr']:.3f}")
+    latency = report["latency"]
+    print(f"  latency: p50 {latency['p50_ms']:.1f}ms, p95 {latency['p95_ms']:.1f}ms, p99 {latency['p99_ms']:.1f}ms")
+    if "open_ms" in report:
+        print(f"  open: {report['open_ms']:.1f}ms")
+
+
+def print_index_comparison(comparison):
+    for index in ["chroma", "numpy"]:
+        comparison[index]["project"] = comparison["project"]
+        comparison[index]["embeddings"] = comparison["embeddings"]
+        print_report(comparison[index])
+
+    agreement = ", ".join(f"top {k} {share:.3f}" for k, share in comparison["agreement"].items())
+    speedup = comparison["chroma"]["latency"]["p50_ms"] / max(comparison["numpy"]["latency"]["p50_ms"], 1e-9)
+    print(f"{comparison['chunks']} chunks, identical results: {agreement}, p50 speedup {speedup:.1f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Retrieval benchmark")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    generate_parser = subparsers.add_parser("generate", help="generate labelled qa pairs from a project's chunks (uses the OpenAI API)")
+    generate_parser.add_argument("db_dir")
+    generate_parser.add_argument("qa_path")
+    generate_parser.add_argument("--n", type=int, default=100, help="number of chunks to generate questions from")
+    generate_parser.add_argument("--seed", type=int, default=0)
+
+    run_parser = subparsers.add_parser("run", help="run the benchmark")
+    run_parser.add_argument("db_dir")
+    run_parser.add_argument("qa_path")
+    run_parser.add_argument("--online", action="store_true", help="use the project's Chroma store and OpenAI embeddings")
+    run_parser.add_argument("--hybrid", action="store_true", help="fuse vector search with the BM25 index")
+    run_parser.add_argument("--index", choices=["chroma", "numpy"], default="chroma", help="vector index to search")
+    run_parser.add_argument("--two-level", action="store_true", help="also search the raw chunk vectors")
+    run_parser.add_argument("--rerank", action="store_true", help="re-rank a wider candidate set with the local cross-encoder")
+    run_parser.add_argument("--k", type=int, nargs="+", default=list(DEFAULT_K_VALUES))
+    run_parser.add_argument("--out", help="write the JSON report here")
+    run_parser.add_argument("--baseline", help="JSON report to compare against; exits with status 1 on regression")
+
+    index_parser = subparsers.add_parser("index", help="compare Chroma and the NumPy vector index")
+    index_parser.add_argument("db_dir")
+    index_parser.add_argument("qa_path")
+    index_parser.add_argument("--online", action="store_true", help="use the project's Chroma store and OpenAI embeddings")
+    index_parser.add_argument("--k", type=int, nargs="+", default=list(DEFAULT_K_VALUES))
+    index_parser.add_argument("--out", help="write the JSON report here")
+
+    compression_parser = subparsers.add_parser("compression", help="compare the memory and recall of the vector index compressions")
+    compression_parser.add_argument("db_dir")
+    compression_parser.add_argument("qa_path")
+    compression_parser.add_argument("--online", action="store_true", help="use the project's Chroma store and OpenAI embeddings")
+    compression_parser.add_argument("--pq-subvectors", type=int, default=DEFAULT_PQ_SUBVECTORS)
+    compression_parser.add_argument("--k", type=int, nargs="+", default=list(DEFAULT_K_VALUES))
+    compression_parser.add_argument("--out", help="write the JSON report here")
+
+    args = parser.parse_args()
+
+    if args.command == "generate":
+        from utils.retriever_utils import get_llm
+
+        docstore = ChunkStore(args.db_dir)
+        document_data = docstore.document_data()
+        document_data = random.Random(args.seed).sample(document_data, min(args.n, len(document_data)))
+
+        labelled_qa_pairs = generate_labelled_qa_pairs(document_data, get_llm("gpt-4o-mini"))
+        save_labelled_qa_pairs(labelled_qa_pairs, args.qa_path)
+        print(f"Saved {len(labelled_qa_pairs)} labelled qa pairs to {args.qa_path}")
+        return
+
+    if args.command == "index":
+        comparison = compare_indexes(args.db_dir, args.qa_path, online=args.online, k_values=args.k)
+        print_index_comparison(comparison)
+        if args.out:
+            with open(args.out, "w", encoding="utf-8") as f:
+                json.dump(comparison, f, indent=1)
+        return
+
+    if args.command == "compression":
+        comparison = compare_compression(args.db_dir, args.qa_path, online=args.online, k_values=args.k, pq_subvectors=args.pq_subvectors)
+        print_compression_comparison(comparison)
+        if args.out:
+            with open(args.out, "w", encoding="utf-8") as f:
+                json.dump(comparison, f, indent=1)
+        return
+
+    report = run_benchmark(args.db_dir, args.qa_path, online=args.online, hybrid=args.hybrid, index=args.index, two_level=args.two_level, rerank=args.rerank, k_values=args.k)
+    print_report(report)
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=1)
+
+    if args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+
+        regressions = compare_reports(baseline, report)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+'''
+Local BM25 index over the raw chunks of a project, for hybrid (lexical + vector) retrieval
+
+Summaries embed the meaning of a chunk well but lose exact tokens: gprMax commands such as `#waveform` or
+`#rx`, and error messages pasted from tracebacks. The BM25 index is built over the raw page_content, kept in
+`bm25.json` next to the chunk store, and updated incrementally when chunks are added or removed. Its ranking
+is merged with the vector search ranking by reciprocal rank fusion.
+
+`bm25.json` records the size of `chunks.idx` it was built against; if the chunk store changed without the index
+(e.g. a database built before this file existed) the index is rebuilt from the chunk store on load.
+'''
+
+import heapq
+import json
+import math
+import os
+import re
+from utils.chunkstore_utils import INDEX_FILE, ChunkStore
+
+
+BM25_FILE = "bm25.json"
+BM25_VERSION = 1
+
+STOPWORDS = frozenset([
+    "a", "an", "and", "are", "as", "at", "be", "by", "can", "do", "does", "for", "from", "how", "i", "if", "in",
+    "is", "it", "of", "on", "or", "that", "the", "this", "to", "what", "when", "where", "which", "with", "you",
+])
+
+_TOKEN_PATTERN = re.compile(r"#?\w+")
+
+
+def tokenize(text):
+    '''
+    lowercased words. gprMax commands are kept with their `#` and also indexed as the bare word, so both
+    "#waveform" and "waveform" match them
+    '''
+    tokens = []
+    for token in _TOKEN_PATTERN.findall(text.lower()):
+        if token.startswith("#"):
+            tokens.append(token)
+            token = token[1:]
+        if token and token not in STOPWORDS:
+            tokens.append(token)
+    return tokens
+
+
+class BM25Index:
+
+    def __init__(self, k1 = 1.5, b = 0.75):
+        self.k1 = k1
+        self.b = b
+        # term -> {doc_id : term frequency}
+        self.postings = {}
+        # doc_id -> number of tokens
+        self.lengths = {}
+        self._total_length = 0
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def add(self, doc_id, text):
+        if doc_id in self.lengths:
+            self.remove([doc_id])
+
+        tokens = tokenize(text)
+        counts = {}
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+
+        for term, tf in counts.items():
+            self.postings.setdefault(term, {})[doc_id] = tf
+
+        self.lengths[doc_id] = len(tokens)
+        self._total_length += len(tokens)
+
+    def add_document_data(self, document_data):
+        for doc in document_data:
+            self.add(doc['doc_id'], doc['page_content'])
+
+    def remove(self, doc_ids):
+        doc_ids = set(doc_id for doc_id in doc_ids if doc_id in self.lengths)
+        if not doc_ids:
+            return
+
+        for term in list(self.postings):
+            posting = self.postings[term]
+            for doc_id in doc_ids.intersection(posting):
+                del posting[doc_id]
+            if not posting:
+                del self.postings[term]
+
+        for doc_id in doc_ids:
+            self._total_length -= self.lengths.pop(doc_id)
+
+    def search(self, query, k = 4):
+        '''
+        returns the `k` best (doc_id, score) pairs for `query`, best first
+        '''
+        if not self.lengths:
+            return []
+
+        n = len(self.lengths)
+        average_length = self._total_length / n or 1.0
+        scores = {}
+
+        for term in set(tokenize(query)):
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+
+            idf = math.log(1 + (n - len(posting) + 0.5) / (len(posting) + 0.5))
+            for doc_id, tf in posting.items():
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[doc_id] / average_length)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+
+        return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+
+    def to_json(self):
+        # doc_ids are stored once and referred to by position in the postings
+        doc_ids = list(self.lengths)
+        positions = {doc_id : i for i, doc_id in enumerate(doc_ids)}
+        return {
+            "version" : BM25_VERSION,
+            "k1" : self.k1,
+            "b" : self.b,
+            "doc_ids" : doc_ids,
+            "lengths" : [self.lengths[doc_id] for doc_id in doc_ids],
+            "postings" : {term : [[positions[doc_id], tf] for doc_id, tf in posting.items()] for term, posting in self.postings.items()},
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        index = cls(k1 = data["k1"], b = data["b"])
+        doc_ids = data["doc_ids"]
+        index.lengths = dict(zip(doc_ids, data["lengths"]))
+        index._total_length = sum(data["lengths"])
+        index.postings = {term : {doc_ids[i] : tf for i, tf in posting} for term, posting in data["postings"].items()}
+        return index
+
+
+def _chunk_index_size(db_dir):
+    try:
+        return os.path.getsize(f"{db_dir}/{INDEX_FILE}")
+    except FileNotFoundError:
+        return None
+
+
+def save_bm25_index(index, db_dir):
+    data = index.to_json()
+    data["chunks_idx_size"] = _chunk_index_size(db_dir)
+
+    with open(f"{db_dir}/{BM25_FILE}.tmp", "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(f"{db_dir}/{BM25_FILE}.tmp", f"{db_dir}/{BM25_FILE}")
+
+
+def build_bm25_index(document_data):
+    index = BM25Index()
+    index.add_document_data(document_data)
+    return index
+
+
+def write_bm25_index(document_data, db_dir):
+    '''
+    builds the BM25 index of `document_data` and saves it in `db_dir`
+    '''
+    index = build_bm25_index(document_data)
+    save_bm25_index(index, db_dir)
+    return index
+
+
+def load_bm25_index(db_dir, docstore = None, save = True):
+    '''
+    loads the BM25 index of `db_dir`, (re)building it from the chunk store if it is missing or out of date
+
+    docstore: the project's already open `ChunkStore`, if any
+    save: whether a rebuilt index is written back to `db_dir`. the query path passes False, so it never writes
+    to (possibly read-only) project directories or changes their `db_stamp`
+    '''
+    if os.path.exists(f"{db_dir}/{BM25_FILE}"):
+        with open(f"{db_dir}/{BM25_FILE}", "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("version") == BM25_VERSION and data.get("chunks_idx_size") == _chunk_index_size(db_dir):
+            return BM25Index.from_json(data)
+
+    store = docstore if docstore is not None else ChunkStore(db_dir)
+    index = BM25Index()
+    for doc_id in store.keys():
+        index.add(doc_id, store[doc_id].page_content)
+    if docstore is None:
+        store.close()
+
+    print(f"Built BM25 index of {len(index)} chunks in {db_dir}")
+    if save:
+        save_bm25_index(index, db_dir)
+
+    return index
+
+
+def reciprocal_rank_fusion(rankings, k = 60):
+    '''
+    merges several rankings (lists of doc_ids, best first) into one, scoring each doc_id by the sum of
+    1 / (k + rank) over the rankings it appears in
+    '''
+    scores = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, start=1):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1 / (k + rank)
+
+    return sorted(scores, key=lambda doc_id: scores[doc_id], reverse=True)
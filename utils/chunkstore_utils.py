@@ -0,0 +1,305 @@
+'''
+On-disk chunk store, replacing the pickled `docstore.pkl` and `document_data.pkl`
+
+A project's chunks are kept in two files in the db directory:
+
+    chunks.bin  - every chunk's page_content followed by its summary, UTF-8 encoded, back to back
+    chunks.idx  - one JSON list per line: [doc_id, offset, content_length, summary_length, source]
+
+`chunks.bin` is opened with mmap and only the chunks that are asked for are decoded, so opening a project costs
+one read of the (small) index. New chunks are appended to both files; a line holding only `[doc_id]` marks that
+chunk as removed. Later lines for the same doc_id override earlier ones.
+
+A rewritten store gets a blob of its own, `chunks.{version}.bin`, named by a first line {"blob" : ...} of the
+new index. Swapping the index alone then switches readers to the new chunks in one step. Indexes without that
+line use `chunks.bin`.
+'''
+
+import json
+import mmap
+import os
+import pickle
+import sys
+import threading
+import uuid
+from langchain_core.documents import Document
+
+
+BLOB_FILE = "chunks.bin"
+INDEX_FILE = "chunks.idx"
+MIGRATION_LOCK_FILE = "migrate.lock"
+
+
+def blob_file(db_dir):
+    '''
+    the name of the blob the index of `db_dir` refers to
+    '''
+    with open(f"{db_dir}/{INDEX_FILE}", "r", encoding="utf-8") as f:
+        entry = json.loads(f.readline() or "[]")
+    return entry["blob"] if isinstance(entry, dict) else BLOB_FILE
+
+
+def chunk_store_exists(db_dir):
+    return os.path.exists(f"{db_dir}/{INDEX_FILE}") and os.path.exists(f"{db_dir}/{blob_file(db_dir)}")
+
+
+class ChunkStore:
+    '''
+    Read-only, dict-like view of a project's chunks: `store[doc_id]` returns a `Document` with the raw
+    page_content and a `source` metadata entry, as the old pickled docstore did
+    '''
+
+    def __init__(self, db_dir):
+        self.db_dir = db_dir
+        self.index = {}
+        self._lexical_index = None
+        self._lexical_index_lock = threading.Lock()
+
+        # a rewrite between reading the index and opening its blob removes that blob; the new index is read then
+        for attempt in range(3):
+            blob_name, self.index = self._read_index(db_dir)
+            try:
+                self._file = open(f"{db_dir}/{blob_name}", "rb")
+                break
+            except FileNotFoundError:
+                if attempt == 2:
+                    raise
+
+        if os.fstat(self._file.fileno()).st_size > 0:
+            self._blob = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            # mmap cannot map an empty file
+            self._blob = b""
+
+    @staticmethod
+    def _read_index(db_dir):
+        blob_name = BLOB_FILE
+        index = {}
+        with open(f"{db_dir}/{INDEX_FILE}", "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if isinstance(entry, dict):
+                    blob_name = entry["blob"]
+                elif len(entry) == 1:
+                    index.pop(entry[0], None)
+                else:
+                    index[entry[0]] = tuple(entry[1:])
+        return blob_name, index
+
+    def __getitem__(self, doc_id):
+        offset, content_length, _, source = self.index[doc_id]
+        page_content = self._blob[offset:offset + content_length].decode("utf-8")
+        return Document(page_content=page_content, metadata={'source' : source})
+
+    def __contains__(self, doc_id):
+        return doc_id in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def keys(self):
+        return self.index.keys()
+
+    def get(self, doc_id, default = None):
+        if doc_id not in self.index:
+            return default
+        return self[doc_id]
+
+    def get_summary(self, doc_id):
+        offset, content_length, summary_length, _ = self.index[doc_id]
+        start = offset + content_length
+        return self._blob[start:start + summary_length].decode("utf-8")
+
+    @property
+    def lexical_index(self):
+        '''
+        the project's BM25 index over the raw chunks, loaded on first use
+
+        if bm25.json is missing or out of date the index is built in memory only; it is written at ingest
+        or migration time
+        '''
+        with self._lexical_index_lock:
+            if self._lexical_index is None:
+                from utils.bm25_utils import load_bm25_index
+                self._lexical_index = load_bm25_index(self.db_dir, docstore = self, save = False)
+            return self._lexical_index
+
+    def document_data(self):
+        '''
+        decodes every chunk into the `document_data` format used by `db_utils`
+        '''
+        document_data = []
+        for doc_id, (offset, content_length, summary_length, source) in self.index.items():
+            document_data.append({
+                'page_content' : self._blob[offset:offset + content_length].decode("utf-8"),
+                'source' : source,
+                'summary' : self._blob[offset + content_length:offset + content_length + summary_length].decode("utf-8"),
+                'doc_id' : doc_id
+            })
+        return document_data
+
+    def close(self):
+        if isinstance(self._blob, mmap.mmap):
+            self._blob.close()
+        self._file.close()
+
+
+def _encode_chunks(document_data, start_offset):
+    '''
+    returns the blob bytes and index lines for `document_data`, with offsets starting at `start_offset`
+    '''
+    blob_parts = []
+    index_lines = []
+    offset = start_offset
+
+    for doc in document_data:
+        content = doc['page_content'].encode("utf-8")
+        summary = doc.get('summary', "").encode("utf-8")
+        blob_parts.append(content)
+        blob_parts.append(summary)
+        index_lines.append(json.dumps([doc['doc_id'], offset, len(content), len(summary), doc['source']]) + "\n")
+        offset += len(content) + len(summary)
+
+    return b"".join(blob_parts), "".join(index_lines)
+
+
+def write_chunk_store(document_data, db_dir):
+    '''
+    (re)writes the chunk store of `db_dir` from scratch, into a new blob. Only the index is swapped in, atomically,
+    so a reader sees either the old index and blob or the new ones, and readers holding the old store open keep
+    a consistent view
+    '''
+    blob, index_text = _encode_chunks(document_data, 0)
+
+    old_blob_name = blob_file(db_dir) if os.path.exists(f"{db_dir}/{INDEX_FILE}") else None
+    blob_name = f"chunks.{uuid.uuid4().hex}.bin"
+    # a temporary name unique to this writer, so concurrent writers never share a half written index
+    index_tmp = f"{db_dir}/{INDEX_FILE}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+    with open(f"{db_dir}/{blob_name}", "wb") as f:
+        f.write(blob)
+        f.flush()
+        os.fsync(f.fileno())
+    with open(index_tmp, "w", encoding="utf-8") as f:
+        f.write(json.dumps({"blob" : blob_name}) + "\n")
+        f.write(index_text)
+
+    os.replace(index_tmp, f"{db_dir}/{INDEX_FILE}")
+
+    # readers that still have the old blob mapped keep it until they close it
+    if old_blob_name is not None and os.path.exists(f"{db_dir}/{old_blob_name}"):
+        os.remove(f"{db_dir}/{old_blob_name}")
+
+
+def append_chunks(document_data, db_dir):
+    '''
+    appends new chunks to the chunk store of `db_dir`, creating it if needed. The blob is written before the
+    index, so a reader never sees an index entry whose bytes are missing
+    '''
+    if not chunk_store_exists(db_dir):
+        write_chunk_store(document_data, db_dir)
+        return
+
+    with open(f"{db_dir}/{blob_file(db_dir)}", "ab") as f:
+        start_offset = f.tell()
+        blob, index_text = _encode_chunks(document_data, start_offset)
+        f.write(blob)
+        f.flush()
+        os.fsync(f.fileno())
+
+    with open(f"{db_dir}/{INDEX_FILE}", "a", encoding="utf-8") as f:
+        f.write(index_text)
+
+
+def remove_chunks(doc_ids, db_dir):
+    '''
+    marks chunks as removed. Their bytes stay in the blob until `compact_chunk_store` is run
+    '''
+    if not chunk_store_exists(db_dir):
+        return
+
+    with open(f"{db_dir}/{INDEX_FILE}", "a", encoding="utf-8") as f:
+        for doc_id in doc_ids:
+            f.write(json.dumps([doc_id]) + "\n")
+
+
+def compact_chunk_store(db_dir):
+    '''
+    rewrites the chunk store without removed or overridden chunks
+    '''
+    store = ChunkStore(db_dir)
+    document_data = store.document_data()
+    store.close()
+    write_chunk_store(document_data, db_dir)
+
+
+def migrate_pickles(db_dir, remove_pickles = False):
+    '''
+    one-shot conversion of `docstore.pkl` and `document_data.pkl` in `db_dir` into a chunk store and its BM25
+    index
+
+    chunks only present in the docstore are kept, with an empty summary
+    '''
+    document_data = []
+    if os.path.exists(f"{db_dir}/document_data.pkl"):
+        with open(f"{db_dir}/document_data.pkl", "rb") as f:
+            document_data = pickle.load(f)
+
+    if os.path.exists(f"{db_dir}/docstore.pkl"):
+        with open(f"{db_dir}/docstore.pkl", "rb") as f:
+            docstore = pickle.load(f)
+
+        known_ids = set(doc['doc_id'] for doc in document_data)
+        for doc_id, doc in docstore.items():
+            if doc_id not in known_ids:
+                document_data.append({
+                    'page_content' : doc.page_content,
+                    'source' : doc.metadata['source'],
+                    'summary' : "",
+                    'doc_id' : doc_id
+                })
+
+    write_chunk_store(document_data, db_dir)
+    print(f"Migrated {len(document_data)} chunks to {db_dir}/{INDEX_FILE}")
+
+    # the BM25 index is built here, while every chunk is decoded anyway, so opening the project never has to
+    from utils.bm25_utils import write_bm25_index
+    write_bm25_index(document_data, db_dir)
+
+    if remove_pickles:
+        for file_name in ["docstore.pkl", "document_data.pkl"]:
+            if os.path.exists(f"{db_dir}/{file_name}"):
+                os.remove(f"{db_dir}/{file_name}")
+
+
+def migrate_pickles_if_needed(db_dir):
+    '''
+    migrates the pickles of `db_dir` unless it already has a chunk store. Processes opening the same legacy
+    project at once wait on a file lock, and only the first one migrates it
+    '''
+    if chunk_store_exists(db_dir):
+        return
+    if not os.path.exists(f"{db_dir}/docstore.pkl") and not os.path.exists(f"{db_dir}/document_data.pkl"):
+        return
+
+    # only needed here, and only available on POSIX systems
+    import fcntl
+
+    with open(f"{db_dir}/{MIGRATION_LOCK_FILE}", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if not chunk_store_exists(db_dir):
+                migrate_pickles(db_dir)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+if __name__ == "__main__":
+    # python -m utils.chunkstore_utils dbs/af6c69d5/db
+    for db_dir in sys.argv[1:]:
+        migrate_pickles(db_dir)
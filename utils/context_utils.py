@@ -0,0 +1,201 @@
+'''
+Assembles the context sent to the LLM from the retrieved chunks
+
+Retrieved chunks often repeat each other: the same paragraph indexed twice, or consecutive chunks of one source
+that share their overlap. `pack_context`:
+    - drops chunks that are near-duplicates of a better ranked one
+    - merges chunks of the same source whose end and start overlap, keeping the overlap once
+    - packs the merged chunks, best ranked first, up to a per-model token budget (the last one truncated to fit)
+
+Tokens are counted with tiktoken.
+'''
+
+import re
+from langchain_core.documents import Document
+from utils.ratelimit_utils import estimate_tokens
+
+
+# tokens of retrieved context per prompt, by model
+CONTEXT_TOKEN_BUDGETS = {
+    "gpt-4o-mini" : 3000,
+    "gpt-4o" : 3000,
+    "gpt-4" : 3000,
+    "gpt-3.5-turbo" : 2000,
+}
+DEFAULT_CONTEXT_TOKEN_BUDGET = 3000
+
+CONTEXT_SEPARATOR = "\n\n"
+
+# Jaccard similarity of word shingles above which two chunks count as duplicates
+DUPLICATE_THRESHOLD = 0.9
+SHINGLE_SIZE = 3
+
+# shortest overlap (in characters) for two chunks to be merged
+MIN_OVERLAP = 20
+
+# a truncated chunk shorter than this is not worth including
+MIN_TRUNCATED_TOKENS = 50
+
+
+_encodings = {}
+
+
+def get_encoding(model = "gpt-4o-mini"):
+    '''
+    tiktoken encoding for `model`, or None if tiktoken or its encoding files are unavailable (e.g. offline)
+    '''
+    if model not in _encodings:
+        try:
+            import tiktoken
+            try:
+                _encodings[model] = tiktoken.encoding_for_model(model)
+            except KeyError:
+                _encodings[model] = tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            _encodings[model] = None
+
+    return _encodings[model]
+
+
+def count_tokens(text, model = "gpt-4o-mini"):
+    '''
+    number of tokens in `text` for `model`, falling back to a rough estimate without tiktoken
+    '''
+    encoding = get_encoding(model)
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_to_tokens(text, max_tokens, model = "gpt-4o-mini"):
+    encoding = get_encoding(model)
+    if encoding is None:
+        return text[:max_tokens * 4]
+    return encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
+
+
+def context_budget(model):
+    return CONTEXT_TOKEN_BUDGETS.get(model, DEFAULT_CONTEXT_TOKEN_BUDGET)
+
+
+def _shingles(text):
+    words = re.findall(r"\w+", text.lower())
+    if len(words) <= SHINGLE_SIZE:
+        return {tuple(words)}
+    return {tuple(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+
+def _jaccard(a, b):
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def _overlap(first, second, max_overlap = 2000):
+    '''
+    length of the longest suffix of `first` that is a prefix of `second` (0 if shorter than MIN_OVERLAP)
+    '''
+    if len(first) < MIN_OVERLAP or len(second) < MIN_OVERLAP:
+        return 0
+
+    head = second[:MIN_OVERLAP]
+    start = max(0, len(first) - max_overlap)
+    position = first.find(head, start)
+    while position != -1:
+        length = len(first) - position
+        if second.startswith(first[position:]) and length >= MIN_OVERLAP:
+            return length
+        position = first.find(head, position + 1)
+
+    return 0
+
+
+def _merge_adjacent(units):
+    '''
+    units: [page_content, source, doc_ids] in rank order. Merges units of the same source whose texts overlap,
+    keeping the position of the better ranked one
+    '''
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(units)):
+            for j in range(len(units)):
+                if i == j or units[i][1] != units[j][1]:
+                    continue
+                overlap = _overlap(units[i][0], units[j][0])
+                if overlap:
+                    # units[i] ends where units[j] starts
+                    text = units[i][0] + units[j][0][overlap:]
+                    keep, drop = min(i, j), max(i, j)
+                    units[keep] = [text, units[i][1], units[i][2] + units[j][2]]
+                    del units[drop]
+                    merged = True
+                    break
+            if merged:
+                break
+
+    return units
+
+
+def pack_context(source_docs, model = "gpt-4o-mini", budget = None):
+    '''
+    source_docs: retrieved chunks (`Document`s with a `source` metadata entry), best first
+
+    returns (context, docs, stats):
+        context: the text to put in the prompt
+        docs: the `Document`s making up the context, after merging
+        stats: {"chunks", "duplicates", "merged", "truncated", "tokens_before", "tokens_after", "saved_tokens"}
+    '''
+    if budget is None:
+        budget = context_budget(model)
+
+    tokens_before = count_tokens(CONTEXT_SEPARATOR.join(doc.page_content for doc in source_docs), model)
+
+    # drop near-duplicates of better ranked chunks
+    kept = []
+    kept_shingles = []
+    for doc in source_docs:
+        shingles = _shingles(doc.page_content)
+        if any(_jaccard(shingles, other) >= DUPLICATE_THRESHOLD for other in kept_shingles):
+            continue
+        kept.append(doc)
+        kept_shingles.append(shingles)
+    duplicates = len(source_docs) - len(kept)
+
+    units = _merge_adjacent([[doc.page_content, doc.metadata['source'], [i]] for i, doc in enumerate(kept)])
+    merged = len(kept) - len(units)
+
+    # pack best ranked first
+    parts = []
+    docs = []
+    used = 0
+    truncated = False
+    separator_tokens = count_tokens(CONTEXT_SEPARATOR, model)
+    for text, source, _ in units:
+        tokens = count_tokens(text, model) + (separator_tokens if parts else 0)
+        if used + tokens > budget:
+            remaining = budget - used - (separator_tokens if parts else 0)
+            if remaining >= MIN_TRUNCATED_TOKENS:
+                text = truncate_to_tokens(text, remaining, model)
+                parts.append(text)
+                docs.append(Document(page_content=text, metadata={'source' : source}))
+                truncated = True
+            break
+        parts.append(text)
+        docs.append(Document(page_content=text, metadata={'source' : source}))
+        used += tokens
+
+    context = CONTEXT_SEPARATOR.join(parts)
+    tokens_after = count_tokens(context, model)
+
+    stats = {
+        "chunks" : len(source_docs),
+        "duplicates" : duplicates,
+        "merged" : merged,
+        "truncated" : truncated,
+        "tokens_before" : tokens_before,
+        "tokens_after" : tokens_after,
+        "saved_tokens" : tokens_before - tokens_after,
+    }
+
+    return context, docs, stats
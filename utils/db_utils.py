@@ -2,40 +2,152 @@ from langchain_chroma import Chroma
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import PromptTemplate
 from langchain_core.documents import Document
+import asyncio
+import json
 import os
+import queue
+import threading
 import tqdm
 import uuid
-import pickle
 # from docs import pdf_to_doc, pdf_txt_to_doc, pkl_to_doc, new_data_to_doc
-from utils.doc_utils import pdf_to_doc, pdf_txt_to_doc, pkl_to_doc, new_data_to_doc, uploaded_files_to_doc
+from utils.doc_utils import pdf_to_doc, pdf_txt_to_doc, pkl_to_doc, new_data_to_doc, iter_new_data_docs, uploaded_files_to_doc
+from utils.chunkstore_utils import ChunkStore, append_chunks, chunk_store_exists, migrate_pickles_if_needed, remove_chunks, write_chunk_store
+from utils.summary_cache_utils import SummaryCache, get_summary_cache, llm_name
+from utils.answer_cache_utils import get_answer_cache
+from utils.ratelimit_utils import TokenBucketLimiter, acall_with_backoff, estimate_tokens, run_sync
+from utils.manifest_utils import ManifestBuilder, load_manifest, manifest_from_document_data, plan_ingestion, save_manifest
+from utils.instrumentation_utils import instrumented
+from utils.bm25_utils import BM25Index, load_bm25_index, save_bm25_index, write_bm25_index
+from utils.vector_index_utils import export_vector_index, load_index_config
+from utils.multivector_utils import CHUNK_LEVEL, SUMMARY_LEVEL, chunk_documents, chunk_level_enabled, open_chunk_db, save_levels
 
 
 
-def summarize_texts(texts, llm):
+SUMMARY_PROMPT = "You are to summarize the following document for retrieval for RAG. Include some helpful keywords to aid in retrieval. \
+        Text: {doc}"
 
-    summaries = []
+# bump whenever SUMMARY_PROMPT changes, so cached summaries made with the old prompt are not reused
+SUMMARY_PROMPT_VERSION = 1
+
+# summaries finished during a build are checkpointed here (in the db directory) until the build completes
+SUMMARY_CHECKPOINT_FILE = "summaries.checkpoint.jsonl"
+
+# expected length of a summary, counted against the tokens per minute budget
+SUMMARY_MAX_TOKENS_ESTIMATE = 256
+
+
+def load_summary_checkpoint(checkpoint_path):
+    '''
+    returns the summaries saved in a checkpoint file, as a dictionary of {cache key : summary}
+    '''
+    checkpoint = {}
+    if checkpoint_path is None or not os.path.exists(checkpoint_path):
+        return checkpoint
+
+    with open(checkpoint_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # the last line may be cut short if the build was killed mid-write
+                continue
+            checkpoint[entry["key"]] = entry["summary"]
+
+    return checkpoint
+
+
+def save_summary_checkpoint(checkpoint_path, entries):
+    with open(checkpoint_path, "a", encoding="utf-8") as f:
+        for key, summary in entries:
+            f.write(json.dumps({"key" : key, "summary" : summary}) + "\n")
 
-    prompt_template = PromptTemplate.from_template(
-        "You are to summarize the following document for retrieval for RAG. Include some helpful keywords to aid in retrieval. \
-        Text: {doc}"
-    )
+
+def remove_summary_checkpoint(checkpoint_path):
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+
+async def asummarize_texts(texts, llm, cache = None, checkpoint_path = None, max_concurrency = 8,
+                           requests_per_minute = 500, tokens_per_minute = 200000, checkpoint_every = 50, limiter = None):
+    '''
+    summarizes each text with `llm`, running up to `max_concurrency` requests at once under a requests/tokens
+    per minute budget. Rate limit (429) and server (5xx) errors are retried with exponential backoff
+
+    cache: optional `SummaryCache`. Only texts without a cached summary for this prompt and model are sent to the llm
+    checkpoint_path: completed summaries are appended to this file every `checkpoint_every` summaries, and
+        summaries already in it are reused, so an interrupted build resumes where it stopped
+    limiter: a `TokenBucketLimiter` shared with other calls (e.g. every batch of a streaming build), so their
+        requests count against one budget. By default a new one is made from `requests_per_minute` and
+        `tokens_per_minute`
+    '''
+
+    model = llm_name(llm)
+    keys = [SummaryCache.key(text, SUMMARY_PROMPT_VERSION, model) for text in texts]
+
+    if cache is not None:
+        summaries = cache.get_many(texts, SUMMARY_PROMPT_VERSION, model)
+    else:
+        summaries = [None] * len(texts)
+
+    checkpoint = load_summary_checkpoint(checkpoint_path)
+    summaries = [summary if summary is not None else checkpoint.get(key) for key, summary in zip(keys, summaries)]
+
+    # identical chunks are only summarized once
+    uncached = dict((key, text) for key, text, summary in zip(keys, texts, summaries) if summary is None)
+    new_summaries = {}
+    pending = []
+
+    prompt_template = PromptTemplate.from_template(SUMMARY_PROMPT)
 
     chain = ({"doc" : lambda x : x} | prompt_template | llm | StrOutputParser())
 
-    # batch 100 at a time
-    print("Batching 100 queries at a time")
-    for i in tqdm.tqdm(range((len(texts)//100)+1), "batches"):
-        summaries += chain.batch(texts[100*i:100*(i+1)])
+    if limiter is None:
+        limiter = TokenBucketLimiter(requests_per_minute, tokens_per_minute)
+    semaphore = asyncio.Semaphore(max_concurrency)
+    progress = tqdm.tqdm(total=len(uncached), desc="summaries")
+
+    def flush():
+        if checkpoint_path is not None:
+            save_summary_checkpoint(checkpoint_path, [(key, summary) for key, _, summary in pending])
+        if cache is not None:
+            cache.put_many([text for _, text, _ in pending], [summary for _, _, summary in pending], SUMMARY_PROMPT_VERSION, model)
+        pending.clear()
+
+    async def summarize(key, text):
+        async with semaphore:
+            await limiter.acquire(estimate_tokens(SUMMARY_PROMPT) + estimate_tokens(text) + SUMMARY_MAX_TOKENS_ESTIMATE)
+            summary = await acall_with_backoff(chain.ainvoke, text)
+
+        new_summaries[key] = summary
+        pending.append((key, text, summary))
+        progress.update(1)
+        if len(pending) >= checkpoint_every:
+            flush()
+
+    try:
+        await asyncio.gather(*[summarize(key, text) for key, text in uncached.items()])
+    finally:
+        # keep whatever finished, even if a request failed for good
+        flush()
+        progress.close()
+
+    summaries = [summary if summary is not None else new_summaries[key] for key, summary in zip(keys, summaries)]
 
     assert len(summaries) == len(texts)
 
-    # for _ in tqdm.tqdm(range(1)):
-    #     summaries = chain.batch(texts)
-
     return summaries
 
 
-def create_document_data(docs, llm):
+@instrumented("ingest.summarize_texts")
+def summarize_texts(texts, llm, cache = None, checkpoint_path = None, **kwargs):
+    '''
+    synchronous wrapper around `asummarize_texts`
+    '''
+    return run_sync(asummarize_texts(texts, llm, cache = cache, checkpoint_path = checkpoint_path, **kwargs))
+
+
+@instrumented("ingest.create_document_data")
+def create_document_data(docs, llm, use_cache = True, checkpoint_path = None, limiter = None):
     # pdf_paths = []
 
     # for file_name in os.listdir(directory):
@@ -55,7 +167,7 @@ def create_document_data(docs, llm):
 
     texts_to_summarize = [doc['page_content'] for doc in docs]
 
-    summaries = summarize_texts(texts_to_summarize, llm)
+    summaries = summarize_texts(texts_to_summarize, llm, cache = get_summary_cache() if use_cache else None, checkpoint_path = checkpoint_path, limiter = limiter)
 
     document_data = []
 
@@ -64,161 +176,426 @@ def create_document_data(docs, llm):
             'page_content' : docs[i]['page_content'],
             'source' : docs[i]['source'],
             'summary' : summaries[i],
-            'doc_id' : str(uuid.uuid4())
+            'doc_id' : docs[i].get('doc_id') or str(uuid.uuid4())
         })
     
     return document_data
 
-def create_db(document_data, save_dir, embedding_function):
+@instrumented("ingest.create_db")
+def create_db(document_data, save_dir, embedding_function, index_chunks = False):
+    '''
+    index_chunks: also embed the raw page_content of each chunk (two-level indexing, see
+    `utils/multivector_utils.py`)
+    '''
     summary_docs = [Document(page_content = doc['summary'], metadata = {'doc_id' : doc['doc_id']}) for doc in document_data]
 
-    db = Chroma.from_documents(summary_docs, embedding_function, persist_directory=f"{save_dir}/chroma_db")
+    # Chroma ids are the doc_ids, so stale chunks can be deleted by id on update
+    db = Chroma.from_documents(summary_docs, embedding_function, ids=[doc['doc_id'] for doc in document_data], persist_directory=f"{save_dir}/chroma_db")
+
+    if index_chunks:
+        chunk_db = open_chunk_db(save_dir, embedding_function)
+        db_update(chunk_db, document_data, level = CHUNK_LEVEL)
+        save_levels([SUMMARY_LEVEL, CHUNK_LEVEL], save_dir)
     docstore = {doc['doc_id'] : Document(page_content = doc['page_content'], metadata = {'source' : doc['source']}) for doc in document_data}
 
     return db, docstore
 
+@instrumented("ingest.save_artifacts")
 def save_artifacts(document_data, docstore, save_dir):
-    
-    with open(f"{save_dir}/document_data.pkl", "wb") as f:
-        pickle.dump(document_data, f)
-
-    with open(f"{save_dir}/docstore.pkl", "wb") as f:
-        pickle.dump(docstore, f)
+    '''
+    writes the chunk store and BM25 index for `document_data`. `docstore` is derived from `document_data` and is
+    not saved separately
+    '''
+    write_chunk_store(document_data, save_dir)
+    write_bm25_index(document_data, save_dir)
 
 
+@instrumented("ingest.load_db_and_artifcats")
 def load_db_and_artifcats(db_dir, embedding_function):
+    '''
+    returns the Chroma db and the chunk store of `db_dir`. Use `docstore.document_data()` if the full
+    `document_data` list is needed; the update functions only append to the store and never decode it
+    '''
+    migrate_pickles_if_needed(db_dir)
+    if not chunk_store_exists(db_dir):
+        write_chunk_store([], db_dir)
 
-    with open(f"{db_dir}/docstore.pkl", "rb") as f:
-        docstore = pickle.load(f)
-
-    with open(f"{db_dir}/document_data.pkl", "rb") as f:
-        document_data = pickle.load(f)
+    docstore = ChunkStore(db_dir)
 
     db = Chroma(persist_directory=f"{db_dir}/chroma_db", embedding_function=embedding_function)
 
 
-    return db, docstore, document_data
+    return db, docstore
 
 
 
 
 
-def db_update(db, new_document_data):
+@instrumented("ingest.db_update")
+def db_update(db, new_document_data, level = SUMMARY_LEVEL):
     '''
     update existing db with new document_data
+
+    level: SUMMARY_LEVEL to embed the summaries, CHUNK_LEVEL to embed the raw chunks (into the chunk collection)
     '''
-    summary_docs = [Document(page_content = doc['summary'], metadata = {'doc_id' : doc['doc_id']}) for doc in new_document_data]
-    db.add_documents(summary_docs)
+    if level == CHUNK_LEVEL:
+        docs = chunk_documents(new_document_data)
+    else:
+        docs = [Document(page_content = doc['summary'], metadata = {'doc_id' : doc['doc_id']}) for doc in new_document_data]
+    db.add_documents(docs, ids=[doc['doc_id'] for doc in new_document_data])
 
 
-def pdf_to_db(pdf_directory, embedding_function, llm, save_dir):
-    os.makedirs(save_dir, exist_ok = False)
+@instrumented("ingest.db_delete")
+def db_delete(db, doc_ids):
+    '''
+    remove chunks from the db by doc_id. Looks the entries up by metadata, since databases built before doc_ids
+    were used as Chroma ids have random Chroma ids
+    '''
+    doc_ids = list(doc_ids)
+    for i in range(0, len(doc_ids), 500):
+        ids = db.get(where={"doc_id" : {"$in" : doc_ids[i:i+500]}})["ids"]
+        if ids:
+            db.delete(ids=ids)
 
-    # load in pdf as "docs"
-    docs = pdf_to_doc(pdf_directory)
 
-    # create summarise and id, save to document_data
-    document_data = create_document_data(docs, llm)
+def assign_doc_ids(docs):
+    '''
+    gives every chunk of a new database its deterministic doc_id. Returns the docs and the manifest to save
+    once the database is written
+    '''
+    builder = ManifestBuilder()
+    docs = [builder.add(doc) for doc in docs]
+    return docs, builder.manifest()
 
-    # embed to database and create docstore
-    db, docstore = create_db(document_data, save_dir, embedding_function = embedding_function)
 
-    # save artifacts
-    save_artifacts(document_data = document_data, docstore = docstore, save_dir = save_dir)
+_END = object()
 
-def data_to_db(new_data_directory, embedding_function, llm, save_dir):
-    os.makedirs(save_dir, exist_ok = True)
 
-    # load in pdf and txts as "docs"
-    docs = new_data_to_doc(new_data_directory)
+def _put(q, item, stop):
+    '''
+    blocking put that gives up once `stop` is set, so a failed downstream stage never deadlocks its producers
+    '''
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get(q, stop):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return _END
+
+
+def _produce_stage(items, out_queue, stop, errors):
+    try:
+        for item in items:
+            if not _put(out_queue, item, stop):
+                return
+    except BaseException as e:
+        errors.append(e)
+        stop.set()
+    finally:
+        _put(out_queue, _END, stop)
+
+
+def _map_stage(fn, in_queue, out_queue, stop, errors):
+    try:
+        while True:
+            item = _get(in_queue, stop)
+            if item is _END:
+                return
+            if not _put(out_queue, fn(item), stop):
+                return
+    except BaseException as e:
+        errors.append(e)
+        stop.set()
+    finally:
+        _put(out_queue, _END, stop)
+
+
+def iter_batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+@instrumented("ingest.stream_docs_to_db")
+def stream_docs_to_db(docs, embedding_function, llm, save_dir, batch_size = 100, queue_size = 2, compression = None,
+                      index_chunks = False, requests_per_minute = 500, tokens_per_minute = 200000):
+    '''
+    streaming build: `docs` (any iterable of chunks, e.g. a generator) flows through doc_id assignment,
+    summarization and embedding in batches of `batch_size`, and each batch is written to Chroma and the chunk
+    store as soon as it is ready
+
+    the stages run in their own threads, connected by queues holding at most `queue_size` batches, so a slow
+    stage holds back the ones before it and peak memory does not grow with the size of the corpus. Chunks are
+    queryable as soon as their batch has been written
+
+    compression: if set, also exports a NumPy vector index stored as "float32", "int8" or "pq" (see
+    `utils/vector_index_utils.py`)
+    index_chunks: also embed the raw page_content of each chunk (see `create_db`)
+    requests_per_minute, tokens_per_minute: summarization budget of the whole build, shared by every batch
+
+    raises FileExistsError if `save_dir` already holds a database, unless it is a build that was interrupted
+    (its summary checkpoint is still there) and is being resumed. Existing projects are updated with
+    `update_db_with_docs` instead, which never empties the chunk store under their vectors
+    '''
+    os.makedirs(save_dir, exist_ok = True)
 
-    # create summarise and id, save to document_data
-    document_data = create_document_data(docs, llm)
+    checkpoint_path = f"{save_dir}/{SUMMARY_CHECKPOINT_FILE}"
+    if chunk_store_exists(save_dir) and not os.path.exists(checkpoint_path):
+        raise FileExistsError(f"{save_dir} already holds a database, update it instead of building over it")
+    # doc_ids are assigned by the producer thread; the manifest only lists chunks once they are written, so a
+    # build that stops part way is seen as incomplete by the next update
+    builder = ManifestBuilder()
+    written = ManifestBuilder()
+    lexical_index = BM25Index()
+    db = Chroma(persist_directory=f"{save_dir}/chroma_db", embedding_function=embedding_function)
+    chunk_db = open_chunk_db(save_dir, embedding_function) if index_chunks else None
+    if index_chunks:
+        save_levels([SUMMARY_LEVEL, CHUNK_LEVEL], save_dir)
+
+    # start from an empty chunk store (a resumed build re-adds its chunks; their vectors are upserted by doc_id)
+    write_chunk_store([], save_dir)
+
+    stop = threading.Event()
+    errors = []
+    chunk_batches = queue.Queue(maxsize=queue_size)
+    summarized_batches = queue.Queue(maxsize=queue_size)
+
+    batches = iter_batches((builder.add(doc) for doc in docs), batch_size)
+    limiter = TokenBucketLimiter(requests_per_minute, tokens_per_minute)
+    summarize = lambda batch: create_document_data(batch, llm, checkpoint_path = checkpoint_path, limiter = limiter)
+
+    threads = [
+        threading.Thread(target=_produce_stage, args=(batches, chunk_batches, stop, errors), daemon=True),
+        threading.Thread(target=_map_stage, args=(summarize, chunk_batches, summarized_batches, stop, errors), daemon=True),
+    ]
+    for thread in threads:
+        thread.start()
+
+    n_chunks = 0
+    try:
+        while True:
+            document_data = _get(summarized_batches, stop)
+            if document_data is _END:
+                break
+
+            # the chunks go into the chunk store before their vectors are searchable, so a query running during
+            # the build never gets a doc_id the chunk store does not have
+            append_chunks(document_data, save_dir)
+            db_update(db, document_data)
+            if chunk_db is not None:
+                db_update(chunk_db, document_data, level = CHUNK_LEVEL)
+            lexical_index.add_document_data(document_data)
+            for doc in document_data:
+                written.record(doc)
+            save_manifest(written.manifest(), save_dir)
+
+            n_chunks += len(document_data)
+            print(f"Wrote {n_chunks} chunks to {save_dir}")
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise errors[0]
+
+    save_bm25_index(lexical_index, save_dir)
+    remove_summary_checkpoint(checkpoint_path)
+
+    if compression is not None:
+        export_vector_index(db, save_dir, compression = compression)
+    get_answer_cache().invalidate(save_dir)
+
+    return db
+
+
+@instrumented("ingest.update_db_with_docs")
+def update_db_with_docs(db_dir, embedding_function, new_docs, llm, prune = False, compression = None):
+    '''
+    incrementally applies freshly loaded `new_docs` to the database in `db_dir`
 
-    # embed to database and create docstore
-    db, docstore = create_db(document_data, save_dir, embedding_function = embedding_function)
+    only chunks that are not in the database yet are summarized and embedded. Chunks of sources whose content
+    changed are replaced, and with `prune` every source not present in `new_docs` is removed
 
-    # save artifacts
-    save_artifacts(document_data = document_data, docstore = docstore, save_dir = save_dir)
+    compression: stores the project's NumPy vector index as "float32", "int8" or "pq" from now on. By default
+    an existing index is re-exported as it was, and none is created
+    '''
+    get_summary_cache().reset_stats()
 
+    db, docstore = load_db_and_artifcats(db_dir, embedding_function)
+    chunk_db = open_chunk_db(db_dir, embedding_function) if chunk_level_enabled(db_dir) else None
 
+    manifest = load_manifest(db_dir)
+    if manifest is None:
+        manifest = manifest_from_document_data(docstore.document_data())
+    lexical_index = load_bm25_index(db_dir, docstore = docstore)
+    docstore.close()
 
-def add_pdfs_to_db(db_dir, embedding_function, new_pdf_directory, llm):
-    # load old db
-    db, docstore, document_data = load_db_and_artifcats(db_dir, embedding_function)
+    new_docs, stale_doc_ids, new_manifest = plan_ingestion(manifest, new_docs, prune = prune)
 
     # generate new document_data (summaries)
-    new_docs = pdf_to_doc(new_pdf_directory)
-    new_document_data = create_document_data(new_docs, llm)
+    checkpoint_path = f"{db_dir}/{SUMMARY_CHECKPOINT_FILE}"
+    new_document_data = create_document_data(new_docs, llm, checkpoint_path = checkpoint_path) if new_docs else []
 
-    # add documents
-    db_update(db, new_document_data)
+    # drop replaced chunks, then add the new ones
+    if stale_doc_ids:
+        db_delete(db, stale_doc_ids)
+        if chunk_db is not None:
+            db_delete(chunk_db, stale_doc_ids)
+        remove_chunks(stale_doc_ids, db_dir)
+        lexical_index.remove(stale_doc_ids)
 
-    # make new docstore and document_data
-    merged_document_data = document_data + new_document_data
-    new_docstore = {doc['doc_id'] : Document(page_content = doc['page_content'], metadata = {'source' : doc['source']}) for doc in new_document_data}
-    merged_docstore = docstore
-    merged_docstore.update(new_docstore)
+    # chunk store first, vectors second (see `stream_docs_to_db`)
+    if new_document_data:
+        append_chunks(new_document_data, db_dir)
+        db_update(db, new_document_data)
+        if chunk_db is not None:
+            db_update(chunk_db, new_document_data, level = CHUNK_LEVEL)
+        lexical_index.add_document_data(new_document_data)
 
-    save_artifacts(document_data = merged_document_data, docstore = merged_docstore, save_dir = db_dir)
+    save_bm25_index(lexical_index, db_dir)
+    save_manifest(new_manifest, db_dir)
+    remove_summary_checkpoint(checkpoint_path)
 
+    # keep an exported NumPy index in step with Chroma
+    if compression is not None or load_index_config(db_dir) is not None:
+        export_vector_index(db, db_dir, compression = compression)
 
-def add_data_to_db(db_dir, embedding_function, new_data_directory, llm):
-    # load old db
-    db, docstore, document_data = load_db_and_artifcats(db_dir, embedding_function)
+    # answers cached for the old version of the database may now be wrong
+    get_answer_cache().invalidate(db_dir)
 
-    # generate new document_data (summaries)
-    new_docs = new_data_to_doc(new_data_directory)
+    get_summary_cache().report()
+
+
+@instrumented("ingest.add_chunk_level")
+def add_chunk_level(db_dir, embedding_function, batch_size = 500):
+    '''
+    turns the project in `db_dir` into a two-level index by embedding the raw page_content of every chunk
+    already in it. No summaries are generated
+    '''
+    if chunk_level_enabled(db_dir):
+        print(f"{db_dir} already has a chunk level")
+        return
 
-    new_document_data = create_document_data(new_docs, llm)
+    docstore = ChunkStore(db_dir)
+    chunk_db = open_chunk_db(db_dir, embedding_function)
 
-    # add documents
-    db_update(db, new_document_data)
+    doc_ids = list(docstore.keys())
+    for i in range(0, len(doc_ids), batch_size):
+        document_data = [{'doc_id' : doc_id, 'page_content' : docstore[doc_id].page_content} for doc_id in doc_ids[i:i + batch_size]]
+        db_update(chunk_db, document_data, level = CHUNK_LEVEL)
+        print(f"Embedded {min(i + batch_size, len(doc_ids))}/{len(doc_ids)} chunks of {db_dir}")
+    docstore.close()
 
-    # make new docstore and document_data
-    merged_document_data = document_data + new_document_data
-    new_docstore = {doc['doc_id'] : Document(page_content = doc['page_content'], metadata = {'source' : doc['source']}) for doc in new_document_data}
-    merged_docstore = docstore
-    merged_docstore.update(new_docstore)
+    save_levels([SUMMARY_LEVEL, CHUNK_LEVEL], db_dir)
 
-    save_artifacts(document_data = merged_document_data, docstore = merged_docstore, save_dir = db_dir)
+    # answers cached for the summary-only index may differ
+    get_answer_cache().invalidate(db_dir)
 
 
+@instrumented("ingest.pdf_to_db")
+def pdf_to_db(pdf_directory, embedding_function, llm, save_dir, compression = None, index_chunks = False):
+    get_summary_cache().reset_stats()
 
-def add_uploaded_files_to_db(db_dir, embedding_function, uploaded_files, llm):
-    # load old db
-    db, docstore, document_data = load_db_and_artifcats(db_dir, embedding_function)
+    os.makedirs(save_dir, exist_ok = False)
 
-    # generate new document_data (summaries)
-    # new_docs = new_data_to_doc(new_data_directory)
-    new_docs = uploaded_files_to_doc(uploaded_files)
+    # load in pdf as "docs"
+    docs = pdf_to_doc(pdf_directory)
+
+    # assign doc_ids and record them in the manifest
+    docs, manifest = assign_doc_ids(docs)
+
+    # create summarise and id, save to document_data
+    checkpoint_path = f"{save_dir}/{SUMMARY_CHECKPOINT_FILE}"
+    document_data = create_document_data(docs, llm, checkpoint_path = checkpoint_path)
+
+    # embed to database and create docstore
+    db, docstore = create_db(document_data, save_dir, embedding_function = embedding_function, index_chunks = index_chunks)
+
+    # save artifacts
+    save_artifacts(document_data = document_data, docstore = docstore, save_dir = save_dir)
+    save_manifest(manifest, save_dir)
+    remove_summary_checkpoint(checkpoint_path)
+
+    if compression is not None:
+        export_vector_index(db, save_dir, compression = compression)
+
+    get_summary_cache().report()
+
+@instrumented("ingest.data_to_db")
+def data_to_db(new_data_directory, embedding_function, llm, save_dir, batch_size = 100, compression = None, index_chunks = False):
+    get_summary_cache().reset_stats()
 
-    new_document_data = create_document_data(new_docs, llm)
+    # stream pdf, txt and pkl chunks from the parser into the database, batch by batch
+    docs = iter_new_data_docs(new_data_directory)
 
-    # add documents
-    db_update(db, new_document_data)
+    stream_docs_to_db(docs, embedding_function, llm, save_dir, batch_size = batch_size, compression = compression, index_chunks = index_chunks)
 
-    # make new docstore and document_data
-    merged_document_data = document_data + new_document_data
-    new_docstore = {doc['doc_id'] : Document(page_content = doc['page_content'], metadata = {'source' : doc['source']}) for doc in new_document_data}
-    merged_docstore = docstore
-    merged_docstore.update(new_docstore)
+    get_summary_cache().report()
 
-    save_artifacts(document_data = merged_document_data, docstore = merged_docstore, save_dir = db_dir)
 
 
-def uploaded_files_to_db(uploaded_files, embedding_function, llm, save_dir):
+@instrumented("ingest.add_pdfs_to_db")
+def add_pdfs_to_db(db_dir, embedding_function, new_pdf_directory, llm, prune = False, compression = None):
+    new_docs = pdf_to_doc(new_pdf_directory, mark_failures = True)
+    update_db_with_docs(db_dir, embedding_function, new_docs, llm, prune = prune, compression = compression)
+
+
+@instrumented("ingest.add_data_to_db")
+def add_data_to_db(db_dir, embedding_function, new_data_directory, llm, prune = False, compression = None):
+    new_docs = new_data_to_doc(new_data_directory, mark_failures = True)
+    update_db_with_docs(db_dir, embedding_function, new_docs, llm, prune = prune, compression = compression)
+
+
+@instrumented("ingest.add_uploaded_files_to_db")
+def add_uploaded_files_to_db(db_dir, embedding_function, uploaded_files, llm, prune = False, compression = None):
+    new_docs = uploaded_files_to_doc(uploaded_files)
+    update_db_with_docs(db_dir, embedding_function, new_docs, llm, prune = prune, compression = compression)
+
+
+@instrumented("ingest.uploaded_files_to_db")
+def uploaded_files_to_db(uploaded_files, embedding_function, llm, save_dir, compression = None, index_chunks = False):
+    get_summary_cache().reset_stats()
+
     os.makedirs(save_dir, exist_ok = True)
 
     # load in pdf and txts as "docs"
     # docs = new_data_to_doc(new_data_directory)
     docs = uploaded_files_to_doc(uploaded_files)
 
+    # assign doc_ids and record them in the manifest
+    docs, manifest = assign_doc_ids(docs)
+
     # create summarise and id, save to document_data
-    document_data = create_document_data(docs, llm)
+    checkpoint_path = f"{save_dir}/{SUMMARY_CHECKPOINT_FILE}"
+    document_data = create_document_data(docs, llm, checkpoint_path = checkpoint_path)
 
     # embed to database and create docstore
-    db, docstore = create_db(document_data, save_dir, embedding_function = embedding_function)
+    db, docstore = create_db(document_data, save_dir, embedding_function = embedding_function, index_chunks = index_chunks)
 
     # save artifacts
-    save_artifacts(document_data = document_data, docstore = docstore, save_dir = save_dir)
\ No newline at end of file
+    save_artifacts(document_data = document_data, docstore = docstore, save_dir = save_dir)
+    save_manifest(manifest, save_dir)
+    remove_summary_checkpoint(checkpoint_path)
+
+    if compression is not None:
+        export_vector_index(db, save_dir, compression = compression)
+
+    get_summary_cache().report()
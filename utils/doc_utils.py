@@ -10,121 +10,189 @@ all functions in this file are concerned with making `doc` files, which have for
 
 from langchain_community.document_loaders import UnstructuredPDFLoader, TextLoader
 from langchain_text_splitters.character import RecursiveCharacterTextSplitter
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import os
+import time
 import tqdm
 import pickle
 
 
-def pdf_to_doc(directory):
-    pdf_paths = []
+def _load_file(file_path, file_name):
+    '''
+    parses one file into docs. Runs in a worker process, so any error is returned rather than raised, and a
+    single bad file does not abort the whole load
+
+    returns (docs, seconds taken, error message or None)
+    '''
+    start = time.perf_counter()
+    docs = []
 
-    for file_name in os.listdir(directory):
+    try:
         if file_name.endswith(".pdf"):
-            pdf_file = os.path.join(directory, file_name)
-            pdf_paths.append((pdf_file, file_name))
+            loader = UnstructuredPDFLoader(file_path)
+            pages = loader.load_and_split()
+            for page in pages:
+                docs.append({'page_content' : page.page_content, 'source' : file_name})
 
-    docs = []
-    for pdf_file, file_name in tqdm.tqdm(pdf_paths):
-        loader = UnstructuredPDFLoader(pdf_file)
-        pages = loader.load_and_split()
-        for page in pages:
-            # docs.append({'page_content' : page.page_content, 'metadata' : {'source' : file_name}})
-            docs.append({'page_content' : page.page_content, 'source' : file_name})
+        elif file_name.endswith(".txt"):
+            loader = TextLoader(file_path)
+            pages = loader.load_and_split()
+            for page in pages:
+                docs.append({'page_content' : page.page_content, 'source' : file_name})
 
-    # print(f"Generated {len(docs)} chunks")
+        elif file_name.endswith(".pkl"):
+            # Note: will automatically split documents that are too long
+            splitter = RecursiveCharacterTextSplitter()
 
-    return docs
+            with open(file_path, "rb") as f:
+                temp_docs = pickle.load(f)
 
-def txt_to_doc(directory):
-    txt_paths = []
+            # split docs
+            for doc in temp_docs:
+                page_content = doc['page_content']
 
-    for file_name in os.listdir(directory):
-        if file_name.endswith(".txt"):
-            txt_file = os.path.join(directory, file_name)
-            txt_paths.append((txt_file, file_name))
-    
-    docs = []
-    for txt_file, file_name in tqdm.tqdm(txt_paths):
-        loader = TextLoader(txt_file)
-        pages = loader.load_and_split()
-        for page in pages:
-            docs.append({'page_content' : page.page_content, 'source' : file_name})
+                split_texts = splitter.split_text(page_content)
 
-    # print(f"Generated {len(docs)} chunks")
+                for text in split_texts:
+                    docs.append({'page_content': text, 'source': doc['source']})
 
-    return docs
+    except Exception as e:
+        return [], time.perf_counter() - start, f"{type(e).__name__}: {e}"
 
-def pdf_txt_to_doc(directory):
-    txt_paths = []
-    pdf_paths = []
+    return docs, time.perf_counter() - start, None
 
-    for file_name in os.listdir(directory):
-        if file_name.endswith(".txt"):
-            txt_file = os.path.join(directory, file_name)
-            txt_paths.append((txt_file, file_name))
-        elif file_name.endswith(".pdf"):
-            pdf_file = os.path.join(directory, file_name)
-            pdf_paths.append((pdf_file, file_name))
 
-    
-    docs = []
+def failed_file_doc(file_name):
+    '''
+    stands in for the chunks of a file that failed to parse, so an update keeps that source's existing chunks
+    instead of pruning them (see `utils/manifest_utils.py`). Has no page_content: it is never ingested
+    '''
+    return {'source' : file_name, 'load_failed' : True}
 
-    for pdf_file, file_name in tqdm.tqdm(pdf_paths):
-        loader = UnstructuredPDFLoader(pdf_file)
-        pages = loader.load_and_split()
-        for page in pages:
-            docs.append({'page_content' : page.page_content, 'source' : file_name})
 
-    for txt_file, file_name in tqdm.tqdm(txt_paths):
-        loader = TextLoader(txt_file)
-        pages = loader.load_and_split()
-        for page in pages:
-            docs.append({'page_content' : page.page_content, 'source' : file_name})
+def list_files(directory, extensions):
+    '''
+    returns (path, file name) of every file in `directory` with one of `extensions`, grouped by extension in the
+    order given and sorted by name, so loading order does not depend on the filesystem
+    '''
+    file_names = sorted(os.listdir(directory))
+    paths = []
 
-    # print(f"Generated {len(docs)} chunks")
+    for extension in extensions:
+        for file_name in file_names:
+            if file_name.endswith(extension):
+                paths.append((os.path.join(directory, file_name), file_name))
 
-    return docs
+    return paths
 
 
-def pkl_to_doc(directory):
+def iter_load_files(paths, max_workers = 1):
     '''
-    Note: will automatically split documents that are too long
+    parses `paths` (a list of (path, file name)), fanning the files out over a process pool of `max_workers`
+    processes (all cores if None, in-process if 1)
+
+    yields (file name, docs, seconds taken, error) for each file, in the order of `paths` whatever the number of
+    workers, as soon as that file (and every file before it) has been parsed. At most 2 * `max_workers` files
+    are parsed ahead of the consumer, so a slow consumer holds parsing back
     '''
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    max_workers = min(max_workers, len(paths))
+
+    if max_workers <= 1:
+        for file_path, file_name in tqdm.tqdm(paths):
+            yield (file_name,) + _load_file(file_path, file_name)
+        return
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor, tqdm.tqdm(total=len(paths)) as progress:
+        # (file name, future) in submission order; the next file is only submitted once the oldest is consumed
+        window = deque()
+        for file_path, file_name in paths:
+            window.append((file_name, executor.submit(_load_file, file_path, file_name)))
+            if len(window) >= 2 * max_workers:
+                done_name, future = window.popleft()
+                progress.update(1)
+                yield (done_name,) + future.result()
+
+        while window:
+            done_name, future = window.popleft()
+            progress.update(1)
+            yield (done_name,) + future.result()
+
+
+def load_files(paths, max_workers = 1, mark_failures = False):
+    '''
+    parses `paths` (a list of (path, file name)) into docs, see `iter_load_files`. Files that fail to parse are
+    reported and skipped
 
-    splitter = RecursiveCharacterTextSplitter()
+    mark_failures: add a `failed_file_doc` for each file that failed, for updates to leave its source alone
+    '''
+    docs = []
+    report = []
+    for file_name, file_docs, seconds, error in iter_load_files(paths, max_workers = max_workers):
+        docs += file_docs
+        if error and mark_failures:
+            docs.append(failed_file_doc(file_name))
+        report.append({'file' : file_name, 'chunks' : len(file_docs), 'seconds' : seconds, 'error' : error})
+
+    print_load_report(report)
 
-    pkl_paths = []
+    return docs
 
-    for file_name in os.listdir(directory):
-        if file_name.endswith(".pkl"):
-            pkl_file = os.path.join(directory, file_name)
-            pkl_paths.append(pkl_file)
 
-    docs = []
+def print_load_report(report):
+    if not report:
+        return
 
-    for pkl_file in tqdm.tqdm(pkl_paths):
-        with open(pkl_file, "rb") as f:
-            temp_docs = pickle.load(f)
+    total_seconds = sum(r['seconds'] for r in report)
+    print(f"Parsed {len(report)} files ({total_seconds:.1f}s of parsing)")
 
-        # split docs
-        for doc in temp_docs:
-            page_content = doc['page_content']
+    for r in sorted(report, key=lambda r: r['seconds'], reverse=True)[:5]:
+        print(f"  {r['file']}: {r['chunks']} chunks in {r['seconds']:.2f}s")
 
-            split_texts = splitter.split_text(page_content)
+    for r in report:
+        if r['error']:
+            print(f"  FAILED {r['file']}: {r['error']}")
 
-            for text in split_texts:
-                docs.append({'page_content': text, 'source': doc['source']})
-        
-    return docs
 
+def pdf_to_doc(directory, max_workers = 1, mark_failures = False):
+    return load_files(list_files(directory, [".pdf"]), max_workers = max_workers, mark_failures = mark_failures)
 
-def new_data_to_doc(directory):
-    docs = []
-    docs += pdf_txt_to_doc(directory)
-    docs += pkl_to_doc(directory)
-    print(f"Generated {len(docs)} chunks")
+def txt_to_doc(directory, max_workers = 1):
+    return load_files(list_files(directory, [".txt"]), max_workers = max_workers)
+
+def pdf_txt_to_doc(directory, max_workers = 1):
+    return load_files(list_files(directory, [".pdf", ".txt"]), max_workers = max_workers)
+
+
+def pkl_to_doc(directory, max_workers = 1):
+    '''
+    Note: will automatically split documents that are too long
+    '''
+    return load_files(list_files(directory, [".pkl"]), max_workers = max_workers)
+
+
+def new_data_to_doc(directory, max_workers = None, mark_failures = False):
+    '''
+    loads every pdf, txt and pkl file in `directory`, parsing files in parallel on all cores by default
+    '''
+    docs = load_files(list_files(directory, [".pdf", ".txt", ".pkl"]), max_workers = max_workers, mark_failures = mark_failures)
+    print(f"Generated {sum(not doc.get('load_failed') for doc in docs)} chunks")
     return docs
 
+def iter_new_data_docs(directory, max_workers = None):
+    '''
+    generator version of `new_data_to_doc`: yields docs one at a time, as soon as their file has been parsed
+    '''
+    report = []
+    for file_name, file_docs, seconds, error in iter_load_files(list_files(directory, [".pdf", ".txt", ".pkl"]), max_workers = max_workers):
+        report.append({'file' : file_name, 'chunks' : len(file_docs), 'seconds' : seconds, 'error' : error})
+        yield from file_docs
+
+    print_load_report(report)
+
+
 def uploaded_files_to_doc(uploaded_files):
     docs = []
     splitter = RecursiveCharacterTextSplitter()
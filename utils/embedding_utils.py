@@ -0,0 +1,183 @@
+'''
+Embedding functions used in front of (or in place of) `OpenAIEmbeddings`
+
+`CachedEmbeddings` wraps any LangChain embedding function and keeps every vector it has seen on disk, so
+re-ingested chunks and repeated questions skip the embedding round trip. Vectors for a model are stored in
+`cache/embeddings/{model}.{dim}.f32`, a flat file of fixed-size records (hex sha256 of the text followed by
+`dim` float32 values), which is appended to and read back with NumPy.
+'''
+
+import glob
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+
+DEFAULT_EMBEDDING_CACHE_DIR = "cache/embeddings"
+
+
+def text_key(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest().encode("ascii")
+
+
+class CachedEmbeddings(Embeddings):
+
+    def __init__(self, embeddings, model = None, cache_dir = DEFAULT_EMBEDDING_CACHE_DIR, lru_size = 1024):
+        '''
+        embeddings: the embedding function to cache
+        model: name of the embedding model, used to keep vectors of different models apart
+        lru_size: number of query strings kept in memory
+        '''
+        self.embeddings = embeddings
+        self.model = model or getattr(embeddings, "model", None) or type(embeddings).__name__
+        self.cache_dir = cache_dir
+        self.lru_size = lru_size
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._lru = OrderedDict()
+        self._rows = {}
+        self._dim = None
+        self._path = None
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load()
+
+    def _model_prefix(self):
+        safe_model = "".join(c if c.isalnum() or c in "-_." else "_" for c in self.model)
+        return os.path.join(self.cache_dir, safe_model)
+
+    def _record_dtype(self):
+        return np.dtype([("key", "S64"), ("vector", "<f4", (self._dim,))])
+
+    def _load(self):
+        paths = glob.glob(f"{self._model_prefix()}.*.f32")
+        if not paths:
+            return
+
+        self._path = paths[0]
+        self._dim = int(self._path.rsplit(".", 2)[1])
+
+        dtype = self._record_dtype()
+        n_records = os.path.getsize(self._path) // dtype.itemsize
+        if n_records == 0:
+            return
+
+        # a partially written trailing record (interrupted append) is ignored
+        records = np.memmap(self._path, dtype=dtype, mode="r", shape=(n_records,))
+        self._rows = dict(zip(records["key"].tolist(), records["vector"]))
+
+    def _store(self, keys, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+
+        if self._dim is None:
+            self._dim = vectors.shape[1]
+            self._path = f"{self._model_prefix()}.{self._dim}.f32"
+
+        records = np.empty(len(keys), dtype=self._record_dtype())
+        records["key"] = keys
+        records["vector"] = vectors
+
+        # one write per batch, so concurrent writers never interleave inside a record
+        with open(self._path, "ab") as f:
+            f.write(records.tobytes())
+
+        for key, vector in zip(keys, vectors):
+            self._rows[key] = vector
+
+    def _remember_query(self, text, vector):
+        self._lru[text] = vector
+        self._lru.move_to_end(text)
+        while len(self._lru) > self.lru_size:
+            self._lru.popitem(last=False)
+
+    def embed_documents(self, texts):
+        keys = [text_key(text) for text in texts]
+
+        with self._lock:
+            missing = {}
+            for text, key in zip(texts, keys):
+                if key not in self._rows:
+                    missing[key] = text
+
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+
+        if missing:
+            new_vectors = self.embeddings.embed_documents(list(missing.values()))
+            with self._lock:
+                self._store(list(missing.keys()), new_vectors)
+
+        with self._lock:
+            return [self._rows[key].tolist() for key in keys]
+
+    def embed_query(self, text):
+        with self._lock:
+            if text in self._lru:
+                self._lru.move_to_end(text)
+                self.hits += 1
+                return self._lru[text]
+
+            key = text_key(text)
+            if key in self._rows:
+                vector = self._rows[key].tolist()
+                self._remember_query(text, vector)
+                self.hits += 1
+                return vector
+
+        self.misses += 1
+        vector = self.embeddings.embed_query(text)
+
+        with self._lock:
+            self._store([key], [vector])
+            vector = self._rows[key].tolist()
+            self._remember_query(text, vector)
+
+        return vector
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits" : self.hits,
+            "misses" : self.misses,
+            "hit_rate" : self.hits / total if total else 0.0,
+            "stored" : len(self._rows),
+        }
+
+
+class HashingEmbeddings(Embeddings):
+    '''
+    Deterministic, offline stand-in for `OpenAIEmbeddings`: each word (and word bigram) is hashed into one of
+    `size` dimensions with a random sign, and the result is L2 normalized. No API calls, same vectors on every
+    machine, so retrieval benchmarks and load tests can run without network access
+    '''
+
+    def __init__(self, size = 512):
+        self.size = size
+        self.model = f"hashing-{size}"
+
+    def _embed(self, text):
+        vector = np.zeros(self.size, dtype=np.float32)
+        words = re.findall(r"[#\w.]+", text.lower())
+
+        for token in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+            digest = hashlib.md5(token.encode("utf-8")).digest()
+            index = int.from_bytes(digest[:4], "little") % self.size
+            vector[index] += 1.0 if digest[4] & 1 else -1.0
+
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector /= norm
+
+        return vector.tolist()
+
+    def embed_documents(self, texts):
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self._embed(text)
@@ -2,53 +2,171 @@
 Module for functions used in evaluation
 '''
 
+import json
+import os
 import pickle
 import random
-from .query_utils import query_chatbot
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from .context_utils import pack_context
+from .query_utils import answer_from_docs, retrieve_source_docs_batch
+from .summary_cache_utils import llm_name
+from .ratelimit_utils import TokenBucketLimiter, call_with_backoff, estimate_tokens
 from bert_score import BERTScorer
-import statistics
 
 DEBUG = True
+
+# prompt (context) plus answer tokens of one chatbot call, counted against the tokens per minute budget
+ANSWER_TOKENS_ESTIMATE = 2000
+
 def c_log(s):
     if DEBUG:
         print(s)
 
 
 
-def generate_answers(qa_pairs, db, docstore, llm, n = 50):
+def load_answer_checkpoint(checkpoint_path):
     '''
-    n: number of answers to generate. will default to 50
+    returns the answers saved in a checkpoint file, as a dictionary of {(question, target answer) : record}
+    '''
+    records = {}
+    if checkpoint_path is None or not os.path.exists(checkpoint_path):
+        return records
+
+    with open(checkpoint_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # the last line may be cut short if the run crashed mid-write
+                continue
+            records[(record["query"], record["target"])] = record
+
+    return records
+
+def answer_questions(qa_pairs, db, docstore, llm, n = 50, max_workers = 8, seed = 0, checkpoint_path = None,
+                     requests_per_minute = 500, tokens_per_minute = 200000, batch_size = 32, rerank = None):
+    '''
+    answers a random sample of `n` qa_pairs with the chatbot, `max_workers` questions at a time
+
+    seed: seed for sampling, so a rerun (e.g. to resume) picks the same questions
+    checkpoint_path: each answer is appended to this JSONL file as soon as it is ready, and questions already in
+        it are not asked again, so a crashed run can be resumed
+    batch_size: questions are retrieved for `batch_size` at a time, with one embedding call and one vector search
+    rerank: re-rank the retrieved chunks with the cross-encoder (see `retrieve_source_docs`)
+
+    returns a list of records {"query", "answer", "target", "latency", "retrieval_latency", "context_tokens"} in
+    sampled order. The latency of each answer includes its share of the batch retrieval time
     '''
     n = min(len(qa_pairs), n)
-    qa_pairs = random.sample(qa_pairs, n)
+    qa_pairs = random.Random(seed).sample(qa_pairs, n)
+
+    done = load_answer_checkpoint(checkpoint_path)
+    todo = [qa for qa in qa_pairs if (qa['Question'], qa['Answer']) not in done]
 
-    c_log(f"Chat bot answering {n} evaluation question")
+    c_log(f"Chat bot answering {n} evaluation question ({n - len(todo)} already answered)")
 
-    chatbot_answers = []
-    for qa in qa_pairs:
+    limiter = TokenBucketLimiter(requests_per_minute, tokens_per_minute)
+    checkpoint_lock = threading.Lock()
+
+    def answer(qa, source_docs, retrieval_time):
         query = qa['Question']
-        target = qa['Answer']
-        chatbot_answers.append((query, query_chatbot(query, db, docstore, llm)[0], target))
-    
+        limiter.acquire_sync(estimate_tokens(query) + ANSWER_TOKENS_ESTIMATE)
+
+        start = time.perf_counter()
+        chatbot_answer = call_with_backoff(answer_from_docs, query, source_docs, llm)[0]
+        record = {
+            "query" : query,
+            "answer" : chatbot_answer,
+            "target" : qa['Answer'],
+            "latency" : retrieval_time + time.perf_counter() - start,
+            "retrieval_latency" : retrieval_time,
+            "context_tokens" : pack_context(source_docs, llm_name(llm))[2]["tokens_after"],
+        }
+
+        if checkpoint_path is not None:
+            with checkpoint_lock, open(checkpoint_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record) + "\n")
+
+        return record
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for i in range(0, len(todo), batch_size):
+            batch = todo[i:i + batch_size]
+
+            start = time.perf_counter()
+            batch_docs = call_with_backoff(retrieve_source_docs_batch, [qa['Question'] for qa in batch], db, docstore, rerank=rerank)
+            retrieval_time = (time.perf_counter() - start) / len(batch)
+
+            for record in executor.map(answer, batch, batch_docs, [retrieval_time] * len(batch)):
+                done[(record["query"], record["target"])] = record
+
     c_log("Finished answering evaluation question")
 
-    return chatbot_answers
+    return [done[(qa['Question'], qa['Answer'])] for qa in qa_pairs]
+
+def generate_answers(qa_pairs, db, docstore, llm, n = 50, **kwargs):
+    '''
+    n: number of answers to generate. will default to 50
+
+    see `answer_questions` for the other arguments. returns a list of tuples (query, chatbot answer, target answer)
+    '''
+    records = answer_questions(qa_pairs, db, docstore, llm, n, **kwargs)
+
+    return [(record["query"], record["answer"], record["target"]) for record in records]
+
+def latency_stats(records, key = "latency"):
+    latencies = np.array([record[key] for record in records if key in record])
+    if len(latencies) == 0:
+        return None
+
+    return {
+        "mean" : float(latencies.mean()),
+        "p50" : float(np.percentile(latencies, 50)),
+        "p95" : float(np.percentile(latencies, 95)),
+        "max" : float(latencies.max()),
+        "raw" : latencies.tolist(),
+    }
 
-def get_bertscores(chatbot_answers):
+_scorer = None
+_scorer_lock = threading.Lock()
+
+def get_scorer():
+    '''
+    returns the BERTScorer, loading the model the first time only
+    '''
+    global _scorer
+    with _scorer_lock:
+        if _scorer is None:
+            _scorer = BERTScorer(model_type='bert-base-uncased')
+        return _scorer
+
+def get_bertscores(chatbot_answers, batch_size = 64):
     '''
     chatbot_answers: list of tuples (query, chatbot answer, target answer)
 
-    returns `bert_scores`, a list of tuples (precision, recall, f1 score) for each query-answer pair
+    returns `bert_scores`, a numpy array of shape (n, 3) holding (precision, recall, f1 score) for each query-answer pair
+
+    pairs are scored in batches of similar length, so little time is spent on padding
     '''
-    bert_scores = []
-    scorer = BERTScorer(model_type='bert-base-uncased')
+    scorer = get_scorer()
 
-    for query, chatbot_answer, target in chatbot_answers:
-        candidate = chatbot_answer
-        reference = target
-        P, R, F1 = scorer.score([candidate], [reference])
+    candidates = [chatbot_answer for _, chatbot_answer, _ in chatbot_answers]
+    references = [target for _, _, target in chatbot_answers]
 
-        bert_scores.append((P,R,F1))
+    bert_scores = np.zeros((len(chatbot_answers), 3), dtype=np.float32)
+
+    order = np.argsort([max(len(c), len(r)) for c, r in zip(candidates, references)], kind="stable")
+
+    for i in range(0, len(order), batch_size):
+        batch = order[i:i+batch_size]
+        P, R, F1 = scorer.score([candidates[j] for j in batch], [references[j] for j in batch], batch_size=batch_size)
+
+        bert_scores[batch, 0] = P.numpy()
+        bert_scores[batch, 1] = R.numpy()
+        bert_scores[batch, 2] = F1.numpy()
 
     return bert_scores
 
@@ -58,23 +176,25 @@ def process_bertscores(bert_scores) -> dict:
     the values are dictionaries, with keys "mean", "std", "max", "mean
     '''
 
+    bert_scores = np.asarray(bert_scores)
+
     bertscores_dict = {}
     bertscores_dict["raw"] = bert_scores
 
     for i, score_type in enumerate(["p", "r", "f1"]):
-        temp_scores = [score[i].item() for score in bert_scores]
+        temp_scores = bert_scores[:, i]
 
         bertscores_dict[score_type] = {}
 
-        bertscores_dict[score_type]["mean"] = statistics.mean(temp_scores)
-        bertscores_dict[score_type]["std"] = statistics.stdev(temp_scores)
-        bertscores_dict[score_type]["max"] = max(temp_scores)
-        bertscores_dict[score_type]["min"] = min(temp_scores)
-        bertscores_dict[score_type]["raw"] = temp_scores
+        bertscores_dict[score_type]["mean"] = float(temp_scores.mean())
+        bertscores_dict[score_type]["std"] = float(temp_scores.std(ddof=1))
+        bertscores_dict[score_type]["max"] = float(temp_scores.max())
+        bertscores_dict[score_type]["min"] = float(temp_scores.min())
+        bertscores_dict[score_type]["raw"] = temp_scores.tolist()
 
     return bertscores_dict
 
-def evaluate_bertscore(db, docstore, llm, qa_pairs = None, load_path = None, n = 50):
+def evaluate_bertscore(db, docstore, llm, qa_pairs = None, load_path = None, n = 50, **kwargs):
     '''
     Requires one of qa_pairs or a load_path to a 'qa_pairs.pkl' file to be supplied
 
@@ -82,6 +202,8 @@ def evaluate_bertscore(db, docstore, llm, qa_pairs = None, load_path = None, n =
 
     n: number of answers to generate. will default to 50
 
+    other keyword arguments (max_workers, seed, checkpoint_path, ...) are passed to `answer_questions`
+
     returns a `bertscores_dict` object
     '''
 
@@ -92,12 +214,44 @@ def evaluate_bertscore(db, docstore, llm, qa_pairs = None, load_path = None, n =
         with open(load_path, "rb") as f:
             qa_pairs = pickle.load(f)
 
-    chatbot_answers = generate_answers(qa_pairs, db, docstore, llm, n)
+    records = answer_questions(qa_pairs, db, docstore, llm, n, **kwargs)
+    chatbot_answers = [(record["query"], record["answer"], record["target"]) for record in records]
     bert_scores = get_bertscores(chatbot_answers)
     bertscores_dict = process_bertscores(bert_scores)
+    bertscores_dict["latency"] = latency_stats(records)
+    bertscores_dict["retrieval_latency"] = latency_stats(records, "retrieval_latency")
+    context_tokens = [record["context_tokens"] for record in records if "context_tokens" in record]
+    bertscores_dict["context_tokens"] = float(np.mean(context_tokens)) if context_tokens else None
 
     return bertscores_dict
 
+def compare_rerank(db, docstore, llm, qa_pairs = None, load_path = None, n = 50, checkpoint_path = None, **kwargs):
+    '''
+    evaluates the same questions without and with cross-encoder re-ranking
+
+    checkpoint_path: if given, answers are checkpointed to `{checkpoint_path}.plain` and `{checkpoint_path}.rerank`
+
+    returns {"plain" : bertscores_dict, "rerank" : bertscores_dict} (see `evaluate_bertscore`), each with its
+    answer and retrieval latencies and mean context tokens per prompt
+    '''
+    results = {}
+    for name, rerank in [("plain", False), ("rerank", True)]:
+        c_log(f"Evaluating {'with' if rerank else 'without'} re-ranking")
+        results[name] = evaluate_bertscore(
+            db, docstore, llm, qa_pairs = qa_pairs, load_path = load_path, n = n, rerank = rerank,
+            checkpoint_path = f"{checkpoint_path}.{name}" if checkpoint_path else None, **kwargs
+        )
+
+    for name, result in results.items():
+        # answers restored from older checkpoints have no latencies or context token counts
+        retrieval, latency, context_tokens = result["retrieval_latency"], result["latency"], result["context_tokens"]
+        retrieval_p50 = f"{retrieval['p50'] * 1000:.0f}ms" if retrieval else "n/a"
+        answer_p50 = f"{latency['p50']:.2f}s" if latency else "n/a"
+        tokens = f"{context_tokens:.0f}" if context_tokens is not None else "n/a"
+        c_log(f"{name}: f1 {result['f1']['mean']:.3f}, retrieval p50 {retrieval_p50}, answer p50 {answer_p50}, {tokens} context tokens")
+
+    return results
+
     
 
 
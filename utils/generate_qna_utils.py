@@ -5,6 +5,7 @@ Generate question-answer pairs based on a given collection of documents
 from langchain_core.output_parsers import StrOutputParser
 from langchain_openai import ChatOpenAI
 from langchain_core.prompts import PromptTemplate
+import json
 import pickle
 import utils.doc_utils as doc_utils
 
@@ -68,6 +69,35 @@ def process_text(qnas):
     return qa_pairs
 
 
+def generate_labelled_qa_pairs(document_data, llm):
+    '''
+    like `generate_qna` + `process_text`, but each qa pair also records the chunk it was generated from
+    (its "doc_id" and "source"), so retrieval can be checked against it
+
+    document_data: chunks with 'page_content', 'source' and 'doc_id', e.g. `ChunkStore.document_data()`
+    '''
+    qnas = generate_qna([doc['page_content'] for doc in document_data], llm)
+
+    labelled_qa_pairs = []
+    for doc, qna in zip(document_data, qnas):
+        for qa in process_text([qna]):
+            qa["doc_id"] = doc['doc_id']
+            qa["source"] = doc['source']
+            labelled_qa_pairs.append(qa)
+
+    return labelled_qa_pairs
+
+
+def save_labelled_qa_pairs(labelled_qa_pairs, path):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(labelled_qa_pairs, f, indent=1)
+
+
+def load_labelled_qa_pairs(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
 def save_qa_pairs(qa_pairs, directory):
 
     inp = input(f"Saving to directory {directory} [Y/N]")
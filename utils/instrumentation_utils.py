@@ -0,0 +1,243 @@
+'''
+Lightweight per-stage timing and token counting for the query and ingestion paths
+
+Code marks stages with `with span("stage name") as s:` (or the `@instrumented("stage name")` decorator), and
+may attach attributes such as token counts with `s.set(prompt_tokens=...)`. Every finished span is sent to the
+registered sinks as a record:
+
+    {"trace_id" : ..., "stage" : ..., "duration_ms" : ..., **attributes}
+
+Sinks: `LogSink` (one JSON line per span), `PrometheusSink` (aggregated, rendered in the Prometheus text format
+and optionally served over HTTP) and `RingBufferSink` (the last N records in memory).
+
+Instrumentation is off unless `enable_instrumentation` is called or the GPRMAX_CHATBOT_TRACING environment
+variable is set. When off, `span` returns a shared no-op object and decorated functions are called directly,
+so the overhead is one flag check per stage.
+'''
+
+import functools
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+logger = logging.getLogger("gprmax_chatbot.trace")
+
+_enabled = False
+_sinks = []
+_local = threading.local()
+
+
+def instrumentation_enabled():
+    return _enabled
+
+
+def enable_instrumentation(sinks = None):
+    '''
+    turns instrumentation on, sending records to `sinks` (a `LogSink` if none are given)
+    '''
+    global _enabled
+    _sinks[:] = list(sinks) if sinks else [LogSink()]
+    _enabled = True
+
+
+def disable_instrumentation():
+    global _enabled
+    _enabled = False
+    _sinks[:] = []
+
+
+class _NullSpan:
+
+    enabled = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attributes):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span:
+
+    enabled = True
+
+    def __init__(self, stage, attributes):
+        self.stage = stage
+        self.attributes = attributes
+
+    def __enter__(self):
+        # the outermost span starts a new trace, nested spans share its id
+        self._owns_trace = getattr(_local, "trace_id", None) is None
+        if self._owns_trace:
+            _local.trace_id = uuid.uuid4().hex[:16]
+        self.trace_id = _local.trace_id
+        self._start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration_ms = (time.perf_counter_ns() - self._start) / 1e6
+        if self._owns_trace:
+            _local.trace_id = None
+
+        record = {"trace_id" : self.trace_id, "stage" : self.stage, "duration_ms" : duration_ms}
+        record.update(self.attributes)
+        if exc_type is not None:
+            record["error"] = exc_type.__name__
+
+        for sink in list(_sinks):
+            sink.emit(record)
+
+        return False
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+
+def span(stage, **attributes):
+    if not _enabled:
+        return _NULL_SPAN
+    return Span(stage, attributes)
+
+
+def instrumented(stage):
+    '''
+    decorator timing every call of the function as `stage`
+    '''
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            with Span(stage, {}):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class LogSink:
+    '''
+    writes each record as one JSON line to the `gprmax_chatbot.trace` logger (or stdout)
+    '''
+
+    def __init__(self, use_logging = False):
+        self.use_logging = use_logging
+
+    def emit(self, record):
+        line = json.dumps(record)
+        if self.use_logging:
+            logger.info(line)
+        else:
+            print(f"TRACE {line}")
+
+
+class RingBufferSink:
+    '''
+    keeps the last `size` records in memory
+    '''
+
+    def __init__(self, size = 10000):
+        self._records = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def emit(self, record):
+        with self._lock:
+            self._records.append(record)
+
+    def records(self, stage = None):
+        with self._lock:
+            return [record for record in self._records if stage is None or record["stage"] == stage]
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+
+
+class PrometheusSink:
+    '''
+    aggregates records into a per-stage duration histogram and per-stage token counters, rendered in the
+    Prometheus text exposition format by `render` (or served over HTTP by `serve`)
+    '''
+
+    BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = {}
+        self._tokens = {}
+
+    def emit(self, record):
+        with self._lock:
+            stage = self._stages.setdefault(record["stage"], {"count" : 0, "sum" : 0.0, "buckets" : [0] * len(self.BUCKETS_MS)})
+            stage["count"] += 1
+            stage["sum"] += record["duration_ms"] / 1000
+            for i, bound in enumerate(self.BUCKETS_MS):
+                if record["duration_ms"] <= bound:
+                    stage["buckets"][i] += 1
+
+            for key, value in record.items():
+                if key.endswith("_tokens") and isinstance(value, int):
+                    name = (record["stage"], key[:-len("_tokens")])
+                    self._tokens[name] = self._tokens.get(name, 0) + value
+
+    def render(self):
+        lines = [
+            "# HELP chatbot_stage_duration_seconds Time spent per stage",
+            "# TYPE chatbot_stage_duration_seconds histogram",
+        ]
+
+        with self._lock:
+            for stage, data in sorted(self._stages.items()):
+                for bound, count in zip(self.BUCKETS_MS, data["buckets"]):
+                    lines.append(f'chatbot_stage_duration_seconds_bucket{{stage="{stage}",le="{bound / 1000}"}} {count}')
+                lines.append(f'chatbot_stage_duration_seconds_bucket{{stage="{stage}",le="+Inf"}} {data["count"]}')
+                lines.append(f'chatbot_stage_duration_seconds_sum{{stage="{stage}"}} {data["sum"]}')
+                lines.append(f'chatbot_stage_duration_seconds_count{{stage="{stage}"}} {data["count"]}')
+
+            lines.append("# HELP chatbot_tokens_total Tokens per stage and kind")
+            lines.append("# TYPE chatbot_tokens_total counter")
+            for (stage, kind), count in sorted(self._tokens.items()):
+                lines.append(f'chatbot_tokens_total{{stage="{stage}",kind="{kind}"}} {count}')
+
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port = 9464, host = "0.0.0.0"):
+        '''
+        serves `render()` at http://{host}:{port}/metrics from a background thread
+        '''
+        sink = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body = sink.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+if os.environ.get("GPRMAX_CHATBOT_TRACING", "") not in ("", "0"):
+    enable_instrumentation()
@@ -0,0 +1,226 @@
+'''
+Load test for the chat path: simulated concurrent sessions drive `query_chatbot` (retrieval, docstore lookup,
+prompt construction and the LLM call) against a project database
+
+The OpenAI models are replaced by local stubs with configurable latency, so the test measures what one process
+(e.g. one container built from the Dockerfile) can sustain without spending API credits. Reports throughput,
+latency percentiles, the memory high-water mark and how the time splits between stages.
+
+usage:
+
+python -m utils.loadtest_utils {db_dir} [--sessions 10] [--requests 20] [--llm-latency 1.0] [--embed-latency 0.05] [--out report.json]
+'''
+
+import argparse
+import json
+import random
+import resource
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from utils.embedding_utils import HashingEmbeddings
+from utils.instrumentation_utils import RingBufferSink, disable_instrumentation, enable_instrumentation, instrumentation_enabled
+from utils.query_utils import load_db, query_chatbot
+
+
+DEFAULT_QUESTIONS = [
+    "How do I install gprMax?",
+    "How do I install gprMax on Windows?",
+    "What does the #waveform command do?",
+    "How do I add a receiver with #rx?",
+    "How do I set the domain size?",
+    "What is the #dx_dy_dz command?",
+    "How do I run gprMax on a GPU?",
+    "How do I plot an A-scan?",
+    "How do I create a B-scan?",
+    "What materials are available in gprMax?",
+]
+
+
+class StubChatModel(BaseChatModel):
+    '''
+    stands in for `ChatOpenAI`: waits `latency` seconds and returns a fixed answer
+    '''
+
+    latency: float = 1.0
+    answer: str = "This is a stub answer used for load testing."
+
+    @property
+    def _llm_type(self):
+        return "stub"
+
+    def _generate(self, messages, stop = None, run_manager = None, **kwargs):
+        time.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self.answer))])
+
+
+class StubEmbeddings(HashingEmbeddings):
+    '''
+    stands in for `OpenAIEmbeddings`: deterministic local vectors of the project's dimension, after waiting
+    `latency` seconds per call
+    '''
+
+    def __init__(self, size = 1536, latency = 0.05):
+        super().__init__(size)
+        self.latency = latency
+
+    def embed_documents(self, texts):
+        time.sleep(self.latency)
+        return super().embed_documents(texts)
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+QUERY_STAGES = ["embed_query", "vector_search", "lexical_search", "docstore_lookup", "rerank", "prompt_build", "llm"]
+
+
+def project_dimension(db):
+    '''
+    dimension of the vectors stored in a Chroma db, so stub query vectors can be searched against it
+    '''
+    embeddings = db.get(limit=1, include=["embeddings"])["embeddings"]
+    if embeddings is None or len(embeddings) == 0:
+        raise ValueError("Database has no embeddings")
+    return len(embeddings[0])
+
+
+def max_rss_mb():
+    # ru_maxrss is in kilobytes on Linux (bytes on macOS)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+def run_load_test(db_dir, sessions = 10, requests_per_session = 20, llm_latency = 1.0, embed_latency = 0.05, questions = None, seed = 0):
+    '''
+    runs `sessions` simulated users at once, each asking `requests_per_session` questions in a row
+
+    returns a report dictionary
+    '''
+    if questions is None:
+        questions = DEFAULT_QUESTIONS
+
+    rss_before = max_rss_mb()
+
+    load_start = time.perf_counter()
+    embedding_function = StubEmbeddings(latency=embed_latency)
+    db, docstore = load_db(db_dir, embedding_function)
+    embedding_function.size = project_dimension(db)
+    docstore.lexical_index
+    load_time = time.perf_counter() - load_start
+
+    llm = StubChatModel(latency=llm_latency)
+
+    # per-stage timings come from the query path's own instrumentation
+    if instrumentation_enabled():
+        raise RuntimeError("Instrumentation is already enabled; the load test installs its own sink")
+    sink = RingBufferSink(size=sessions * requests_per_session * (len(QUERY_STAGES) + 1))
+    enable_instrumentation([sink])
+
+    latencies = []
+    errors = []
+    latencies_lock = threading.Lock()
+
+    def session(session_id):
+        rng = random.Random(seed + session_id)
+        for _ in range(requests_per_session):
+            query = rng.choice(questions)
+            start = time.perf_counter()
+            try:
+                query_chatbot(query, db, docstore, llm)
+            except Exception as e:
+                errors.append(f"{type(e).__name__}: {e}")
+                continue
+            with latencies_lock:
+                latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=sessions) as executor:
+            list(executor.map(session, range(sessions)))
+    finally:
+        disable_instrumentation()
+    wall_time = time.perf_counter() - start
+
+    latencies_ms = np.asarray(latencies) * 1000
+    n = len(latencies)
+
+    totals = {stage : sum(record["duration_ms"] for record in sink.records(stage)) for stage in QUERY_STAGES}
+    totals["other"] = max(0.0, latencies_ms.sum() - sum(totals.values()))
+
+    report = {
+        "project" : db_dir,
+        "sessions" : sessions,
+        "requests" : n,
+        "errors" : len(errors),
+        "llm_latency_s" : llm_latency,
+        "embed_latency_s" : embed_latency,
+        "load_time_s" : load_time,
+        "wall_time_s" : wall_time,
+        "throughput_rps" : n / wall_time if wall_time else 0.0,
+        "latency" : {
+            "mean_ms" : float(latencies_ms.mean()) if n else None,
+            "p50_ms" : float(np.percentile(latencies_ms, 50)) if n else None,
+            "p95_ms" : float(np.percentile(latencies_ms, 95)) if n else None,
+            "p99_ms" : float(np.percentile(latencies_ms, 99)) if n else None,
+        },
+        # mean time per request spent in each stage
+        "stages_ms" : {stage : ms / n for stage, ms in totals.items()} if n else {},
+        "max_rss_mb" : max_rss_mb(),
+        "max_rss_before_mb" : rss_before,
+    }
+
+    if errors:
+        report["first_error"] = errors[0]
+
+    return report
+
+
+def print_report(report):
+    print(f"{report['project']}: {report['sessions']} sessions, {report['requests']} requests ({report['errors']} errors) in {report['wall_time_s']:.1f}s")
+    print(f"  throughput: {report['throughput_rps']:.2f} requests/s")
+    latency = report["latency"]
+    if latency["p50_ms"] is not None:
+        print(f"  latency: p50 {latency['p50_ms']:.0f}ms, p95 {latency['p95_ms']:.0f}ms, p99 {latency['p99_ms']:.0f}ms")
+    print("  per request: " + ", ".join(f"{stage} {ms:.1f}ms" for stage, ms in report["stages_ms"].items()))
+    print(f"  memory high-water mark: {report['max_rss_mb']:.0f}MB (load time {report['load_time_s']:.2f}s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the chat path with local model stubs")
+    parser.add_argument("db_dir")
+    parser.add_argument("--sessions", type=int, default=10, help="number of concurrent simulated users")
+    parser.add_argument("--requests", type=int, default=20, help="questions asked by each user")
+    parser.add_argument("--llm-latency", type=float, default=1.0, help="seconds per stub LLM call")
+    parser.add_argument("--embed-latency", type=float, default=0.05, help="seconds per stub embedding call")
+    parser.add_argument("--questions", help="JSON file of qa pairs (with 'Question' keys) to ask instead of the defaults")
+    parser.add_argument("--out", help="write the JSON report here")
+    args = parser.parse_args()
+
+    questions = None
+    if args.questions:
+        with open(args.questions, "r", encoding="utf-8") as f:
+            questions = [qa['Question'] for qa in json.load(f)]
+
+    report = run_load_test(
+        args.db_dir,
+        sessions=args.sessions,
+        requests_per_session=args.requests,
+        llm_latency=args.llm_latency,
+        embed_latency=args.embed_latency,
+        questions=questions,
+    )
+    print_report(report)
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
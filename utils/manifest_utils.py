@@ -0,0 +1,184 @@
+'''
+Ingestion manifest, used to make database updates incremental
+
+The manifest (`manifest.json` in the db directory) records, for every source, a hash of its content and the
+ordered list of its chunks as [chunk_hash, doc_id] pairs:
+
+{
+    "version" : 1,
+    "sources" : {
+        "user_guide.pdf" : {"hash" : ..., "chunks" : [[chunk_hash, doc_id], ...]},
+        ...
+    }
+}
+
+doc_ids are derived from (source, chunk hash, occurrence), so re-ingesting an unchanged chunk always maps to
+the doc_id already stored in Chroma and the chunk store.
+'''
+
+import hashlib
+import json
+import os
+import uuid
+
+
+MANIFEST_FILE = "manifest.json"
+MANIFEST_VERSION = 1
+
+# namespace for deterministic doc_ids
+DOC_ID_NAMESPACE = uuid.UUID("5c0b6d6e-3f57-4bb4-9a4e-8e0f3d1d2a61")
+
+
+def chunk_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def source_hash(chunk_hashes):
+    return hashlib.sha256("\n".join(chunk_hashes).encode("utf-8")).hexdigest()
+
+
+def make_doc_id(source, text_hash, occurrence):
+    return str(uuid.uuid5(DOC_ID_NAMESPACE, f"{source}\0{text_hash}\0{occurrence}"))
+
+
+def empty_manifest():
+    return {"version" : MANIFEST_VERSION, "sources" : {}}
+
+
+def load_manifest(db_dir):
+    if not os.path.exists(f"{db_dir}/{MANIFEST_FILE}"):
+        return None
+
+    with open(f"{db_dir}/{MANIFEST_FILE}", "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, db_dir):
+    with open(f"{db_dir}/{MANIFEST_FILE}.tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    os.replace(f"{db_dir}/{MANIFEST_FILE}.tmp", f"{db_dir}/{MANIFEST_FILE}")
+
+
+def manifest_from_document_data(document_data):
+    '''
+    builds a manifest for a database created before manifests existed, keeping its existing doc_ids
+    '''
+    manifest = empty_manifest()
+
+    for doc in document_data:
+        entry = manifest["sources"].setdefault(doc['source'], {"hash" : None, "chunks" : []})
+        entry["chunks"].append([chunk_hash(doc['page_content']), doc['doc_id']])
+
+    for entry in manifest["sources"].values():
+        entry["hash"] = source_hash([h for h, _ in entry["chunks"]])
+
+    return manifest
+
+
+class ManifestBuilder:
+    '''
+    assigns doc_ids to the chunks of a new database one chunk at a time, and builds its manifest as it goes
+    '''
+
+    def __init__(self):
+        self.sources = {}
+        self._occurrences = {}
+
+    def add(self, doc):
+        '''
+        returns `doc` with its doc_id
+        '''
+        h = chunk_hash(doc['page_content'])
+        occurrence = self._occurrences.get((doc['source'], h), 0)
+        self._occurrences[(doc['source'], h)] = occurrence + 1
+
+        doc_id = make_doc_id(doc['source'], h, occurrence)
+        self.sources.setdefault(doc['source'], []).append([h, doc_id])
+
+        return {'page_content' : doc['page_content'], 'source' : doc['source'], 'doc_id' : doc_id}
+
+    def record(self, doc):
+        '''
+        adds a chunk that already has its doc_id to the manifest
+        '''
+        self.sources.setdefault(doc['source'], []).append([chunk_hash(doc['page_content']), doc['doc_id']])
+
+    def manifest(self):
+        manifest = empty_manifest()
+        for source, chunks in self.sources.items():
+            manifest["sources"][source] = {"hash" : source_hash([h for h, _ in chunks]), "chunks" : chunks}
+        return manifest
+
+
+def _group_by_source(docs):
+    groups = {}
+    for doc in docs:
+        groups.setdefault(doc['source'], []).append(doc)
+    return groups
+
+
+def plan_ingestion(manifest, docs, prune = False):
+    '''
+    compares freshly loaded `docs` against `manifest`
+
+    returns (new_docs, stale_doc_ids, new_manifest):
+        new_docs: the chunks that are not in the database yet, each with its `doc_id` assigned. Only these
+            need summarizing and embedding
+        stale_doc_ids: chunks that belong to changed sources (or, with `prune`, to sources absent from `docs`)
+            and must be removed from Chroma and the chunk store
+        new_manifest: the manifest describing the database once the update has been applied
+
+    docs marked `load_failed` (see `utils/doc_utils.py`) stand for files that could not be parsed: their
+    sources are left as they are, and never pruned. A failed .pkl file holds sources of unknown names, so
+    nothing is pruned at all
+    '''
+    new_manifest = {"version" : MANIFEST_VERSION, "sources" : dict(manifest["sources"])}
+    new_docs = []
+    stale_doc_ids = []
+    skipped_sources = 0
+
+    failed_sources = set(doc['source'] for doc in docs if doc.get('load_failed'))
+    docs = [doc for doc in docs if not doc.get('load_failed')]
+
+    for source, source_docs in _group_by_source(docs).items():
+        hashes = [chunk_hash(doc['page_content']) for doc in source_docs]
+        new_source_hash = source_hash(hashes)
+        old_entry = manifest["sources"].get(source)
+
+        if old_entry is not None and old_entry["hash"] == new_source_hash:
+            skipped_sources += 1
+            continue
+
+        # chunks of the old version of this source, available for reuse
+        reusable = {}
+        for h, doc_id in (old_entry["chunks"] if old_entry else []):
+            reusable.setdefault(h, []).append(doc_id)
+
+        chunks = []
+        occurrences = {}
+        for doc, h in zip(source_docs, hashes):
+            if reusable.get(h):
+                doc_id = reusable[h].pop(0)
+            else:
+                occurrence = occurrences.get(h, 0)
+                doc_id = make_doc_id(source, h, occurrence)
+                new_docs.append({'page_content' : doc['page_content'], 'source' : source, 'doc_id' : doc_id})
+            occurrences[h] = occurrences.get(h, 0) + 1
+            chunks.append([h, doc_id])
+
+        for doc_ids in reusable.values():
+            stale_doc_ids += doc_ids
+
+        new_manifest["sources"][source] = {"hash" : new_source_hash, "chunks" : chunks}
+
+    if prune and any(source.endswith(".pkl") for source in failed_sources):
+        print(f"Not pruning: could not parse {', '.join(sorted(failed_sources))}")
+    elif prune:
+        loaded_sources = set(doc['source'] for doc in docs) | failed_sources
+        for source in list(new_manifest["sources"]):
+            if source not in loaded_sources:
+                stale_doc_ids += [doc_id for _, doc_id in new_manifest["sources"].pop(source)["chunks"]]
+
+    print(f"Skipping {skipped_sources} unchanged sources, {len(new_docs)} new chunks, {len(stale_doc_ids)} stale chunks")
+
+    return new_docs, stale_doc_ids, new_manifest
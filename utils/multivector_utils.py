@@ -0,0 +1,106 @@
+'''
+Two-level indexing: every chunk is embedded twice, as its LLM summary and as its raw page_content
+
+The summary vectors are the project's usual Chroma collection; the raw chunk vectors are a second collection
+(`chunks`) in the same `chroma_db` directory, with the same doc_ids. At query time both are searched with the
+same query vector and their rankings are merged by reciprocal rank fusion, so a chunk found by either of its
+vectors is returned once. A poor summary then no longer hides its chunk, and the chunk level can be added to an
+existing project without summarizing anything again.
+
+`indexing.json` in the db directory records which levels a project has: {"levels" : ["summary", "chunk"]}.
+Projects without it are summary only.
+
+use command:
+
+python -m utils.multivector_utils enable {db_dir}
+'''
+
+import argparse
+import json
+import os
+from langchain_chroma import Chroma
+from langchain_core.documents import Document
+from utils.bm25_utils import reciprocal_rank_fusion
+
+
+CHUNK_COLLECTION = "chunks"
+INDEXING_FILE = "indexing.json"
+
+SUMMARY_LEVEL = "summary"
+CHUNK_LEVEL = "chunk"
+
+
+def load_levels(db_dir):
+    '''
+    the vector levels of the project in `db_dir`
+    '''
+    if not os.path.exists(f"{db_dir}/{INDEXING_FILE}"):
+        return [SUMMARY_LEVEL]
+
+    with open(f"{db_dir}/{INDEXING_FILE}", "r", encoding="utf-8") as f:
+        return json.load(f)["levels"]
+
+
+def save_levels(levels, db_dir):
+    with open(f"{db_dir}/{INDEXING_FILE}", "w", encoding="utf-8") as f:
+        json.dump({"levels" : levels}, f)
+
+
+def chunk_level_enabled(db_dir):
+    return CHUNK_LEVEL in load_levels(db_dir)
+
+
+def open_chunk_db(db_dir, embedding_function):
+    '''
+    the Chroma collection of raw chunk vectors of `db_dir`
+    '''
+    return Chroma(collection_name=CHUNK_COLLECTION, persist_directory=f"{db_dir}/chroma_db", embedding_function=embedding_function)
+
+
+def chunk_documents(document_data):
+    '''
+    the raw page_content of each chunk, keyed by doc_id as the summaries are
+    '''
+    return [Document(page_content = doc['page_content'], metadata = {'doc_id' : doc['doc_id']}) for doc in document_data]
+
+
+class MultiVectorStore:
+    '''
+    Searches several vector stores holding vectors of the same chunks (e.g. summaries and raw chunks) with one
+    query vector and fuses their rankings by doc_id
+
+    Implements the parts of the Chroma vector store the query path uses: `embeddings`,
+    `similarity_search_by_vector`, `similarity_search` and `get` (of the first store)
+    '''
+
+    def __init__(self, levels):
+        self.levels = levels
+        self.embeddings = levels[0].embeddings
+
+    def similarity_search_by_vector(self, embedding, k = 4, **kwargs):
+        rankings = [[doc.metadata['doc_id'] for doc in level.similarity_search_by_vector(embedding, k = k)] for level in self.levels]
+        return [Document(page_content="", metadata={'doc_id' : doc_id}) for doc_id in reciprocal_rank_fusion(rankings)[:k]]
+
+    def similarity_search(self, query, k = 4, **kwargs):
+        return self.similarity_search_by_vector(self.embeddings.embed_query(query), k = k)
+
+    def get(self, *args, **kwargs):
+        return self.levels[0].get(*args, **kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Two-level (summary and raw chunk) indexing")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    enable_parser = subparsers.add_parser("enable", help="embed the raw chunks of an existing project (uses the OpenAI API)")
+    enable_parser.add_argument("db_dir")
+
+    args = parser.parse_args()
+
+    from utils.db_utils import add_chunk_level
+    from utils.retriever_utils import get_embedding_function
+    add_chunk_level(args.db_dir, get_embedding_function())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+'''
+Compressed storage of summary vectors for the NumPy vector index
+
+    int8 - scalar quantization: each dimension mapped linearly onto -128..127 between its min and max over the
+           project (4x smaller than float32)
+    pq   - product quantization: vectors split into `n_subvectors` pieces, each replaced by the id of its nearest
+           of 256 centroids learned by k-means (one byte per piece, e.g. 96x smaller for 1536 dimensions and
+           64 pieces)
+
+Queries are not quantized: scores are computed between the full-precision query and the codes (asymmetric
+distance computation), in one pass over the codes. Both quantizers score "ip" and "l2" (cosine collections are
+normalized and searched as "ip", see `utils/vector_index_utils.py`).
+'''
+
+import numpy as np
+
+
+# rows of codes expanded to float32 at a time while scoring, bounding the temporary memory of a search
+BLOCK_ROWS = 8192
+
+DEFAULT_PQ_SUBVECTORS = 64
+PQ_CENTROIDS = 256
+# k-means is trained on at most this many vectors
+PQ_TRAINING_SAMPLE = 20000
+
+
+class Int8Quantizer:
+    name = "int8"
+
+    def __init__(self, offset = None, scale = None):
+        self.offset = offset
+        self.scale = scale
+
+    def fit(self, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if len(vectors) == 0:
+            # a project without chunks: nothing to learn, and nothing to encode
+            self.offset = np.zeros(vectors.shape[1], dtype=np.float32)
+            self.scale = np.ones(vectors.shape[1], dtype=np.float32)
+            return self
+
+        low = vectors.min(axis=0)
+        high = vectors.max(axis=0)
+
+        self.offset = low
+        # constant dimensions get any non-zero scale; all their codes are -128
+        self.scale = np.where(high > low, (high - low) / 255, 1.0).astype(np.float32)
+        return self
+
+    def encode(self, vectors):
+        codes = np.rint((np.asarray(vectors, dtype=np.float32) - self.offset) / self.scale) - 128
+        return np.clip(codes, -128, 127).astype(np.int8)
+
+    def decode(self, codes):
+        return self.offset + self.scale * (np.asarray(codes, dtype=np.float32) + 128)
+
+    def squared_norms(self, codes):
+        '''
+        squared norm of each decoded vector, needed to score "l2"
+        '''
+        norms = np.empty(len(codes), dtype=np.float32)
+        for start in range(0, len(codes), BLOCK_ROWS):
+            decoded = self.decode(codes[start:start + BLOCK_ROWS])
+            norms[start:start + len(decoded)] = np.einsum("ij,ij->i", decoded, decoded)
+        return norms
+
+    def scores(self, query_vectors, codes, metric = "ip", squared_norms = None):
+        '''
+        similarity of each query vector to each coded vector, higher is better. returns (n_queries, n_codes)
+        '''
+        query_vectors = np.asarray(query_vectors, dtype=np.float32)
+
+        # q . (offset + scale * (c + 128)) = (q * scale) . c + q . (offset + 128 * scale)
+        scaled = query_vectors * self.scale
+        constant = query_vectors @ (self.offset + 128 * self.scale)
+
+        dots = np.empty((len(query_vectors), len(codes)), dtype=np.float32)
+        for start in range(0, len(codes), BLOCK_ROWS):
+            block = np.asarray(codes[start:start + BLOCK_ROWS], dtype=np.float32)
+            dots[:, start:start + len(block)] = scaled @ block.T
+        dots += constant[:, None]
+
+        if metric == "l2":
+            if squared_norms is None:
+                squared_norms = self.squared_norms(codes)
+            return 2 * dots - squared_norms[None, :]
+        return dots
+
+    def params(self):
+        return {"offset" : self.offset, "scale" : self.scale}
+
+    @classmethod
+    def from_params(cls, params):
+        return cls(offset=params["offset"], scale=params["scale"])
+
+    @property
+    def nbytes(self):
+        return self.offset.nbytes + self.scale.nbytes
+
+
+def _kmeans(x, n_centroids, iterations, rng):
+    centroids = x[rng.choice(len(x), n_centroids, replace=False)].copy()
+
+    for _ in range(iterations):
+        distances = np.einsum("ij,ij->i", x, x)[:, None] - 2 * (x @ centroids.T) + np.einsum("ij,ij->i", centroids, centroids)[None, :]
+        assignment = distances.argmin(axis=1)
+
+        counts = np.bincount(assignment, minlength=n_centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, x)
+
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+        # empty clusters are moved onto random points
+        empty = np.flatnonzero(~filled)
+        if len(empty):
+            centroids[empty] = x[rng.choice(len(x), len(empty), replace=False)]
+
+    return centroids
+
+
+class ProductQuantizer:
+    name = "pq"
+
+    def __init__(self, n_subvectors = DEFAULT_PQ_SUBVECTORS, codebooks = None, dimension = None):
+        self.n_subvectors = n_subvectors
+        # (n_subvectors, n_centroids, subvector dimension)
+        self.codebooks = codebooks
+        self.dimension = dimension
+
+    def _split(self, vectors):
+        '''
+        (n, dimension) -> (n, n_subvectors, subvector dimension), zero padding the last subvector if needed
+        '''
+        vectors = np.asarray(vectors, dtype=np.float32)
+        padded_dimension = -(-self.dimension // self.n_subvectors) * self.n_subvectors
+        if padded_dimension != vectors.shape[1]:
+            vectors = np.pad(vectors, ((0, 0), (0, padded_dimension - vectors.shape[1])))
+        return vectors.reshape(len(vectors), self.n_subvectors, -1)
+
+    def fit(self, vectors, iterations = 20, seed = 0):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        self.dimension = vectors.shape[1]
+        if len(vectors) == 0:
+            # a project without chunks: no centroids, and n_subvectors is kept for the next export
+            self.codebooks = np.zeros((self.n_subvectors, 0, -(-self.dimension // self.n_subvectors)), dtype=np.float32)
+            return self
+        self.n_subvectors = min(self.n_subvectors, self.dimension)
+
+        rng = np.random.default_rng(seed)
+        if len(vectors) > PQ_TRAINING_SAMPLE:
+            vectors = vectors[rng.choice(len(vectors), PQ_TRAINING_SAMPLE, replace=False)]
+
+        n_centroids = min(PQ_CENTROIDS, len(vectors))
+        subvectors = self._split(vectors)
+        self.codebooks = np.stack([_kmeans(subvectors[:, j], n_centroids, iterations, rng) for j in range(self.n_subvectors)])
+        return self
+
+    def encode(self, vectors):
+        codes = np.empty((len(vectors), self.n_subvectors), dtype=np.uint8)
+        for start in range(0, len(vectors), BLOCK_ROWS):
+            subvectors = self._split(vectors[start:start + BLOCK_ROWS])
+            for j, codebook in enumerate(self.codebooks):
+                distances = -2 * (subvectors[:, j] @ codebook.T) + np.einsum("ij,ij->i", codebook, codebook)[None, :]
+                codes[start:start + len(subvectors), j] = distances.argmin(axis=1)
+        return codes
+
+    def decode(self, codes):
+        codes = np.asarray(codes)
+        decoded = self.codebooks[np.arange(self.n_subvectors)[None, :], codes]
+        return decoded.reshape(len(codes), -1)[:, :self.dimension]
+
+    def scores(self, query_vectors, codes, metric = "ip", squared_norms = None):
+        '''
+        similarity of each query vector to each coded vector, higher is better. returns (n_queries, n_codes)
+
+        each query is compared to every centroid once (a table of n_subvectors x 256 scores), and the score
+        of a coded vector is the sum of its entries in that table
+        '''
+        subqueries = self._split(query_vectors)
+        tables = np.einsum("qmd,mcd->qmc", subqueries, self.codebooks)
+        if metric == "l2":
+            # -|q - c|^2 per subvector; |q|^2 is left out as it is the same for every row
+            tables = 2 * tables - np.einsum("mcd,mcd->mc", self.codebooks, self.codebooks)[None, :, :]
+
+        subvector_index = np.arange(self.n_subvectors)[None, :]
+        scores = np.empty((len(tables), len(codes)), dtype=np.float32)
+        for start in range(0, len(codes), BLOCK_ROWS):
+            block = np.asarray(codes[start:start + BLOCK_ROWS])
+            for i, table in enumerate(tables):
+                scores[i, start:start + len(block)] = table[subvector_index, block].sum(axis=1)
+
+        return scores
+
+    def squared_norms(self, codes):
+        return None
+
+    def params(self):
+        return {"codebooks" : self.codebooks, "dimension" : np.asarray(self.dimension)}
+
+    @classmethod
+    def from_params(cls, params):
+        codebooks = params["codebooks"]
+        return cls(n_subvectors=len(codebooks), codebooks=codebooks, dimension=int(params["dimension"]))
+
+    @property
+    def nbytes(self):
+        return self.codebooks.nbytes
+
+
+QUANTIZERS = {
+    "int8" : Int8Quantizer,
+    "pq" : ProductQuantizer,
+}
+
+
+def build_quantizer(compression, vectors, pq_subvectors = DEFAULT_PQ_SUBVECTORS):
+    '''
+    a quantizer for `compression` ("int8" or "pq") trained on `vectors`
+    '''
+    if compression == "int8":
+        return Int8Quantizer().fit(vectors)
+    if compression == "pq":
+        return ProductQuantizer(n_subvectors=pq_subvectors).fit(vectors)
+    raise ValueError(f"Unknown compression {compression}, expected one of {list(QUANTIZERS)}")
+
+
+def load_quantizer(compression, params):
+    return QUANTIZERS[compression].from_params(params)
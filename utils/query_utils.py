@@ -2,13 +2,24 @@
 use command:
 
 python query.py {project_name} query/prompt {query}
+python query.py {project_name} batch {questions.jsonl|questions.csv} {answers.jsonl}
 '''
 
 from langchain_chroma import Chroma
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import PromptTemplate
-import pickle
 import os
+import threading
+import time
+import weakref
+from utils.chunkstore_utils import ChunkStore, migrate_pickles_if_needed
+from utils.instrumentation_utils import span
+from utils.context_utils import count_tokens, pack_context
+from utils.summary_cache_utils import llm_name
+from utils.bm25_utils import reciprocal_rank_fusion
+from utils.vector_index_utils import NumpyVectorStore, chroma_vectors, top_k_similar, use_vector_index
+from utils.multivector_utils import MultiVectorStore, chunk_level_enabled, open_chunk_db
+from utils.rerank_utils import RERANK_CANDIDATES, RERANK_KEEP, get_reranker, rerank_enabled
 
 def generate_gprmax_input(query):
     """
@@ -39,6 +50,203 @@ def generate_gprmax_input(query):
     
     return file_path
 
+# generate_gprmax_input writes to a fixed file name per process
+_generate_lock = threading.Lock()
+
+def generate_gprmax_input_text(query):
+    '''
+    returns (file path, content) of the input file generated for `query`, without leaving the file on disk.
+    Safe to call from several threads (server requests, batch workers) at once
+    '''
+    with _generate_lock:
+        file_path = generate_gprmax_input(query)
+        with open(file_path, "r") as f:
+            content = f.read()
+        os.remove(file_path)
+    return file_path, content
+
+QA_PROMPT = "You are an assistant for question-answering tasks. Use the following pieces of retrieved context to answer the question. If you don't know the answer, just say that you don't know.\
+    Question: {question}\
+    Context: {context}\
+    Answer:"
+
+
+def _rerank_sizes(k, lexical_k):
+    '''
+    (chunks kept, vector k, lexical k) when re-ranking: a wider candidate set, cut down to a few chunks
+    '''
+    return min(k, RERANK_KEEP), max(k, RERANK_CANDIDATES), max(lexical_k, RERANK_CANDIDATES) if lexical_k else 0
+
+def retrieve_source_docs(query, db, docstore, k = 4, lexical_k = 4, query_vector = None, rerank = None):
+    '''
+    returns the raw chunks (from the docstore) whose summaries best match `query`
+
+    if the docstore has a BM25 index over the raw chunks (`docstore.lexical_index`), its top `lexical_k` chunks
+    are merged with the top `k` vector matches by reciprocal rank fusion, and the best `k` are kept
+
+    query_vector: the embedding of `query`, if already computed
+    rerank: retrieve RERANK_CANDIDATES chunks and keep the best RERANK_KEEP (at most `k`) by cross-encoder score
+        (see `utils/rerank_utils.py`). Defaults to the GPRMAX_CHATBOT_RERANK setting
+    '''
+    if rerank is None:
+        rerank = rerank_enabled()
+    if rerank:
+        keep, k, lexical_k = _rerank_sizes(k, lexical_k)
+
+    if query_vector is None:
+        with span("embed_query"):
+            query_vector = db.embeddings.embed_query(query)
+
+    with span("vector_search"):
+        query_docs = db.similarity_search_by_vector(query_vector, k = k)
+    doc_ids = [doc.metadata['doc_id'] for doc in query_docs]
+
+    lexical_index = getattr(docstore, "lexical_index", None)
+    if lexical_index is not None and lexical_k:
+        with span("lexical_search"):
+            lexical_ids = [doc_id for doc_id, _ in lexical_index.search(query, lexical_k)]
+            doc_ids = reciprocal_rank_fusion([doc_ids, lexical_ids])[:k]
+
+    with span("docstore_lookup") as s:
+        # chunks a build has put in the vector store after this docstore was opened are skipped
+        source_docs = [docstore[doc_id] for doc_id in doc_ids if doc_id in docstore]
+        s.set(chunks=len(source_docs))
+
+    if rerank:
+        with span("rerank") as s:
+            s.set(candidates=len(source_docs))
+            source_docs = get_reranker().rerank(query, source_docs, keep)
+
+    return source_docs
+
+_project_vectors = weakref.WeakKeyDictionary()
+_project_vectors_lock = threading.Lock()
+
+def project_vectors(db):
+    '''
+    every summary vector of `db` as one float32 matrix, with the doc_id of each row and the distance metric of
+    the collection. Fetched from Chroma once per db, and again if the collection's size changes
+
+    returns (doc_ids, vectors, metric)
+    '''
+    if isinstance(db, NumpyVectorStore):
+        return db.doc_ids, db.reconstructed_vectors(), db.metric
+
+    count = db._collection.count()
+
+    with _project_vectors_lock:
+        cached = _project_vectors.get(db)
+        if cached is not None and cached[0] == count:
+            return cached[1:]
+
+    doc_ids, vectors, metric = chroma_vectors(db)
+
+    with _project_vectors_lock:
+        _project_vectors[db] = (count, doc_ids, vectors, metric)
+
+    return doc_ids, vectors, metric
+
+def vector_rankings(db, query_vectors, k):
+    '''
+    doc_ids of the `k` best matches in `db` of each query vector, best first, with one vectorized k-NN per
+    set of vectors
+    '''
+    if isinstance(db, MultiVectorStore):
+        level_rankings = [vector_rankings(level, query_vectors, k) for level in db.levels]
+        return [reciprocal_rank_fusion(list(rankings))[:k] for rankings in zip(*level_rankings)]
+
+    if isinstance(db, NumpyVectorStore):
+        # searches the index as stored, compressed or not
+        doc_ids, top = db.doc_ids, db.search(query_vectors, k)
+    else:
+        doc_ids, vectors, metric = project_vectors(db)
+        top = top_k_similar(query_vectors, vectors, k, metric)
+
+    return [[doc_ids[i] for i in row] for row in top]
+
+def retrieve_source_docs_batch(queries, db, docstore, k = 4, lexical_k = 4, query_vectors = None, rerank = None):
+    '''
+    `retrieve_source_docs` for many queries at once: the queries are embedded in one `embed_documents` call,
+    searched with one vectorized k-NN against the project's vectors, and every hit is read from the docstore in
+    one pass. With `rerank`, the candidates of all the queries are scored in the same cross-encoder batches
+
+    query_vectors: the embeddings of `queries`, if already computed
+
+    returns a list with the retrieved chunks of each query
+    '''
+    queries = list(queries)
+    if not queries:
+        return []
+
+    if rerank is None:
+        rerank = rerank_enabled()
+    if rerank:
+        keep, k, lexical_k = _rerank_sizes(k, lexical_k)
+
+    if query_vectors is None:
+        with span("embed_queries") as s:
+            query_vectors = db.embeddings.embed_documents(queries)
+            s.set(queries=len(queries))
+
+    with span("vector_search_batch"):
+        rankings = vector_rankings(db, query_vectors, k)
+
+    lexical_index = getattr(docstore, "lexical_index", None)
+    if lexical_index is not None and lexical_k:
+        with span("lexical_search"):
+            rankings = [
+                reciprocal_rank_fusion([ranking, [doc_id for doc_id, _ in lexical_index.search(query, lexical_k)]])[:k]
+                for query, ranking in zip(queries, rankings)
+            ]
+
+    with span("docstore_lookup") as s:
+        docs = {doc_id : docstore[doc_id] for doc_id in set(doc_id for ranking in rankings for doc_id in ranking) if doc_id in docstore}
+        s.set(chunks=len(docs))
+
+    source_docs = [[docs[doc_id] for doc_id in ranking if doc_id in docs] for ranking in rankings]
+
+    if rerank:
+        with span("rerank") as s:
+            s.set(candidates=sum(len(candidates) for candidates in source_docs))
+            source_docs = get_reranker().rerank_batch(queries, source_docs, keep)
+
+    return source_docs
+
+def build_prompt(query, source_docs, model = "gpt-4o-mini"):
+    '''
+    packs `source_docs` into a context within `model`'s token budget (see `pack_context`) and fills in the prompt
+
+    returns (prompt, context_docs, context_stats)
+    '''
+    with span("prompt_build") as s:
+        context, context_docs, context_stats = pack_context(source_docs, model)
+
+        prompt_template = PromptTemplate.from_template(QA_PROMPT)
+        prompt = prompt_template.invoke({"question": query, "context": context})
+
+        s.set(context_tokens=context_stats["tokens_after"], saved_tokens=context_stats["saved_tokens"])
+        if s.enabled:
+            s.set(prompt_tokens=count_tokens(prompt.text, model))
+
+    return prompt, context_docs, context_stats
+
+def answer_from_docs(query, source_docs, llm):
+    """
+    Answers `query` from already retrieved `source_docs`. Returns (answer, sources).
+    """
+    model = llm_name(llm)
+
+    prompt, context_docs, _ = build_prompt(query, source_docs, model)
+
+    with span("llm") as s:
+        answer = (llm | StrOutputParser()).invoke(prompt)
+        if s.enabled:
+            s.set(completion_tokens=count_tokens(answer, model))
+
+    sources = [doc.metadata['source'] for doc in context_docs]
+
+    return answer, sources
+
 def query_chatbot(query, db, docstore, llm):
     """
     Modified chatbot function to detect input file generation requests.
@@ -46,29 +254,91 @@ def query_chatbot(query, db, docstore, llm):
     if "generate input file" in query.lower():
         return generate_gprmax_input(query), []
 
-    query_docs = db.similarity_search(query)
-    source_docs = [docstore[doc.metadata['doc_id']] for doc in query_docs]
-    
-    prompt = "You are an assistant for question-answering tasks. Use the following pieces of retrieved context to answer the question. If you don't know the answer, just say that you don't know.\
-    Question: {question}\
-    Context: {context}\
-    Answer:"
-    
-    context = " ".join([doc.page_content for doc in source_docs])
-    
-    prompt_template = PromptTemplate.from_template(prompt)
-    chain = (prompt_template | llm | StrOutputParser())
-    
-    answer = chain.invoke({"question": query, "context": context})
-    sources = [doc.metadata['source'] for doc in source_docs]
+    with span("query_chatbot"):
+        source_docs = retrieve_source_docs(query, db, docstore)
+
+        answer, sources = answer_from_docs(query, source_docs, llm)
     
     return answer, sources
 
+def stream_query_chatbot(query, db, docstore, llm, metrics = None):
+    """
+    Streaming version of `query_chatbot`.
+
+    Retrieval runs before this returns, so the caller can show the sources while the answer is generated.
+    Returns (token generator, sources).
+
+    metrics: optional dict, filled with `retrieval_time`, `time_to_first_token` and `total_time` (seconds,
+    measured from the call) as the answer streams, and with `context_tokens` and `saved_tokens` (prompt
+    tokens saved by deduplicating and merging the retrieved chunks)
+    """
+    start = time.perf_counter()
+    if metrics is None:
+        metrics = {}
+
+    if "generate input file" in query.lower():
+        file_path = generate_gprmax_input(query)
+        metrics["retrieval_time"] = metrics["time_to_first_token"] = metrics["total_time"] = time.perf_counter() - start
+        return iter([file_path]), []
+
+    with span("stream_query_chatbot"):
+        source_docs = retrieve_source_docs(query, db, docstore)
+
+    return stream_answer(query, source_docs, llm, metrics = metrics, start = start)
+
+def stream_answer(query, source_docs, llm, metrics = None, start = None):
+    """
+    Streams the answer to `query` from already retrieved `source_docs`. Returns (token generator, sources).
+
+    metrics and start: as for `stream_query_chatbot`, times being measured from `start` (default: now)
+    """
+    if start is None:
+        start = time.perf_counter()
+    if metrics is None:
+        metrics = {}
+
+    metrics["retrieval_time"] = time.perf_counter() - start
+
+    model = llm_name(llm)
+    prompt, context_docs, context_stats = build_prompt(query, source_docs, model)
+    metrics["context_tokens"] = context_stats["tokens_after"]
+    metrics["saved_tokens"] = context_stats["saved_tokens"]
+
+    chain = (llm | StrOutputParser())
+
+    def tokens():
+        answer = []
+        with span("llm_stream") as s:
+            for token in chain.stream(prompt):
+                if "time_to_first_token" not in metrics:
+                    metrics["time_to_first_token"] = time.perf_counter() - start
+                    s.set(time_to_first_token_ms=1000 * metrics["time_to_first_token"])
+                if s.enabled:
+                    answer.append(token)
+                yield token
+            if s.enabled:
+                s.set(completion_tokens=count_tokens("".join(answer), model))
+        metrics["total_time"] = time.perf_counter() - start
+
+    sources = [doc.metadata['source'] for doc in context_docs]
+
+    return tokens(), sources
+
 def load_db(db_dir, embedding_function):
-    with open(f"{db_dir}/docstore.pkl", "rb") as f:
-        docstore = pickle.load(f)
-    
-    db = Chroma(persist_directory=f"{db_dir}/chroma_db", embedding_function=embedding_function)
+    # databases built before the chunk store existed are converted on first load
+    migrate_pickles_if_needed(db_dir)
+
+    docstore = ChunkStore(db_dir)
+
+    # projects can be switched to an exported NumPy index (see utils/vector_index_utils.py)
+    if use_vector_index(db_dir):
+        db = NumpyVectorStore.load(db_dir, embedding_function)
+    else:
+        db = Chroma(persist_directory=f"{db_dir}/chroma_db", embedding_function=embedding_function)
+
+    # two-level projects also search the raw chunk vectors (see utils/multivector_utils.py)
+    if chunk_level_enabled(db_dir):
+        db = MultiVectorStore([db, open_chunk_db(db_dir, embedding_function)])
     
     return db, docstore
 
@@ -86,21 +356,20 @@ def save_answer_and_sources(answer_path, query, answer, sources):
         for s in sources:
             f.write(f"* {s}\n")
 
-def get_prompt(query, db, docstore):
-    query_docs = db.similarity_search(query)
-    source_docs = [docstore[doc.metadata['doc_id']] for doc in query_docs]
-    
-    prompt = "You are an assistant for question-answering tasks. Use the following pieces of retrieved context to answer the question. If you don't know the answer, just say that you don't know.\
-    Question: {question}\
-    Context: {context}\
-    Answer:"
-    
-    context = " ".join([doc.page_content for doc in source_docs])
-    
-    prompt_template = PromptTemplate.from_template(prompt)
-    prompt = prompt_template.invoke({"question": query, "context": context})
-    
-    sources = [doc.metadata['source'] for doc in source_docs]
+def get_prompt(query, db, docstore, model = "gpt-4o-mini", metrics = None):
+    '''
+    metrics: optional dict, filled with `context_tokens` and `saved_tokens` as in `stream_query_chatbot`
+    '''
+    with span("get_prompt"):
+        source_docs = retrieve_source_docs(query, db, docstore)
+
+        prompt, context_docs, context_stats = build_prompt(query, source_docs, model)
+
+    if metrics is not None:
+        metrics["context_tokens"] = context_stats["tokens_after"]
+        metrics["saved_tokens"] = context_stats["saved_tokens"]
+
+    sources = [doc.metadata['source'] for doc in context_docs]
     
     return prompt.text, sources
 
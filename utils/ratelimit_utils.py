@@ -0,0 +1,135 @@
+'''
+Client-side rate limiting and retries for OpenAI calls
+
+`TokenBucketLimiter` keeps request and token throughput under a per-minute budget, and can be awaited from
+asyncio code or called from worker threads. `call_with_backoff` / `acall_with_backoff` retry calls that failed
+with a rate limit (429) or server (5xx) error, with exponential backoff and jitter.
+'''
+
+import asyncio
+import random
+import threading
+import time
+
+
+def estimate_tokens(text):
+    '''
+    rough token count (about 4 characters per token for English text), good enough for rate limiting
+    '''
+    return len(text) // 4 + 1
+
+
+class TokenBucketLimiter:
+
+    def __init__(self, requests_per_minute = 500, tokens_per_minute = 200000):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+
+        self._lock = threading.Lock()
+        self._requests = float(requests_per_minute)
+        self._tokens = float(tokens_per_minute)
+        self._last = time.monotonic()
+
+    def _reserve(self, tokens):
+        '''
+        takes one request and `tokens` tokens from the buckets if both have enough, and returns 0. Otherwise
+        returns how long to wait before trying again
+        '''
+        tokens = min(tokens, self.tokens_per_minute)
+
+        with self._lock:
+            now = time.monotonic()
+            elapsed = now - self._last
+            self._last = now
+            self._requests = min(self.requests_per_minute, self._requests + elapsed * self.requests_per_minute / 60)
+            self._tokens = min(self.tokens_per_minute, self._tokens + elapsed * self.tokens_per_minute / 60)
+
+            if self._requests >= 1 and self._tokens >= tokens:
+                self._requests -= 1
+                self._tokens -= tokens
+                return 0
+
+            request_wait = max(0, 1 - self._requests) * 60 / self.requests_per_minute
+            token_wait = max(0, tokens - self._tokens) * 60 / self.tokens_per_minute
+            return max(request_wait, token_wait)
+
+    async def acquire(self, tokens = 1):
+        while True:
+            wait = self._reserve(tokens)
+            if wait == 0:
+                return
+            await asyncio.sleep(wait)
+
+    def acquire_sync(self, tokens = 1):
+        while True:
+            wait = self._reserve(tokens)
+            if wait == 0:
+                return
+            time.sleep(wait)
+
+
+def is_retryable(exc):
+    '''
+    rate limit (429), server (5xx), timeout and connection errors are worth retrying
+    '''
+    status_code = getattr(exc, "status_code", None)
+    if status_code is None:
+        status_code = getattr(getattr(exc, "response", None), "status_code", None)
+
+    if status_code is not None:
+        return status_code == 429 or status_code >= 500
+
+    return type(exc).__name__ in ("RateLimitError", "APITimeoutError", "APIConnectionError", "InternalServerError")
+
+
+def backoff_delay(attempt, base_delay = 1.0, max_delay = 60.0):
+    '''
+    exponential backoff with full jitter
+    '''
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+async def acall_with_backoff(fn, *args, max_retries = 6, **kwargs):
+    for attempt in range(max_retries + 1):
+        try:
+            return await fn(*args, **kwargs)
+        except Exception as e:
+            if attempt == max_retries or not is_retryable(e):
+                raise
+            await asyncio.sleep(backoff_delay(attempt))
+
+
+def call_with_backoff(fn, *args, max_retries = 6, **kwargs):
+    for attempt in range(max_retries + 1):
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            if attempt == max_retries or not is_retryable(e):
+                raise
+            time.sleep(backoff_delay(attempt))
+
+
+def run_sync(coro):
+    '''
+    runs `coro` to completion from synchronous code, even if this thread already has a running event loop
+    '''
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+
+    result = {}
+
+    def runner():
+        try:
+            result["value"] = asyncio.run(coro)
+        except BaseException as e:
+            result["error"] = e
+
+    thread = threading.Thread(target=runner)
+    thread.start()
+    thread.join()
+
+    if "error" in result:
+        raise result["error"]
+    return result["value"]
@@ -0,0 +1,117 @@
+'''
+Cross-encoder re-ranking of retrieved chunks
+
+Vector and BM25 search rank chunks by comparing embeddings or terms; a cross-encoder reads the question and
+the chunk together and scores how well the chunk answers it. Retrieval then fetches a wider set of candidates
+(RERANK_CANDIDATES), the cross-encoder scores them, and only the best RERANK_KEEP go into the prompt.
+
+The model (cross-encoder/ms-marco-MiniLM-L-6-v2 by default, ~90MB) runs locally on the CPU. It is loaded once
+per process and pairs are scored in batches of similar length. Re-ranking is off unless GPRMAX_CHATBOT_RERANK
+is set (or `rerank=True` is passed to the retrieval functions), and needs `torch` and `transformers`.
+
+`compare_rerank` (utils/evaluation_utils.py) answers the same questions with and without re-ranking and reports
+BERTScore F1, retrieval and answer latency and context tokens for both. It has not been run on the shipped
+project yet, so there are no measured quality or latency numbers; re-ranking stays off by default until there
+are.
+'''
+
+import os
+import threading
+import numpy as np
+
+
+RERANK_MODEL = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+
+# chunks retrieved per query when re-ranking, and kept after it
+RERANK_CANDIDATES = 20
+RERANK_KEEP = 3
+
+BATCH_SIZE = 16
+MAX_LENGTH = 512
+
+
+def rerank_enabled():
+    return os.environ.get("GPRMAX_CHATBOT_RERANK", "") not in ("", "0")
+
+
+class CrossEncoderReranker:
+
+    def __init__(self, model_name = RERANK_MODEL, batch_size = BATCH_SIZE, max_length = MAX_LENGTH):
+        import torch
+        from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+        self._torch = torch
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.max_length = max_length
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.model = AutoModelForSequenceClassification.from_pretrained(model_name).to("cpu")
+        self.model.eval()
+
+        # one batch at a time: concurrent batches would only compete for the same CPU cores
+        self._lock = threading.Lock()
+
+    def score_pairs(self, pairs):
+        '''
+        pairs: list of (query, passage)
+
+        returns a numpy array with the relevance score of each pair (higher is more relevant)
+        '''
+        scores = np.zeros(len(pairs), dtype=np.float32)
+
+        # batches of similar length, so little time is spent on padding
+        order = np.argsort([len(query) + len(passage) for query, passage in pairs], kind="stable")
+
+        with self._lock, self._torch.inference_mode():
+            for i in range(0, len(order), self.batch_size):
+                batch = order[i:i + self.batch_size]
+                inputs = self.tokenizer(
+                    [pairs[j][0] for j in batch],
+                    [pairs[j][1] for j in batch],
+                    padding=True,
+                    truncation="only_second",
+                    max_length=self.max_length,
+                    return_tensors="pt",
+                )
+                logits = self.model(**inputs).logits
+                scores[batch] = logits[:, 0].float().numpy()
+
+        return scores
+
+    def rerank(self, query, docs, keep = RERANK_KEEP):
+        '''
+        the `keep` `Document`s of `docs` most relevant to `query`, best first
+        '''
+        return self.rerank_batch([query], [docs], keep)[0]
+
+    def rerank_batch(self, queries, docs_per_query, keep = RERANK_KEEP):
+        '''
+        `rerank` for several queries, scoring all their (query, chunk) pairs in the same batches
+        '''
+        pairs = [(query, doc.page_content) for query, docs in zip(queries, docs_per_query) for doc in docs]
+        scores = self.score_pairs(pairs)
+
+        reranked = []
+        start = 0
+        for docs in docs_per_query:
+            doc_scores = scores[start:start + len(docs)]
+            start += len(docs)
+            order = np.argsort(-doc_scores, kind="stable")[:keep]
+            reranked.append([docs[i] for i in order])
+
+        return reranked
+
+
+_rerankers = {}
+_rerankers_lock = threading.Lock()
+
+
+def get_reranker(model_name = RERANK_MODEL):
+    '''
+    returns the cross-encoder for `model_name`, loading it the first time only
+    '''
+    with _rerankers_lock:
+        if model_name not in _rerankers:
+            _rerankers[model_name] = CrossEncoderReranker(model_name)
+        return _rerankers[model_name]
@@ -0,0 +1,271 @@
+'''
+Process-wide registry of loaded project databases and OpenAI clients
+
+Streamlit re-executes the script on every interaction, so anything built inside `chat_func` and friends is
+thrown away after each message. The functions here keep one copy of each project's Chroma store and docstore
+(and of the OpenAI clients) per process, shared by every session, and reload a project only when its files
+on disk change.
+
+Several projects can be resident at once (e.g. the gprMax docs, forum archives and source code as separate
+stores). Their combined size is kept under a memory budget (GPRMAX_CHATBOT_MEMORY_BUDGET_MB, default 2048MB,
+or `set_memory_budget`) by evicting the least recently used projects, and `retrieve_across_projects` queries
+several of them in parallel and merges their rankings.
+'''
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from langchain_core.documents import Document
+from langchain_core.output_parsers import StrOutputParser
+from langchain_openai import ChatOpenAI
+from langchain_openai import OpenAIEmbeddings
+from utils.bm25_utils import reciprocal_rank_fusion
+from utils.query_utils import build_prompt, load_db, retrieve_source_docs
+from utils.embedding_utils import CachedEmbeddings
+from utils.summary_cache_utils import llm_name
+
+
+_registry_lock = threading.Lock()
+_load_locks = {}
+# least recently used first
+_retrievers = OrderedDict()
+_clients = {}
+
+_memory_budget = int(os.environ.get("GPRMAX_CHATBOT_MEMORY_BUDGET_MB", 2048)) * 1024 * 1024
+_stats = {"hits" : 0, "loads" : 0, "reloads" : 0, "evictions" : 0, "load_time_s" : 0.0}
+
+_fanout_executor = None
+
+
+class ProjectRetriever:
+    '''
+    A loaded project database: the Chroma store of summaries and the docstore of raw chunks
+    '''
+
+    def __init__(self, db_dir, db, docstore, stamp, load_time = 0.0):
+        self.db_dir = db_dir
+        self.db = db
+        self.docstore = docstore
+        self.stamp = stamp
+        self.load_time = load_time
+        self.last_used = time.time()
+
+    @property
+    def size(self):
+        '''
+        estimated memory footprint: the size of the project's files on disk
+        '''
+        return sum(file_size for _, _, file_size in self.stamp)
+
+
+def db_stamp(db_dir):
+    '''
+    returns a tuple of (path, mtime, size) for every file in `db_dir`, which changes whenever the database
+    is rebuilt or updated on disk
+    '''
+    stamp = []
+    for root, _, file_names in os.walk(db_dir):
+        for file_name in sorted(file_names):
+            path = os.path.join(root, file_name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                # file removed while we were walking, e.g. during an update
+                continue
+            stamp.append((os.path.relpath(path, db_dir), st.st_mtime_ns, st.st_size))
+
+    return tuple(sorted(stamp))
+
+
+def _api_key_id():
+    '''
+    short fingerprint of the current OpenAI API key, so clients built for one key are never reused for another
+    '''
+    api_key = os.environ.get("OPENAI_API_KEY", "")
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+
+def embedding_config(embedding_function):
+    '''
+    identifies an embedding function (class, model and API key) for the purpose of caching databases built on
+    top of it. Two equivalent clients map to the same key, so passing a freshly built `OpenAIEmbeddings()` still
+    hits the cache
+    '''
+    model = getattr(embedding_function, "model", None) or type(embedding_function).__name__
+    return (type(embedding_function).__name__, model, _api_key_id())
+
+
+def get_embedding_function(model = "text-embedding-ada-002"):
+    '''
+    returns a shared `OpenAIEmbeddings` client for `model` and the current API key, behind a `CachedEmbeddings`
+    so chunks and questions that were embedded before are not sent to OpenAI again
+    '''
+    key = ("embeddings", model, _api_key_id())
+    with _registry_lock:
+        if key not in _clients:
+            _clients[key] = CachedEmbeddings(OpenAIEmbeddings(model=model), model=model)
+        return _clients[key]
+
+
+def get_llm(model = "gpt-4o-mini"):
+    '''
+    returns a shared `ChatOpenAI` client for `model` and the current API key
+    '''
+    key = ("llm", model, _api_key_id())
+    with _registry_lock:
+        if key not in _clients:
+            _clients[key] = ChatOpenAI(model=model)
+        return _clients[key]
+
+
+def set_memory_budget(megabytes):
+    '''
+    sets the combined size of the projects kept loaded, evicting projects if they no longer fit
+    '''
+    global _memory_budget
+    with _registry_lock:
+        _memory_budget = int(megabytes * 1024 * 1024)
+        _evict_over_budget()
+
+
+def _evict_over_budget(keep = None):
+    '''
+    drops least recently used projects until the loaded ones fit in the memory budget. `keep` (the project
+    just loaded) is never evicted. Must be called with `_registry_lock` held
+    '''
+    total = sum(retriever.size for retriever in _retrievers.values())
+    for key in list(_retrievers):
+        if total <= _memory_budget:
+            break
+        if key == keep:
+            continue
+        # sessions (or fanout threads) still holding the retriever keep using it; it is freed once they let go
+        total -= _retrievers.pop(key).size
+        _stats["evictions"] += 1
+        print(f"Evicted project {key[0]} from memory")
+
+
+def get_retriever(db_dir, embedding_function):
+    '''
+    returns the `ProjectRetriever` for `db_dir`, loading it only if it is not already loaded in this process
+    or if the database files have changed since it was loaded
+
+    safe to call from several threads (Streamlit sessions) at once: a project is only ever loaded by one of them
+    '''
+    key = (os.path.abspath(db_dir), embedding_config(embedding_function))
+
+    with _registry_lock:
+        load_lock = _load_locks.setdefault(key, threading.Lock())
+
+    with load_lock:
+        with _registry_lock:
+            retriever = _retrievers.get(key)
+
+        if retriever is not None and retriever.stamp == db_stamp(db_dir):
+            with _registry_lock:
+                if key in _retrievers:
+                    _retrievers.move_to_end(key)
+                _stats["hits"] += 1
+            retriever.last_used = time.time()
+            return retriever
+
+        start = time.perf_counter()
+        db, docstore = load_db(db_dir, embedding_function)
+        # stamped after loading, as loading may itself write to `db_dir` (e.g. migrating pickles)
+        retriever = ProjectRetriever(db_dir, db, docstore, db_stamp(db_dir), load_time = time.perf_counter() - start)
+
+        with _registry_lock:
+            # sessions still holding the superseded retriever keep using it; its chunk store is unmapped once
+            # they let go
+            _stats["reloads" if key in _retrievers else "loads"] += 1
+            _stats["load_time_s"] += retriever.load_time
+            _retrievers[key] = retriever
+            _retrievers.move_to_end(key)
+            _evict_over_budget(keep = key)
+
+    return retriever
+
+
+def invalidate_retrievers(db_dir = None):
+    '''
+    drop loaded retrievers for `db_dir` (or all of them), forcing a reload on next use
+    '''
+    with _registry_lock:
+        for key in list(_retrievers):
+            if db_dir is None or key[0] == os.path.abspath(db_dir):
+                del _retrievers[key]
+
+
+def retriever_stats():
+    '''
+    load/hit/eviction counters, and the projects currently loaded (least recently used first)
+    '''
+    with _registry_lock:
+        stats = dict(_stats)
+        stats["memory_budget_mb"] = _memory_budget / (1024 * 1024)
+        stats["resident_mb"] = sum(retriever.size for retriever in _retrievers.values()) / (1024 * 1024)
+        stats["projects"] = [{
+            "db_dir" : retriever.db_dir,
+            "size_mb" : retriever.size / (1024 * 1024),
+            "load_time_s" : retriever.load_time,
+            "last_used" : retriever.last_used,
+        } for retriever in _retrievers.values()]
+    return stats
+
+
+def _get_fanout_executor():
+    global _fanout_executor
+    with _registry_lock:
+        if _fanout_executor is None:
+            _fanout_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="project-fanout")
+        return _fanout_executor
+
+
+def retrieve_across_projects(query, db_dirs, embedding_function, k = 4):
+    '''
+    retrieves from every project in `db_dirs` in parallel and merges their rankings by reciprocal rank fusion
+
+    the query is embedded once and reused for every project. Returns the best `k` chunks overall, each with a
+    `project` metadata entry naming the db directory it came from, and its source prefixed by the project name
+    '''
+    query_vector = embedding_function.embed_query(query)
+
+    def retrieve(db_dir):
+        retriever = get_retriever(db_dir, embedding_function)
+        return retrieve_source_docs(query, retriever.db, retriever.docstore, k = k, query_vector = query_vector)
+
+    results = list(_get_fanout_executor().map(retrieve, db_dirs))
+
+    docs = {}
+    rankings = []
+    for db_dir, source_docs in zip(db_dirs, results):
+        ranking = []
+        for i, doc in enumerate(source_docs):
+            source = f"{project_name(db_dir)}: {doc.metadata['source']}"
+            docs[(db_dir, i)] = Document(page_content=doc.page_content, metadata={**doc.metadata, 'source' : source, 'project' : db_dir})
+            ranking.append((db_dir, i))
+        rankings.append(ranking)
+
+    return [docs[key] for key in reciprocal_rank_fusion(rankings)[:k]]
+
+
+def project_name(db_dir):
+    '''
+    "af6c69d5" for "dbs/af6c69d5/db"
+    '''
+    return os.path.basename(os.path.dirname(os.path.abspath(db_dir)))
+
+
+def query_projects_chatbot(query, db_dirs, embedding_function, llm, k = 4):
+    '''
+    `query_chatbot` over several projects at once. Returns (answer, sources), sources prefixed by their project
+    '''
+    source_docs = retrieve_across_projects(query, db_dirs, embedding_function, k = k)
+
+    prompt, context_docs, _ = build_prompt(query, source_docs, llm_name(llm))
+    answer = (llm | StrOutputParser()).invoke(prompt)
+
+    return answer, [doc.metadata['source'] for doc in context_docs]
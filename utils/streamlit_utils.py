@@ -5,7 +5,10 @@ from langchain_openai import ChatOpenAI
 from langchain_openai import OpenAIEmbeddings
 import streamlit as st
 import os
-from utils.query_utils import load_db, query_chatbot
+from utils.query_utils import query_chatbot, stream_answer, stream_query_chatbot
+from utils.retriever_utils import get_retriever, get_embedding_function, get_llm, retrieve_across_projects, retriever_stats
+from utils.chunkstore_utils import chunk_store_exists
+from utils.answer_cache_utils import answer_cacheable, cached_query_chatbot, get_answer_cache
 from utils.db_utils import add_data_to_db, data_to_db, add_uploaded_files_to_db, uploaded_files_to_db
 from utils.doc_utils import uploaded_files_to_doc
 from utils.evaluation_utils import evaluate_bertscore
@@ -68,7 +71,7 @@ def generate_qna_streamlit(contents_directory):
 
     contents = load_contents(contents_directory)
 
-    llm = ChatOpenAI(model="gpt-4o-mini")
+    llm = get_llm("gpt-4o-mini")
 
     qnas = generate_qna(contents, llm)
     qa_pairs = process_text(qnas)
@@ -129,6 +132,11 @@ def build_update_base(database_operation):
     else:
         st.session_state["db_project"] = st.text_input("Name of project")
 
+    # "Chroma only" skips the NumPy vector index; on update it keeps the project's current setting
+    st.session_state["db_compression"] = st.selectbox("Vector index compression", ["Chroma only", "float32", "int8", "pq"], key="db_compression_select")
+    if st.session_state["db_type"] == "Build new":
+        st.session_state["db_index_chunks"] = st.checkbox("Also index raw chunks (two-level retrieval)", key="db_index_chunks_checkbox")
+
     root_dir = f"dbs/{st.session_state['db_project']}"
 
     if st.session_state["db_type"] == "Update existing":
@@ -144,6 +152,8 @@ def build_update_base(database_operation):
                 cleanup_uploaded_files(temp_data_dir)
             write_uploaded_files_to_disk(st.session_state["uploaded_files"], temp_data_dir)
 
+            compression = None if st.session_state["db_compression"] == "Chroma only" else st.session_state["db_compression"]
+
             if st.session_state["db_type"] == "Update existing":
                 with st.spinner("Updating database..."):
                     # add_uploaded_files_to_db(
@@ -154,9 +164,10 @@ def build_update_base(database_operation):
                     # )
                     add_data_to_db(
                         db_dir=f"{root_dir}/db",
-                        embedding_function=OpenAIEmbeddings(),
+                        embedding_function=get_embedding_function(),
                         new_data_directory=temp_data_dir,
-                        llm=ChatOpenAI(model="gpt-4o-mini")
+                        llm=get_llm("gpt-4o-mini"),
+                        compression=compression
                     )
                 st.success("Database updated!")
             else:
@@ -168,14 +179,22 @@ def build_update_base(database_operation):
                     #     save_dir = f"{root_dir}/db"
                     # )
 
-                    data_to_db(
-                        new_data_directory=temp_data_dir,
-                        embedding_function=OpenAIEmbeddings(),
-                        llm=ChatOpenAI(model="gpt-4o-mini"),
-                        save_dir=f"{root_dir}/db"
-                    )
-
-                st.success("Database created!")
+                    try:
+                        data_to_db(
+                            new_data_directory=temp_data_dir,
+                            embedding_function=get_embedding_function(),
+                            llm=get_llm("gpt-4o-mini"),
+                            save_dir=f"{root_dir}/db",
+                            compression=compression,
+                            index_chunks=st.session_state["db_index_chunks"]
+                        )
+                        created = True
+                    except FileExistsError as e:
+                        st.error(f"{e}. Choose \"Update existing\" or another project name")
+                        created = False
+
+                if created:
+                    st.success("Database created!")
 
             # clean up temp storage
             cleanup_uploaded_files(temp_data_dir)
@@ -210,6 +229,7 @@ def eval_func():
 
     st.session_state["eval_uploaded_files"] = st.file_uploader("Upload files to evaluate database", accept_multiple_files=True)
     st.session_state["eval_number"] = st.text_input("How many evaluation data points to use. Higher yields more accurate results but will take longer and use more API requests. Leave blank to use all available data")
+    st.session_state["eval_rerank"] = st.checkbox("Re-rank retrieved chunks with a local cross-encoder", key="eval_rerank_checkbox")
 
     if st.button("Go!", key="5"):
         if st.session_state["openai_api_key"] == "":
@@ -222,14 +242,14 @@ def eval_func():
             st.error(f"Could not find database (expected at `dbs/{st.session_state['query_project']}/db`)")
             st.stop()
 
-        if not os.path.exists(f"dbs/{st.session_state['query_project']}/db/chroma_db") or not os.path.exists(f"dbs/{st.session_state['query_project']}/db/docstore.pkl") or not os.path.exists(f"dbs/{st.session_state['query_project']}/db/document_data.pkl"):
+        eval_db_dir = f"dbs/{st.session_state['query_project']}/db"
+        has_chunks = chunk_store_exists(eval_db_dir) or os.path.exists(f"{eval_db_dir}/docstore.pkl")
+        if not os.path.exists(f"{eval_db_dir}/chroma_db") or not has_chunks:
             st.error("Database missing files:")
-            if not os.path.exists(f"dbs/{st.session_state['query_project']}/db/chroma_db"):
-                st.error(f"missing directory `dbs/{st.session_state['query_project']}/db/chroma_db`")
-            if not os.path.exists(f"dbs/{st.session_state['query_project']}/db/docstore.pkl"):
-                st.error(f"missing file `dbs/{st.session_state['query_project']}/db/docstore.pkl`")
-            if not os.path.exists(f"dbs/{st.session_state['query_project']}/db/document_data.pkl"):
-                st.error(f"missing file `dbs/{st.session_state['query_project']}/db/document_data.pkl`")
+            if not os.path.exists(f"{eval_db_dir}/chroma_db"):
+                st.error(f"missing directory `{eval_db_dir}/chroma_db`")
+            if not has_chunks:
+                st.error(f"missing chunk store `{eval_db_dir}/chunks.idx` (or legacy `{eval_db_dir}/docstore.pkl`)")
             st.stop()
 
         with st.spinner("Generating evaluation dataset"):
@@ -238,28 +258,36 @@ def eval_func():
                 cleanup_uploaded_files(temp_eval_data_dir)
             write_uploaded_files_to_disk(st.session_state["eval_uploaded_files"], temp_eval_data_dir)
 
-            embedding_function = OpenAIEmbeddings()
-            llm = ChatOpenAI(model="gpt-4o-mini")
-
             qa_pairs = generate_qna_streamlit(temp_eval_data_dir)
             cleanup_uploaded_files(temp_eval_data_dir)
 
         with st.spinner("Evaluating"):
-            embedding_function = OpenAIEmbeddings()
-            llm = ChatOpenAI(model="gpt-4o-mini")
+            embedding_function = get_embedding_function()
+            llm = get_llm("gpt-4o-mini")
 
-            db, docstore = load_db(f"dbs/{st.session_state['query_project']}/db", embedding_function)
+            retriever = get_retriever(f"dbs/{st.session_state['query_project']}/db", embedding_function)
+            db, docstore = retriever.db, retriever.docstore
 
             if st.session_state["eval_number"] == "":
                 n = len(qa_pairs)
             else:
                 n = int(st.session_state["eval_number"])
 
-            bertscores_dict = evaluate_bertscore(db, docstore, llm, qa_pairs=qa_pairs, n=n)
+            bertscores_dict = evaluate_bertscore(db, docstore, llm, qa_pairs=qa_pairs, n=n, rerank=st.session_state["eval_rerank"])
 
             # print_bertscores(bertscores_dict)
             visualise_bertscores(bertscores_dict)
 
+            # answers restored from older checkpoints have no latencies or context token counts
+            latency = bertscores_dict["latency"]
+            if latency is not None:
+                st.write(f"Answer latency: p50 = {latency['p50']:.2f}s, p95 = {latency['p95']:.2f}s, max = {latency['max']:.2f}s")
+            retrieval_latency = bertscores_dict["retrieval_latency"]
+            if retrieval_latency is not None:
+                st.write(f"Retrieval latency per question: p50 = {retrieval_latency['p50'] * 1000:.0f}ms, p95 = {retrieval_latency['p95'] * 1000:.0f}ms")
+            if bertscores_dict["context_tokens"] is not None:
+                st.write(f"Context tokens per prompt: {bertscores_dict['context_tokens']:.0f}")
+
 
 def query_func():
     # os.environ["OPENAI_API_KEY"] = st.session_state["openai_api_key"]
@@ -292,8 +320,8 @@ def query_func():
             st.stop()
 
         with st.spinner("Running"):
-            embedding_function = OpenAIEmbeddings()
-            llm = ChatOpenAI(model="gpt-4o-mini")
+            embedding_function = get_embedding_function()
+            llm = get_llm("gpt-4o-mini")
 
             root_dir = f"dbs/{st.session_state['query_project']}"
             db_dir = f"{root_dir}/db"
@@ -309,10 +337,11 @@ def query_func():
             answer_path = f"{root_dir}/answers/{str(uuid.uuid4())}.md"
             os.makedirs(f"{root_dir}/answers", exist_ok=True)
 
-            db, docstore = load_db(db_dir, embedding_function)
+            retriever = get_retriever(db_dir, embedding_function)
+            db, docstore = retriever.db, retriever.docstore
 
             try:
-                answer, sources = query_chatbot(st.session_state["query"], db, docstore, llm)
+                answer, sources = cached_query_chatbot(st.session_state["query"], db, docstore, llm, db_dir, "gpt-4o-mini")
             except:
                 st.error("Unable to generate answer. Please check OpenAI API key, or try again later")
                 st.stop()
@@ -333,7 +362,13 @@ def chat_func():
     with st.sidebar:
         chat_model = st.selectbox("Select a model", ["gpt-4o-mini", "gpt-4o"])
 
-        st.session_state["query_project"] = "af6c69d5"
+        # the gprMax docs project by default; pick several to query them together
+        default_projects = [p for p in ["af6c69d5"] if p in st.session_state["available_projects"]]
+        chat_projects = st.multiselect("Select projects", st.session_state["available_projects"], default=default_projects, key="chat_projects")
+
+        with st.expander("Loaded projects"):
+            stats = retriever_stats()
+            st.write(f"{len(stats['projects'])} loaded ({stats['resident_mb']:.0f}MB of {stats['memory_budget_mb']:.0f}MB), {stats['loads']} loads, {stats['reloads']} reloads, {stats['evictions']} evictions")
 
     for msg in history.messages:
         avatar = AI_AVATAR if msg.type == "ai" else None
@@ -353,8 +388,8 @@ def chat_func():
         elif not chat_model:
             st.error("Please specify a chat model")
             st.stop()
-        elif st.session_state["query_project"] == "":
-            st.error("Please enter a project")
+        elif not chat_projects:
+            st.error("Please select a project")
             st.stop()
         elif streamlit_prompt == "":
             st.error("Please enter a query")
@@ -364,34 +399,87 @@ def chat_func():
             st.write(streamlit_prompt)
         history.add_user_message(streamlit_prompt)
 
-        embedding_function = OpenAIEmbeddings()
-        llm = ChatOpenAI(model=chat_model)
+        embedding_function = get_embedding_function()
+        llm = get_llm(chat_model)
 
-        root_dir = f"dbs/{st.session_state['query_project']}"
-        db_dir = f"{root_dir}/db"
+        db_dirs = []
+        for project in chat_projects:
+            root_dir = f"dbs/{project}"
+            db_dir = f"{root_dir}/db"
 
-        # check if db exists
-        if not os.path.exists(root_dir):
-            st.error(f"Project does not exist, or is in the incorrect location. Make sure that the project exists and has path `{root_dir}`")
-            st.stop()
-        elif not os.path.exists(db_dir):
-            st.error(f"Database does not exist, or is in the incorrect location. Make sure that the database exists and has path `{db_dir}`")
-            st.stop()
+            # check if db exists
+            if not os.path.exists(root_dir):
+                st.error(f"Project does not exist, or is in the incorrect location. Make sure that the project exists and has path `{root_dir}`")
+                st.stop()
+            elif not os.path.exists(db_dir):
+                st.error(f"Database does not exist, or is in the incorrect location. Make sure that the database exists and has path `{db_dir}`")
+                st.stop()
 
-        answer_path = f"{root_dir}/answers/{str(uuid.uuid4())}.md"
-        os.makedirs(f"{root_dir}/answers", exist_ok=True)
+            db_dirs.append(db_dir)
 
-        db, docstore = load_db(db_dir, embedding_function)
+        answer_cache = get_answer_cache()
+        cached = None
+        # answers are cached per project, so only single project chats use the cache
+        use_answer_cache = len(db_dirs) == 1 and answer_cacheable(streamlit_prompt)
+        if use_answer_cache:
+            query_vector = embedding_function.embed_query(streamlit_prompt)
+            cached = answer_cache.lookup(query_vector, db_dir, chat_model)
 
-        answer, sources = query_chatbot(streamlit_prompt, db, docstore, llm)
+        if cached is not None:
+            answer, sources = cached
 
-        with st.chat_message("assistant", avatar=AI_AVATAR):
-            st.write(answer)
-        history.add_ai_message(answer)
+            with st.expander("See sources"):
+                for s in set(sources):
+                    st.write(f"- {s}")
+
+            with st.chat_message("assistant", avatar=AI_AVATAR):
+                st.write(answer)
+            history.add_ai_message(answer)
+        elif len(db_dirs) == 1 or not answer_cacheable(streamlit_prompt):
+            # input file generation does not depend on the project
+            retriever = get_retriever(db_dirs[0], embedding_function)
+
+            metrics = {}
+            tokens, sources = stream_query_chatbot(streamlit_prompt, retriever.db, retriever.docstore, llm, metrics=metrics)
+
+            # retrieval is done, show the sources while the answer is generated
+            with st.expander("See sources"):
+                for s in set(sources):
+                    st.write(f"- {s}")
+
+            with st.chat_message("assistant", avatar=AI_AVATAR):
+                answer = st.write_stream(tokens)
+            history.add_ai_message(answer)
+
+            record_chat_latency(metrics)
 
-        with st.expander("See sources"):
-            for s in set(sources):
-                st.write(f"- {s}")
+            if use_answer_cache:
+                answer_cache.store(query_vector, streamlit_prompt, answer, sources, db_dir, chat_model)
+        else:
+            # query every selected project in parallel and answer from the merged results
+            metrics = {}
+            start = time.perf_counter()
+            source_docs = retrieve_across_projects(streamlit_prompt, db_dirs, embedding_function)
+            tokens, sources = stream_answer(streamlit_prompt, source_docs, llm, metrics=metrics, start=start)
+
+            with st.expander("See sources"):
+                for s in set(sources):
+                    st.write(f"- {s}")
+
+            with st.chat_message("assistant", avatar=AI_AVATAR):
+                answer = st.write_stream(tokens)
+            history.add_ai_message(answer)
+
+            record_chat_latency(metrics)
+
+
+def record_chat_latency(metrics):
+    '''
+    keeps the latency of each chat answer (retrieval, time to first token, total) and its context size in the
+    session, and logs it
+    '''
+    st.session_state.setdefault("chat_latencies", []).append(metrics)
+    print(f"chat latency: retrieval {metrics.get('retrieval_time', 0):.3f}s, first token {metrics.get('time_to_first_token', 0):.3f}s, total {metrics.get('total_time', 0):.3f}s, context {metrics.get('context_tokens', 0)} tokens ({metrics.get('saved_tokens', 0)} saved)")
 
 
 def finetune_func():
@@ -506,11 +594,10 @@ def main():
     query = st.text_area("Enter your query:")
 
     if st.button("Submit"):
-        db_dir = "path_to_your_db"  # Set the correct database path
-        embedding_function = None  # Replace with actual embedding function
-        db, docstore = load_db(db_dir, embedding_function)
+        db_dir = "dbs/af6c69d5/db"
+        retriever = get_retriever(db_dir, get_embedding_function())
 
-        answer, sources = query_chatbot(query, db, docstore, None)
+        answer, sources = query_chatbot(query, retriever.db, retriever.docstore, get_llm("gpt-4o-mini"))
 
         if answer.endswith(".in"):
             st.success("Input file generated!")
@@ -0,0 +1,129 @@
+'''
+Persistent cache of chunk summaries, so rebuilding a project (or building one from overlapping documents)
+only pays for summaries that were never generated before
+
+Summaries are stored in a local SQLite file, keyed by (hash of the chunk text, summary prompt version, model
+name). The least recently used entries are evicted once the cache holds more than `max_entries` summaries.
+'''
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+
+DEFAULT_CACHE_PATH = "cache/summaries.sqlite"
+DEFAULT_MAX_ENTRIES = 200000
+
+
+def llm_name(llm):
+    '''
+    best-effort name of the model behind `llm`, used as part of cache keys
+    '''
+    return getattr(llm, "model_name", None) or getattr(llm, "model", None) or type(llm).__name__
+
+
+class SummaryCache:
+
+    def __init__(self, path = DEFAULT_CACHE_PATH, max_entries = DEFAULT_MAX_ENTRIES):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS summaries (key TEXT PRIMARY KEY, summary TEXT NOT NULL, last_used REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS summaries_last_used ON summaries (last_used)")
+
+    @staticmethod
+    def key(text, prompt_version, model):
+        text_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        return f"{text_hash}:{prompt_version}:{model}"
+
+    def get_many(self, texts, prompt_version, model):
+        '''
+        returns a list with the cached summary of each text, or None where there is none
+        '''
+        keys = [self.key(text, prompt_version, model) for text in texts]
+        found = {}
+
+        with self._lock:
+            for i in range(0, len(keys), 500):
+                batch = keys[i:i+500]
+                rows = self._conn.execute(
+                    f"SELECT key, summary FROM summaries WHERE key IN ({','.join('?' * len(batch))})", batch
+                ).fetchall()
+                found.update(rows)
+
+            if found:
+                with self._conn:
+                    self._conn.executemany(
+                        "UPDATE summaries SET last_used = ? WHERE key = ?", [(time.time(), k) for k in found]
+                    )
+
+        summaries = [found.get(k) for k in keys]
+        hits = sum(summary is not None for summary in summaries)
+        self.hits += hits
+        self.misses += len(summaries) - hits
+
+        return summaries
+
+    def put_many(self, texts, summaries, prompt_version, model):
+        now = time.time()
+        rows = [(self.key(text, prompt_version, model), summary, now) for text, summary in zip(texts, summaries)]
+
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO summaries (key, summary, last_used) VALUES (?, ?, ?)", rows)
+
+        self.evict()
+
+    def evict(self):
+        '''
+        drop the least recently used summaries beyond `max_entries`
+        '''
+        with self._lock, self._conn:
+            count = self._conn.execute("SELECT COUNT(*) FROM summaries").fetchone()[0]
+            if count > self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM summaries WHERE key IN (SELECT key FROM summaries ORDER BY last_used ASC LIMIT ?)",
+                    (count - self.max_entries,)
+                )
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits" : self.hits,
+            "misses" : self.misses,
+            "hit_rate" : self.hits / total if total else 0.0,
+        }
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def report(self):
+        stats = self.stats()
+        print(f"Summary cache: {stats['hits']} hits, {stats['misses']} misses ({100 * stats['hit_rate']:.1f}% hit rate)")
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_summary_cache():
+    '''
+    returns the process-wide summary cache at `DEFAULT_CACHE_PATH`
+    '''
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = SummaryCache()
+        return _default_cache
@@ -0,0 +1,434 @@
+'''
+NumPy vector index: a project's summary embeddings exported from Chroma to plain `.npy` files
+
+For a project of a few thousand chunks a brute-force search over one float32 matrix is faster than Chroma's
+HNSW index, and opening it costs no client startup: the vectors are memory-mapped and searched with one matrix
+product and `argpartition`. The files live in the db directory next to `chroma_db`:
+
+    vectors.npy         - float32 matrix, one summary embedding per row (normalized if the collection is cosine)
+    doc_ids.npy         - the doc_id of each row
+    codes.npy           - the compressed vectors, if the index is compressed
+    quantizer.npz       - the parameters needed to score the codes
+    vector_index.json   - {"backend", "metric", "compression", "rerank", "count", "dimension", "chunks_idx_size"}
+
+`backend` selects what `load_db` opens for the project: "numpy" (set on export) or "chroma". Chroma stays the
+source of truth for updates; `update_db_with_docs` re-exports the index of projects using it, and an index
+older than the chunk store is ignored in favour of Chroma.
+
+`compression` is "float32" (no compression), "int8" or "pq" (see `utils/quantization_utils.py`). A compressed
+index searches the codes; with `rerank` the best `RERANK_FACTOR * k` candidates are re-scored against
+vectors.npy, which stays on disk and is memory-mapped so only the candidates' rows are read. Without `rerank`
+vectors.npy is not written at all.
+
+use command:
+
+python -m utils.vector_index_utils export {db_dir} [--compression float32|int8|pq] [--no-rerank]
+python -m utils.vector_index_utils select {db_dir} {chroma|numpy}
+'''
+
+import argparse
+import json
+import os
+import numpy as np
+from langchain_core.documents import Document
+from utils.chunkstore_utils import INDEX_FILE
+from utils.quantization_utils import DEFAULT_PQ_SUBVECTORS, build_quantizer, load_quantizer
+
+
+VECTORS_FILE = "vectors.npy"
+DOC_IDS_FILE = "doc_ids.npy"
+CODES_FILE = "codes.npy"
+QUANTIZER_FILE = "quantizer.npz"
+INDEX_CONFIG_FILE = "vector_index.json"
+
+BACKENDS = ["chroma", "numpy"]
+COMPRESSIONS = ["float32", "int8", "pq"]
+
+# candidates re-scored at full precision per result kept, when a compressed index is reranked
+RERANK_FACTOR = 10
+
+
+def similarity_scores(query_vectors, vectors, metric = "l2", squared_norms = None):
+    '''
+    similarity of each query vector to each row of `vectors` under `metric` (Chroma's "l2", "cosine" or "ip"),
+    higher is better. One matrix product for all the queries
+
+    squared_norms: the squared norm of each row of `vectors`, if already computed (used by "l2")
+
+    returns an array of shape (n_queries, n_rows)
+    '''
+    query_vectors = np.asarray(query_vectors, dtype=np.float32)
+
+    if metric == "cosine":
+        query_vectors = query_vectors / (np.linalg.norm(query_vectors, axis=1, keepdims=True) + 1e-12)
+        return query_vectors @ (vectors / (np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12)).T
+    if metric == "ip":
+        return query_vectors @ vectors.T
+
+    # ranking by -|q - x|^2 = 2 q.x - |x|^2 - |q|^2, and |q|^2 is the same for every row
+    if squared_norms is None:
+        squared_norms = np.einsum("ij,ij->i", vectors, vectors)
+    return 2 * (query_vectors @ vectors.T) - squared_norms[None, :]
+
+
+def top_k_scores(scores, k):
+    '''
+    column indices of the `k` highest scores of each row, best first. returns an array of shape (n_rows, k)
+    '''
+    k = min(k, scores.shape[1])
+    if k == 0:
+        return np.zeros((len(scores), 0), dtype=np.int64)
+
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1)
+    return np.take_along_axis(top, order, axis=1)
+
+
+def top_k_similar(query_vectors, vectors, k, metric = "l2", squared_norms = None):
+    '''
+    indices of the `k` rows of `vectors` closest to each query vector under `metric`, best first
+
+    returns an array of shape (n_queries, k)
+    '''
+    if len(vectors) == 0:
+        return np.zeros((len(query_vectors), 0), dtype=np.int64)
+
+    return top_k_scores(similarity_scores(query_vectors, vectors, metric, squared_norms), k)
+
+
+def chroma_vectors(db):
+    '''
+    every summary vector of the Chroma `db` as one float32 matrix, with the doc_id of each row and the distance
+    metric of the collection
+
+    returns (doc_ids, vectors, metric)
+    '''
+    data = db.get(include=["embeddings", "metadatas"])
+    doc_ids = [metadata['doc_id'] for metadata in data["metadatas"]]
+    if doc_ids:
+        vectors = np.asarray(data["embeddings"], dtype=np.float32).reshape(len(doc_ids), -1)
+    else:
+        vectors = np.zeros((0, 0), dtype=np.float32)
+    metric = (db._collection.metadata or {}).get("hnsw:space", "l2")
+
+    return doc_ids, vectors, metric
+
+
+def _chunk_index_size(db_dir):
+    try:
+        return os.path.getsize(f"{db_dir}/{INDEX_FILE}")
+    except FileNotFoundError:
+        return None
+
+
+def load_index_config(db_dir):
+    '''
+    the project's `vector_index.json`, or None if it was never exported
+    '''
+    if not os.path.exists(f"{db_dir}/{INDEX_CONFIG_FILE}"):
+        return None
+
+    with open(f"{db_dir}/{INDEX_CONFIG_FILE}", "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_index_config(config, db_dir):
+    with open(f"{db_dir}/{INDEX_CONFIG_FILE}.tmp", "w", encoding="utf-8") as f:
+        json.dump(config, f, indent=1)
+    os.replace(f"{db_dir}/{INDEX_CONFIG_FILE}.tmp", f"{db_dir}/{INDEX_CONFIG_FILE}")
+
+
+def vector_index_fresh(db_dir, config = None):
+    '''
+    whether the exported index matches the project's current chunk store
+    '''
+    if config is None:
+        config = load_index_config(db_dir)
+
+    if config is None or config.get("chunks_idx_size") != _chunk_index_size(db_dir):
+        return False
+
+    return all(os.path.exists(f"{db_dir}/{file_name}") for file_name in _index_files(config))
+
+
+def _index_files(config):
+    '''
+    the files an index with `config` is made of
+    '''
+    files = [DOC_IDS_FILE]
+    if config.get("compression", "float32") == "float32" or config.get("rerank"):
+        files.append(VECTORS_FILE)
+    if config.get("compression", "float32") != "float32":
+        files += [CODES_FILE, QUANTIZER_FILE]
+    return files
+
+
+def use_vector_index(db_dir):
+    '''
+    whether `load_db` should open the NumPy index of `db_dir` instead of Chroma
+    '''
+    config = load_index_config(db_dir)
+    if config is None or config.get("backend") != "numpy":
+        return False
+
+    if not vector_index_fresh(db_dir, config):
+        print(f"Vector index of {db_dir} is out of date, using Chroma. Run `python -m utils.vector_index_utils export {db_dir}` to refresh it")
+        return False
+
+    return True
+
+
+def build_vector_store(doc_ids, vectors, metric, embedding_function, compression = "float32", rerank = True,
+                       pq_subvectors = DEFAULT_PQ_SUBVECTORS):
+    '''
+    an in-memory `NumpyVectorStore` of `vectors`, compressed with `compression`
+    '''
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unknown compression {compression}, expected one of {COMPRESSIONS}")
+
+    # cosine collections are stored normalized, so searching them is a plain inner product
+    if metric == "cosine":
+        vectors = vectors / (np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12)
+        metric = "ip"
+
+    if compression == "float32":
+        return NumpyVectorStore(doc_ids, vectors, metric, embedding_function)
+
+    quantizer = build_quantizer(compression, vectors, pq_subvectors = pq_subvectors)
+    return NumpyVectorStore(
+        doc_ids,
+        vectors if rerank else None,
+        metric,
+        embedding_function,
+        codes = quantizer.encode(vectors),
+        quantizer = quantizer,
+    )
+
+
+def _save_array(array, path):
+    # written under a temporary name and swapped in, so a reader never sees half a file
+    with open(f"{path}.tmp", "wb") as f:
+        np.save(f, array)
+    os.replace(f"{path}.tmp", path)
+
+
+def export_vector_index(db, db_dir, backend = None, compression = None, rerank = None, pq_subvectors = None):
+    '''
+    writes the summary vectors of the Chroma `db` to `db_dir` as `.npy` files
+
+    backend: the backend `load_db` should use from now on; by default "numpy", or the project's current choice
+    if it was exported before
+    compression, rerank, pq_subvectors: how the vectors are stored (see the module docstring); by default as
+    in the previous export, or uncompressed
+    '''
+    config = load_index_config(db_dir) or {}
+    backend = backend or config.get("backend", "numpy")
+    if rerank is None:
+        # a new compression starts with rerank on
+        rerank = config.get("rerank", True) if compression in (None, config.get("compression")) else True
+    compression = compression or config.get("compression", "float32")
+    pq_subvectors = pq_subvectors or config.get("pq_subvectors", DEFAULT_PQ_SUBVECTORS)
+
+    store = build_vector_store(*chroma_vectors(db), None, compression = compression, rerank = rerank, pq_subvectors = pq_subvectors)
+
+    new_config = {
+        "backend" : backend,
+        "metric" : store.metric,
+        "compression" : compression,
+        "rerank" : rerank,
+        "count" : len(store),
+        "dimension" : store.dimension,
+        "chunks_idx_size" : _chunk_index_size(db_dir),
+    }
+    if compression == "pq":
+        new_config["pq_subvectors"] = store.quantizer.n_subvectors
+
+    _save_array(np.asarray(store.doc_ids, dtype=str), f"{db_dir}/{DOC_IDS_FILE}")
+    if store.vectors is not None:
+        _save_array(store.vectors, f"{db_dir}/{VECTORS_FILE}")
+    if store.quantizer is not None:
+        _save_array(store.codes, f"{db_dir}/{CODES_FILE}")
+        with open(f"{db_dir}/{QUANTIZER_FILE}.tmp", "wb") as f:
+            np.savez(f, **store.quantizer.params())
+        os.replace(f"{db_dir}/{QUANTIZER_FILE}.tmp", f"{db_dir}/{QUANTIZER_FILE}")
+
+    save_index_config(new_config, db_dir)
+
+    # files of a previous export that this one does not use, removed only once no config refers to them
+    for file_name in [VECTORS_FILE, CODES_FILE, QUANTIZER_FILE]:
+        if file_name not in _index_files(new_config) and os.path.exists(f"{db_dir}/{file_name}"):
+            os.remove(f"{db_dir}/{file_name}")
+
+    print(f"Exported {len(store)} vectors of {db_dir} ({compression}, {store.nbytes / 1024 / 1024:.1f}MB in memory)")
+
+
+def select_backend(db_dir, backend):
+    '''
+    sets whether `load_db` opens the NumPy index ("numpy") or Chroma ("chroma") for `db_dir`
+    '''
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend}, expected one of {BACKENDS}")
+
+    config = load_index_config(db_dir)
+    if config is None:
+        if backend == "chroma":
+            return
+        raise FileNotFoundError(f"{db_dir} has no vector index, export it first")
+
+    config["backend"] = backend
+    save_index_config(config, db_dir)
+
+
+class NumpyVectorStore:
+    '''
+    Read-only stand-in for the project's Chroma store, searching a float32 matrix (or its compressed codes) by
+    brute force
+
+    Implements the parts of the Chroma vector store the query path uses: `embeddings`,
+    `similarity_search_by_vector`, `similarity_search` and `get`
+    '''
+
+    def __init__(self, doc_ids, vectors, metric, embedding_function, codes = None, quantizer = None):
+        self.doc_ids = list(doc_ids)
+        # full precision vectors; None for a compressed index without rerank
+        self.vectors = vectors
+        self.metric = metric
+        self.embeddings = embedding_function
+        self.codes = codes
+        self.quantizer = quantizer
+
+        if quantizer is not None:
+            self.squared_norms = quantizer.squared_norms(codes) if metric == "l2" else None
+        else:
+            self.squared_norms = np.einsum("ij,ij->i", vectors, vectors) if metric == "l2" else None
+
+    @classmethod
+    def load(cls, db_dir, embedding_function):
+        '''
+        opens the exported index of `db_dir`. The vectors and codes are memory-mapped, not read
+        '''
+        config = load_index_config(db_dir)
+        doc_ids = np.load(f"{db_dir}/{DOC_IDS_FILE}").tolist()
+        vectors = np.load(f"{db_dir}/{VECTORS_FILE}", mmap_mode="r") if VECTORS_FILE in _index_files(config) else None
+
+        compression = config.get("compression", "float32")
+        if compression == "float32":
+            return cls(doc_ids, vectors, config["metric"], embedding_function)
+
+        codes = np.load(f"{db_dir}/{CODES_FILE}", mmap_mode="r")
+        with np.load(f"{db_dir}/{QUANTIZER_FILE}") as params:
+            quantizer = load_quantizer(compression, dict(params))
+
+        return cls(doc_ids, vectors, config["metric"], embedding_function, codes = codes, quantizer = quantizer)
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    @property
+    def dimension(self):
+        if self.vectors is not None:
+            return int(self.vectors.shape[1]) if len(self.vectors) else 0
+        return int(self.quantizer.decode(self.codes[:1]).shape[1]) if len(self.codes) else 0
+
+    @property
+    def nbytes(self):
+        '''
+        memory searched per query: the vectors, or the codes and quantizer of a compressed index (the
+        full precision vectors used to rerank are only read for the candidates)
+        '''
+        if self.quantizer is None:
+            return self.vectors.nbytes
+        return self.codes.nbytes + self.quantizer.nbytes
+
+    def search(self, query_vectors, k = 4):
+        '''
+        row indices of the `k` best matches of each query vector, best first
+        '''
+        if len(self.doc_ids) == 0:
+            return np.zeros((len(query_vectors), 0), dtype=np.int64)
+
+        if self.quantizer is None:
+            return top_k_similar(query_vectors, self.vectors, k, self.metric, squared_norms=self.squared_norms)
+
+        scores = self.quantizer.scores(query_vectors, self.codes, self.metric, squared_norms=self.squared_norms)
+        if self.vectors is None:
+            return top_k_scores(scores, k)
+
+        # rerank the best candidates of the codes at full precision
+        candidates = top_k_scores(scores, k * RERANK_FACTOR)
+        query_vectors = np.asarray(query_vectors, dtype=np.float32)
+        top = []
+        for query_vector, rows in zip(query_vectors, candidates):
+            rows = np.sort(rows)
+            best = top_k_similar(query_vector[None, :], np.asarray(self.vectors[rows]), k, self.metric)[0]
+            top.append(rows[best])
+        return np.asarray(top)
+
+    def reconstructed_vectors(self):
+        '''
+        the full precision vectors, or the decoded codes if they are not kept
+        '''
+        if self.vectors is not None:
+            return self.vectors
+        return self.quantizer.decode(self.codes)
+
+    def similarity_search_by_vector(self, embedding, k = 4, **kwargs):
+        top = self.search([embedding], k)[0]
+        return [Document(page_content="", metadata={'doc_id' : self.doc_ids[i]}) for i in top]
+
+    def similarity_search(self, query, k = 4, **kwargs):
+        return self.similarity_search_by_vector(self.embeddings.embed_query(query), k = k)
+
+    def get(self, ids = None, limit = None, include = ("metadatas",), **kwargs):
+        '''
+        Chroma-style `get`, by doc_id or for the first `limit` rows
+        '''
+        if ids is not None:
+            wanted = set([ids] if isinstance(ids, str) else ids)
+            rows = [i for i, doc_id in enumerate(self.doc_ids) if doc_id in wanted]
+        else:
+            rows = list(range(len(self.doc_ids)))[:limit]
+
+        if "embeddings" in include:
+            embeddings = np.asarray(self.vectors[rows]) if self.vectors is not None else self.quantizer.decode(self.codes[rows])
+        else:
+            embeddings = None
+
+        return {
+            "ids" : [self.doc_ids[i] for i in rows],
+            "embeddings" : embeddings,
+            "metadatas" : [{'doc_id' : self.doc_ids[i]} for i in rows] if "metadatas" in include else None,
+            "documents" : None,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export a project's vectors for brute-force NumPy search")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export", help="export the project's Chroma vectors and use them for queries")
+    export_parser.add_argument("db_dir")
+    export_parser.add_argument("--backend", choices=BACKENDS, help="backend to use for queries afterwards (default numpy)")
+    export_parser.add_argument("--compression", choices=COMPRESSIONS, help="how the vectors are stored (default: as before, or float32)")
+    export_parser.add_argument("--pq-subvectors", type=int, help=f"bytes per vector with pq compression (default {DEFAULT_PQ_SUBVECTORS})")
+    export_parser.add_argument("--no-rerank", dest="rerank", action="store_false", default=None, help="do not keep full precision vectors to rerank compressed results")
+
+    select_parser = subparsers.add_parser("select", help="choose the backend used for queries")
+    select_parser.add_argument("db_dir")
+    select_parser.add_argument("backend", choices=BACKENDS)
+
+    args = parser.parse_args()
+
+    if args.command == "export":
+        from langchain_chroma import Chroma
+
+        # only the stored vectors are read, so no embedding function (or API key) is needed
+        db = Chroma(persist_directory=f"{args.db_dir}/chroma_db")
+        export_vector_index(db, args.db_dir, backend=args.backend, compression=args.compression, rerank=args.rerank, pq_subvectors=args.pq_subvectors)
+    else:
+        select_backend(args.db_dir, args.backend)
+        print(f"{args.db_dir} now uses {args.backend}")
+
+
+if __name__ == "__main__":
+    main()